@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+from datetime import datetime
+from time import monotonic
+
+import ingest
+import metrics
+import state
+from clickhouse import clickhouse_insert_command_ack
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ACK_TIMEOUT = 10
+ACK_CHECK_INTERVAL = 1
+LATENCY_SAMPLES = 200
+# Команда -> событие, которым домофон сообщает о её выполнении в топике message
+ACK_EVENTS = {"open-door": "open-door", "call-response": "open-door"}
+
+ACK_SECONDS = metrics.Histogram("command_ack_seconds", "Round trip from command publish to device acknowledgement",
+                                ["event"])
+ACK_RESULTS = metrics.Counter("command_ack_results_total", "Command outcomes reported by devices", ["event", "status"])
+
+
+class PendingCommand:
+    __slots__ = ("command_id", "mac", "event", "sent_at", "local")
+
+    def __init__(self, command_id: str, mac: str, event: str, sent_at: float, local: bool = True):
+        self.command_id = command_id
+        self.mac = mac
+        self.event = event
+        self.sent_at = sent_at
+        # Команду отправила другая реплика: итог записывает она, здесь запись нужна только для сопоставления
+        self.local = local
+
+
+class AckTracker:
+    """Ждёт от домофона подтверждения отправленной команды и записывает итог и задержку в command_acks.
+
+    Подтверждение сопоставляется по command_id из сообщения, а если домофон его не вернул —
+    с самой старой ещё не просроченной командой этого mac с подходящим событием.
+    В кластере ожидающие команды рассылаются через state.backend: ответ домофона может прийти
+    на любую реплику, она передаёт итог отправившей реплике, которая и пишет строку.
+    """
+
+    def __init__(self, timeout: float = ACK_TIMEOUT, samples: int = LATENCY_SAMPLES):
+        self.timeout = timeout
+        self.samples = samples
+        # (mac, command_id) -> PendingCommand в порядке отправки, поэтому просроченные всегда в начале
+        self.pending = {}
+        # mac -> {command_id: PendingCommand} в порядке отправки
+        self.by_mac = {}
+        self.latencies = {}
+        self.stats = {"sent": 0, "acked": 0, "failed": 0, "timeouts": 0, "unmatched": 0}
+
+    def _add(self, command: PendingCommand):
+        self.pending[(command.mac, command.command_id)] = command
+        self.by_mac.setdefault(command.mac, {})[command.command_id] = command
+
+    def _pop(self, mac: str, command_id: str):
+        command = self.pending.pop((mac, command_id), None)
+        if command is not None:
+            commands = self.by_mac[mac]
+            del commands[command_id]
+            if not commands:
+                del self.by_mac[mac]
+        return command
+
+    def new_command(self, mac: str, event: str) -> str:
+        command_id = uuid.uuid4().hex[:16]
+        self._add(PendingCommand(command_id, mac, event, monotonic()))
+        self.stats["sent"] += 1
+        state.backend.command_sent(mac, command_id, event)
+        return command_id
+
+    def cancel(self, mac: str, command_id: str):
+        # Команда не ушла брокеру, ждать подтверждения нечего
+        if self._pop(mac, command_id) is not None:
+            self.stats["sent"] -= 1
+            state.backend.command_resolved(mac, command_id, None)
+
+    def _find(self, mac: str, payload: dict):
+        command_id = payload.get("command_id")
+        if command_id is not None:
+            return self._pop(mac, command_id)
+        event = payload.get("event")
+        now = monotonic()
+        for command in self.by_mac.get(mac, {}).values():
+            if now - command.sent_at < self.timeout and ACK_EVENTS.get(command.event) == event:
+                return self._pop(mac, command.command_id)
+        return None
+
+    def match(self, mac: str, payload: dict) -> bool:
+        command = self._find(mac, payload)
+        if command is None:
+            if payload.get("command_id") is not None:
+                self.stats["unmatched"] += 1
+            return False
+        status = "success" if payload.get("status") == "success" else "fail"
+        # Остальные реплики снимают свою копию, отправившая реплика записывает итог
+        state.backend.command_resolved(mac, command.command_id, status)
+        if command.local:
+            self._record(command, status)
+        return True
+
+    def _record(self, command: PendingCommand, status: str):
+        latency = monotonic() - command.sent_at
+        self.stats["acked" if status == "success" else "failed"] += 1
+        self.latencies.setdefault(command.mac, deque(maxlen=self.samples)).append(latency)
+        ACK_SECONDS.observe(latency, command.event)
+        ACK_RESULTS.inc(command.event, status)
+        clickhouse_insert_command_ack(datetime.now(), command.mac, command.command_id, command.event, status, latency)
+
+    def add_remote(self, mac: str, command_id: str, event: str):
+        self._add(PendingCommand(command_id, mac, event, monotonic(), local=False))
+
+    def resolve_remote(self, mac: str, command_id: str, status: str | None):
+        command = self._pop(mac, command_id)
+        if command is not None and command.local and status is not None:
+            self._record(command, status)
+
+    def expire(self, now: float | None = None):
+        now = monotonic() if now is None else now
+        while self.pending:
+            command = next(iter(self.pending.values()))
+            if now - command.sent_at < self.timeout:
+                break
+            self._pop(command.mac, command.command_id)
+            if not command.local:
+                continue
+            self.stats["timeouts"] += 1
+            ACK_RESULTS.inc(command.event, "timeout")
+            logger.warning(f"Домофон {command.mac} не подтвердил команду {command.event} за {self.timeout} сек.")
+            clickhouse_insert_command_ack(datetime.now(), command.mac, command.command_id, command.event,
+                                          "timeout", None)
+
+    def latency_stats(self) -> dict:
+        devices = {}
+        for mac, values in self.latencies.items():
+            values = list(values)
+            devices[mac] = {"p50": ingest.percentile(values, 0.5), "p95": ingest.percentile(values, 0.95),
+                            "p99": ingest.percentile(values, 0.99), "count": len(values)}
+        return devices
+
+    async def run(self, interval: float = ACK_CHECK_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке подтверждений команд: {e}")
+
+
+tracker = AckTracker()
+
+PENDING = metrics.Gauge("command_ack_pending", "Commands waiting for device acknowledgement",
+                        function=lambda: len(tracker.pending))
@@ -0,0 +1,47 @@
+"""Нагрузочный прогон конвейера уведомлений на симулированном парке домофонов.
+
+    python -m benchmarks smoke               # прогон и сравнение с benchmarks/baselines/smoke.json
+    python -m benchmarks fleet --save        # обновить базовую линию
+    python -m benchmarks fleet --devices 5000 --broker localhost --clickhouse
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from benchmarks.harness import SCENARIOS, compare, load_baseline, run_benchmark, save_baseline
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS), nargs="?", default="smoke")
+    parser.add_argument("--devices", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--life-interval", type=float)
+    parser.add_argument("--message-interval", type=float)
+    parser.add_argument("--broker", help="хост настоящего MQTT-брокера вместо брокера в памяти")
+    parser.add_argument("--clickhouse", action="store_true", help="писать строки и в настоящий Clickhouse")
+    parser.add_argument("--save", action="store_true", help="сохранить результат как базовую линию")
+    args = parser.parse_args()
+
+    params = dict(SCENARIOS[args.scenario])
+    for name in ("devices", "duration", "life_interval", "message_interval"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    report = asyncio.run(run_benchmark(**params, broker_host=args.broker, real_clickhouse=args.clickhouse))
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        save_baseline(args.scenario, report)
+        return 0
+    baseline = load_baseline(args.scenario)
+    if baseline is None:
+        return 0
+    regressions = compare(report, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import heapq
+import json
+import random
+from collections import deque
+from datetime import datetime
+from time import perf_counter
+
+EVENTS = ("door-open", "key", "call-start", "call-end")
+
+
+def make_mac(index: int) -> str:
+    return ":".join(f"{byte:02X}" for byte in (0x02, 0, 0, index >> 16 & 0xFF, index >> 8 & 0xFF, index & 0xFF))
+
+
+class Fleet:
+    """Парк домофонов: конфигурация при подключении, затем пульсы и события с заданной частотой.
+
+    Отправленные сообщения учитываются по (таблица, mac), чтобы приёмник мог сопоставить строку
+    с моментом её публикации: порядок внутри домофона и класса сохраняется конвейером.
+    """
+
+    def __init__(self, devices: int, life_interval: float, message_interval: float, seed: int = 1):
+        self.random = random.Random(seed)
+        self.macs = [make_mac(index) for index in range(devices)]
+        self.life_interval = life_interval
+        self.message_interval = message_interval
+        self.sent = {}
+        self.published = 0
+        self.schedule = []
+        self.calls = set()
+
+    def _record(self, table: str, mac: str):
+        self.sent.setdefault((table, mac), deque()).append(perf_counter())
+        self.published += 1
+
+    def config(self, mac: str):
+        self._record('intercom_configs', mac)
+        return f"intercom/{mac}/config", json.dumps({
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "event": "added",
+            "new_config": {"location": f"Building {int(mac[-2:], 16) % 10}", "apartments": list(range(1, 9)),
+                           "allowed_keys": [self.random.randint(1000, 9999) for _ in range(4)]},
+        })
+
+    def life(self, mac: str):
+        self._record('intercom_life', mac)
+        return f"intercom/{mac}/life", json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                   "status": "online"})
+
+    def message(self, mac: str):
+        self._record('intercom_messages', mac)
+        # Вызов всегда завершается тем же домофоном, иначе call-end упадёт на отсутствующем вызове
+        if mac in self.calls:
+            event = "call-end"
+            self.calls.discard(mac)
+        else:
+            event = self.random.choice(EVENTS[:3])
+            if event == "call-start":
+                self.calls.add(mac)
+        return f"intercom/{mac}/message", json.dumps({
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "event": event, "status": "success",
+            "door_status": "open", "key": self.random.randint(1000, 9999), "apartment": "5",
+            "location": "Building 0",
+        })
+
+    def start(self, now: float):
+        # Фазы устройств разнесены, чтобы нагрузка была равномерной, а не пачками
+        for mac in self.macs:
+            heapq.heappush(self.schedule, (now + self.random.uniform(0, self.life_interval), mac, "life"))
+            if self.message_interval:
+                heapq.heappush(self.schedule,
+                               (now + self.random.uniform(0, self.message_interval), mac, "message"))
+
+    def due(self, now: float):
+        while self.schedule and self.schedule[0][0] <= now:
+            at, mac, kind = heapq.heappop(self.schedule)
+            interval = self.life_interval if kind == "life" else self.message_interval
+            heapq.heappush(self.schedule, (at + interval, mac, kind))
+            yield getattr(self, kind)(mac)
+
+    def next_at(self):
+        return self.schedule[0][0] if self.schedule else None
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import resource
+from contextlib import AsyncExitStack
+from time import perf_counter, process_time
+from unittest.mock import patch
+
+from aiomqtt import Client
+
+import clickhouse
+import ingest
+import logs
+import main  # noqa: F401 - регистрирует обработчик config
+import notifications
+import state
+from benchmarks.fleet import Fleet
+from tests.fake_broker import FakeBroker
+
+SCENARIOS = {
+    "smoke": {"devices": 20, "duration": 0.5, "life_interval": 0.1, "message_interval": 0.25, "buffer_delay": 0.05},
+    "fleet": {"devices": 1000, "duration": 10.0, "life_interval": 1.0, "message_interval": 10.0,
+              "buffer_delay": clickhouse.BUFFER_MAX_DELAY},
+}
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+DRAIN_TIMEOUT = 30.0
+# Пропускная способность меряется отдельной пачкой: столько пульсов и событий на домофон публикуется без пауз
+SATURATION_ROUNDS = 5
+# Метрика -> (направление, допустимое отношение к базовой линии)
+TOLERANCES = {
+    "throughput": ("min", 0.8),
+    "latency_p99": ("max", 1.5),
+    "cpu_per_message_us": ("max", 1.5),
+}
+
+
+# Таблицы, строки которых соответствуют сообщениям парка; тела конфигураций пишутся только для новых хэшей
+TABLES = ('intercom_configs', 'intercom_messages', 'intercom_life')
+
+
+class Sink:
+    """Подменяет клиент Clickhouse и фиксирует задержку от публикации до записи каждой строки.
+
+    С inner строки дополнительно пишутся в настоящий Clickhouse.
+    """
+
+    def __init__(self, fleet: Fleet, inner=None):
+        self.fleet = fleet
+        self.inner = inner
+        self.latencies = []
+        self.stored = 0
+
+    async def insert(self, table: str, rows: list, column_names=None, **kwargs):
+        if self.inner is not None:
+            await self.inner.insert(table, rows, column_names=column_names, **kwargs)
+        if table not in TABLES:
+            return
+        now = perf_counter()
+        for row in rows:
+            sent = self.fleet.sent.get((table, row[2]))
+            if sent:
+                self.latencies.append(now - sent.popleft())
+        self.stored += len(rows)
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, q: float) -> float:
+    return ingest.percentile(values, q)
+
+
+async def drain(sink: Sink, fleet: Fleet):
+    deadline = perf_counter() + DRAIN_TIMEOUT
+    while sink.stored < fleet.published and perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def run_benchmark(devices: int, duration: float, life_interval: float, message_interval: float,
+                        buffer_delay: float = clickhouse.BUFFER_MAX_DELAY, broker_host: str | None = None,
+                        real_clickhouse: bool = False) -> dict:
+    fleet = Fleet(devices, life_interval, message_interval)
+    sink = Sink(fleet, await clickhouse.init_client() if real_clickhouse else None)
+    broker = FakeBroker()
+
+    async def fake_client():
+        return sink
+
+    async with AsyncExitStack() as stack:
+        # Тот же конвейер, что и в сервисе, но с брокером и приёмником бенчмарка
+        stack.enter_context(patch.object(ingest, "connect",
+                                         (lambda: Client(broker_host)) if broker_host else broker.client))
+        # Пульсы не сбрасываются при переполнении: при насыщении сохранённым должно быть каждое сообщение
+        stack.enter_context(patch.object(ingest, "ingest_queue", ingest.IngestQueue(low_policy="block")))
+        stack.enter_context(patch.object(clickhouse, "init_client", fake_client))
+        stack.enter_context(patch.object(clickhouse, "buffers", {
+            table: clickhouse.InsertBuffer(table, max_delay=buffer_delay)
+            for table in TABLES + ('intercom_config_bodies',)}))
+        stack.enter_context(patch.object(clickhouse, "known_config_hashes", set()))
+        stack.enter_context(patch.object(state, "door_phones", state.Registry()))
+        stack.enter_context(patch.object(state, "last_seen", {}))
+        stack.enter_context(patch.object(state, "current_calls", {}))
+        stack.enter_context(patch.object(notifications, "deadlines", []))
+        stack.enter_context(patch.object(notifications, "next_deadline", {}))
+        stack.enter_context(patch.object(notifications, "offline", set()))
+        # Задержка считается по каждой строке пульса, поэтому замер идёт в режиме raw
+        stack.enter_context(patch.object(notifications, "LIFE_MODE", "raw"))
+        devnull = stack.enter_context(open(os.devnull, "w"))
+        stack.callback(logs.setup_logging(stream=devnull).stop)
+
+        publisher = await stack.enter_async_context(Client(broker_host)) if broker_host else None
+
+        async def publish(topic: str, payload: str):
+            if publisher is not None:
+                await publisher.publish(topic, payload)
+            else:
+                broker.deliver(topic, payload)
+
+        tasks = [asyncio.create_task(ingest.listen()), asyncio.create_task(clickhouse.run_buffers())]
+        try:
+            while not broker_host and not broker.clients:
+                await asyncio.sleep(0)
+
+            rss_before = rss_kb()
+            cpu_before = process_time()
+            started = perf_counter()
+            for mac in fleet.macs:
+                await publish(*fleet.config(mac))
+            fleet.start(perf_counter())
+            end = started + duration
+            while (now := perf_counter()) < end:
+                for topic, payload in fleet.due(now):
+                    await publish(topic, payload)
+                await asyncio.sleep(max(min(fleet.next_at(), end) - perf_counter(), 0))
+
+            await drain(sink, fleet)
+            elapsed = perf_counter() - started
+            cpu = process_time() - cpu_before
+            rss_after = rss_kb()
+            latencies = list(sink.latencies)
+
+            # По расписанию конвейер получает ровно предложенную нагрузку, поэтому пропускная способность
+            # меряется на пачке, опубликованной без пауз, от первой публикации до записи последней строки
+            stored_before = sink.stored
+            saturation_started = perf_counter()
+            for _ in range(SATURATION_ROUNDS):
+                for mac in fleet.macs:
+                    await publish(*fleet.life(mac))
+                    await publish(*fleet.message(mac))
+            await drain(sink, fleet)
+            saturation_elapsed = perf_counter() - saturation_started
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        "devices": devices,
+        "published": fleet.published,
+        "stored": sink.stored,
+        "elapsed": round(elapsed, 3),
+        "offered_rate": round(stored_before / elapsed, 1),
+        "throughput": round((sink.stored - stored_before) / saturation_elapsed, 1),
+        "latency_p50": round(percentile(latencies, 0.5), 4),
+        "latency_p99": round(percentile(latencies, 0.99), 4),
+        "memory_growth_kb": rss_after - rss_before,
+        "cpu_per_message_us": round(cpu / max(stored_before, 1) * 1e6, 1),
+    }
+
+
+def baseline_path(scenario: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{scenario}.json")
+
+
+def load_baseline(scenario: str) -> dict | None:
+    try:
+        with open(baseline_path(scenario)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(scenario: str, report: dict):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(scenario), "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+def compare(report: dict, baseline: dict) -> list:
+    regressions = []
+    for metric, (direction, ratio) in TOLERANCES.items():
+        current, reference = report[metric], baseline.get(metric)
+        if not reference:
+            continue
+        if direction == "min" and current < reference * ratio:
+            regressions.append(f"{metric}: {current} < {reference} * {ratio}")
+        if direction == "max" and current > reference * ratio:
+            regressions.append(f"{metric}: {current} > {reference} * {ratio}")
+    return regressions
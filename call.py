@@ -1,13 +1,15 @@
 from fastapi import APIRouter, Path
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, StreamingResponse
 
+import acks
+import events
 import state
 import logging
 
 import json
 from datetime import datetime
 from clickhouse import clickhouse_insert_commands
-from aiomqtt import Client
+from publisher import publisher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,11 +20,13 @@ call_router = APIRouter()
 async def call_handler(time, mac, event, apartment, location):
     if mac in state.door_phones:
         if event == "call-start":
-            state.current_calls[mac] = {"time": time, "apartment": apartment, "location": location}
-            logger.info(f"call start - {state.current_calls}")
+            state.backend.start_call(mac, {"time": time, "apartment": apartment, "location": location})
+            events.publish("calls", "call-start", {"mac": mac, "call": state.current_calls[mac]})
+            logger.info("call start - %s", state.current_calls, extra={"mac": mac, "transition": True})
         if event == "call-end":
-            state.current_calls.pop(mac)
-            logger.info(f"call end - {state.current_calls}")
+            state.backend.end_call(mac)
+            events.publish("calls", "call-end", {"mac": mac})
+            logger.info("call end - %s", state.current_calls, extra={"mac": mac, "transition": True})
     else:
         logger.warning(f"Данный домофон не подключен к сети {mac}")
 
@@ -34,14 +38,19 @@ async def call_open(mac: str = Path(..., min_length=17, max_length=17)):
         time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         event = "call-response"
         status = "success"
-        async with Client("mqtt") as client:
-            await client.publish(f'intercom/{mac}/management',
-                                 payload=json.dumps({"time": time,
-                                                     "event": event,
-                                                     "status": status}),
-                                 qos=1)
-            await clickhouse_insert_commands(time, mac, event, status)
-            logger.info(f'Отправлен запрос на {mac} - Открыть дверь')
+        command_id = acks.tracker.new_command(mac, event)
+        try:
+            await publisher.publish(f'intercom/{mac}/management',
+                                    payload=json.dumps({"time": time,
+                                                        "event": event,
+                                                        "status": status,
+                                                        "command_id": command_id}),
+                                    qos=1)
+        except BaseException:
+            acks.tracker.cancel(mac, command_id)
+            raise
+        await clickhouse_insert_commands(time, mac, event, status)
+        logger.info(f'Отправлен запрос на {mac} - Открыть дверь')
     except Exception as e:
         logger.error(e)
     return RedirectResponse(f"/calls/", status_code=303)
@@ -51,3 +60,11 @@ async def call_open(mac: str = Path(..., min_length=17, max_length=17)):
 async def calls_data():
     return state.current_calls
 
+
+@call_router.get("/calls/events")
+async def calls_events():
+    return StreamingResponse(events.stream("calls", lambda: state.current_calls),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
@@ -1,12 +1,95 @@
 from clickhouse_connect import get_async_client
+import asyncio
+import hashlib
+import json
 import logging
+import os
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from time import monotonic
+
+import metrics
+from spool import Spool, SPOOL_DIR
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 client = None
+# Пока идут миграции схемы, буферы только копят строки
+schema_ready = True
+
+TABLE_COLUMNS = {
+    'intercom_configs': ['notification_type', 'time', 'mac', 'event', 'new_config', 'old_config', 'new_config_hash',
+                         'old_config_hash'],
+    'intercom_messages': ['notification_type', 'time', 'mac', 'event', 'status', 'door_status', 'reason', 'key',
+                          'result', 'apartment', 'location'],
+    'intercom_life': ['notification_type', 'time', 'mac', 'status'],
+    'management_commands': ['notification_type', 'time', 'mac', 'event', 'status'],
+    'intercom_config_bodies': ['config_hash', 'time', 'location', 'apartments', 'allowed_keys', 'body'],
+    'intercom_life_summary': ['time', 'mac', 'heartbeats', 'raw_rows', 'first_seen', 'last_seen', 'max_gap'],
+    'command_acks': ['time', 'mac', 'command_id', 'event', 'status', 'latency'],
+}
+
+# Колонки DateTime каждой таблицы: в спуле они хранятся строками и при повторе переводятся обратно
+DATETIME_COLUMNS = {table: ('time',) for table in TABLE_COLUMNS}
+DATETIME_COLUMNS['intercom_life_summary'] = ('time', 'first_seen', 'last_seen')
+
+# Колонки, которые показываются на странице уведомлений. Сейчас страница выводит все сохранённые колонки
+VIEW_COLUMNS = TABLE_COLUMNS
+
+PAGE_SIZE = 100
+
+# Каждая таблица хранит ровно один notification_type
+TYPE_TABLES = {
+    'config': 'intercom_configs',
+    'message': 'intercom_messages',
+    'life': 'intercom_life',
+    'management_commands': 'management_commands',
+}
+
+BUFFER_MAX_ROWS = 1000
+BUFFER_MAX_DELAY = 1.0
+BUFFER_MAX_PENDING = 100_000
+BUFFER_MAX_BACKOFF = 30.0
+
+# Формат выгрузки -> (формат вывода Clickhouse, MIME-тип, расширение файла)
+EXPORT_FORMATS = {
+    'csv': ('CSVWithNames', 'text/csv', 'csv'),
+    'arrow': ('ArrowStream', 'application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('Parquet', 'application/vnd.apache.parquet', 'parquet'),
+}
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+CACHE_MAX_SIZE = 256
+CACHE_TTL = 5.0
+
+
+INSERT_SECONDS = metrics.Histogram("clickhouse_insert_seconds", "ClickHouse insert latency by table", ["table"])
+INSERTED_ROWS = metrics.Counter("clickhouse_inserted_rows_total", "Rows inserted into ClickHouse by table", ["table"])
+INSERT_ERRORS = metrics.Counter("clickhouse_insert_errors_total", "Failed ClickHouse inserts by table", ["table"])
+QUERY_SECONDS = metrics.Histogram("clickhouse_query_seconds", "ClickHouse query latency by table", ["table"])
+QUERY_ROWS = metrics.Counter("clickhouse_query_rows_total", "Rows read from ClickHouse by table", ["table"])
+
+
+async def timed_insert(client, table: str, rows: list, **kwargs):
+    started = monotonic()
+    try:
+        await client.insert(table, rows, **kwargs)
+    except Exception:
+        INSERT_ERRORS.inc(table)
+        raise
+    INSERT_SECONDS.observe(monotonic() - started, table)
+    INSERTED_ROWS.inc(table, amount=len(rows))
+
+
+async def timed_query(client, table: str, query: str, **kwargs):
+    started = monotonic()
+    result = await client.query(query, **kwargs)
+    QUERY_SECONDS.observe(monotonic() - started, table)
+    QUERY_ROWS.inc(table, amount=len(result.result_rows))
+    return result
 
 
 async def init_client():
@@ -16,6 +99,222 @@ async def init_client():
     return client
 
 
+class InsertBuffer:
+    def __init__(self, table: str, max_rows: int = BUFFER_MAX_ROWS, max_delay: float = BUFFER_MAX_DELAY,
+                 max_pending: int = BUFFER_MAX_PENDING, spool: Spool | None = None):
+        self.table = table
+        self.column_names = TABLE_COLUMNS[table]
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.rows = []
+        self.oldest = None
+        self.full = None
+        self.backoff = 0.0
+        # Без спула строки при недоступности Clickhouse копятся в памяти до max_pending
+        self.spool = spool
+        self.stats = {"flushes": 0, "rows": 0, "errors": 0, "dropped": 0,
+                      "last_size": 0, "last_latency": 0.0, "last_lag": 0.0, "max_lag": 0.0}
+
+    def add(self, row: list):
+        if not self.rows:
+            self.oldest = monotonic()
+        elif len(self.rows) >= self.max_pending:
+            # Пока запись на паузе (миграции, повтор после ошибки), буфер не растёт сверх max_pending
+            del self.rows[0]
+            self.stats["dropped"] += 1
+            if self.stats["dropped"] % self.max_rows == 1:
+                logger.error(f"Буфер {self.table} переполнен, отброшено {self.stats['dropped']} строк")
+        self.rows.append(row)
+        # Во время паузы после ошибки повторная запись по заполнению не запускается
+        if self.full is not None and not self.backoff and len(self.rows) >= self.max_rows:
+            self.full.set()
+
+    async def flush(self):
+        if not self.rows:
+            return 0
+        # Забираем накопленные строки целиком, новые сообщения пишутся уже в следующую пачку
+        rows, self.rows = self.rows, []
+        oldest, self.oldest = self.oldest, None
+        if self.full is not None:
+            self.full.clear()
+
+        started = monotonic()
+        try:
+            await self._insert(rows)
+        except Exception:
+            self.stats["errors"] += 1
+            if not await self.spill(rows):
+                self._restore(rows, oldest)
+            raise
+        except BaseException:
+            # CancelledError при остановке: строки возвращаются в буфер для финальной записи
+            self._restore(rows, oldest)
+            raise
+
+        latency = monotonic() - started
+        lag = started - oldest
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(rows)
+        self.stats["last_size"] = len(rows)
+        self.stats["last_latency"] = latency
+        self.stats["last_lag"] = lag
+        self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+        logger.info("Flushed %d rows into %s in %.3fs, lag %.3fs", len(rows), self.table, latency, lag,
+                    extra={"table": self.table})
+        return len(rows)
+
+    async def _insert(self, rows: list):
+        client = await init_client()
+        await timed_insert(client, self.table, rows, column_names=self.column_names)
+        query_cache.invalidate(self.table, {row[2] for row in rows})
+
+    async def spill(self, rows: list):
+        if self.spool is None:
+            return False
+        try:
+            await self.spool.append(rows)
+        except Exception as e:
+            logger.error(f"Ошибка при записи {self.table} в спул: {e}")
+            return False
+        logger.warning(f"Clickhouse недоступен, {len(rows)} строк {self.table} сохранены в спул")
+        return True
+
+    async def replay(self):
+        if self.spool is None or not self.spool.sizes:
+            return 0
+        indexes = [self.column_names.index(column) for column in DATETIME_COLUMNS[self.table]]
+
+        async def insert(rows: list):
+            for row in rows:
+                for index in indexes:
+                    row[index] = datetime.fromisoformat(row[index])
+            await self._insert(rows)
+
+        return await self.spool.replay(insert)
+
+    def _restore(self, rows: list, oldest: float):
+        self.rows = rows + self.rows
+        self.oldest = oldest
+        overflow = len(self.rows) - self.max_pending
+        if overflow > 0:
+            del self.rows[:overflow]
+            self.stats["dropped"] += overflow
+            logger.error(f"Буфер {self.table} переполнен, отброшено {overflow} строк")
+
+    async def run(self):
+        self.full = asyncio.Event()
+        if self.spool is not None:
+            self.spool.recover()
+        if len(self.rows) >= self.max_rows:
+            self.full.set()
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not schema_ready:
+                await asyncio.sleep(self.max_delay)
+                continue
+            try:
+                await self.flush()
+                await self.replay()
+                self.backoff = 0.0
+            except Exception as e:
+                self.backoff = min(max(self.backoff * 2, self.max_delay), max(BUFFER_MAX_BACKOFF, self.max_delay))
+                logger.error(f"Ошибка при записи в {self.table}: {e}, повтор через {self.backoff:.1f}с")
+                await asyncio.sleep(self.backoff)
+                self.full.clear()
+
+
+class QueryCache:
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # (таблица, mac) -> ключи кэша, которые нужно сбросить при записи в эту таблицу
+        self.index = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                self._delete(key)
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key, value):
+        table, mac = key[0], key[1]
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.index.setdefault((table, mac), set()).add(key)
+        while len(self.entries) > self.max_size:
+            self._delete(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _delete(self, key):
+        self.entries.pop(key, None)
+        keys = self.index.get((key[0], key[1]))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.index[(key[0], key[1])]
+
+    def invalidate(self, table: str, macs):
+        # Запросы без фильтра по mac ('all') видят любую новую строку таблицы
+        for mac in set(macs) | {'all'}:
+            for key in self.index.pop((table, mac), set()):
+                self.entries.pop(key, None)
+                self.stats["invalidations"] += 1
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+
+query_cache = QueryCache()
+
+CACHE_HIT_RATE = metrics.Gauge("clickhouse_cache_hit_rate", "Share of page queries served from the cache",
+                               function=lambda: query_cache.hit_rate())
+
+buffers = {table: InsertBuffer(table, spool=Spool(os.path.join(SPOOL_DIR, table)))
+           for table in ('intercom_configs', 'intercom_messages', 'intercom_life', 'management_commands',
+                         'intercom_config_bodies', 'intercom_life_summary', 'command_acks')}
+
+# Хэши тел конфигураций, уже отправленных в intercom_config_bodies этим процессом
+known_config_hashes = set()
+
+
+async def run_buffers():
+    await asyncio.gather(*(buffer.run() for buffer in buffers.values()))
+
+
+async def flush_buffers():
+    # Ошибка одной таблицы не мешает остальным сбросить строки (в Clickhouse или в спул)
+    error = None
+    for buffer in buffers.values():
+        try:
+            await buffer.flush()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+
+def buffer_stats():
+    return {table: {**buffer.stats, "pending": len(buffer.rows),
+                    "spool": {**buffer.spool.stats, **buffer.spool.depth()} if buffer.spool else None}
+            for table, buffer in buffers.items()}
+
+
+def cache_stats():
+    return {**query_cache.stats, "size": len(query_cache.entries), "hit_rate": query_cache.hit_rate()}
+
+
 async def clickhouse_tables():
     global client
     client = await init_client()
@@ -76,48 +375,63 @@ async def clickhouse_tables():
     logger.info("Table management_commands created")
 
 
-async def clickhouse_insert_config(time: str, mac: str, event: str, new_config: dict | None, old_config: dict | None):
-    logger.info("Inserting new config")
-    global client
-    client = await init_client()
+def canonical_config(config: dict):
+    # Канонический JSON: одинаковые конфигурации дают одинаковую строку и хэш независимо от порядка ключей
+    body = json.dumps(config, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return body, hashlib.sha1(body.encode()).hexdigest()
 
-    if new_config:
-        new_config_str = str(new_config)
-    else:
-        new_config_str = None
 
-    if old_config:
-        old_config_str = str(old_config)
-    else:
-        old_config_str = None
+def remember_config(time: datetime, config: dict):
+    body, config_hash = canonical_config(config)
+    known = config_hash in known_config_hashes
+    if not known:
+        known_config_hashes.add(config_hash)
+        buffers['intercom_config_bodies'].add([
+            config_hash,
+            time,
+            str(config.get('location') or ''),
+            [str(apartment) for apartment in config.get('apartments') or []],
+            [str(key) for key in config.get('allowed_keys') or []],
+            body
+        ])
+    return body, config_hash, known
+
 
+async def clickhouse_insert_config(time: str, mac: str, event: str, new_config: dict | None, old_config: dict | None):
     notification_type = 'config'
     time_datetype = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
 
-    await client.insert('intercom_configs', [[
+    new_config_str = old_config_str = None
+    new_config_hash = old_config_hash = ''
+    if new_config:
+        new_config_str, new_config_hash, known = remember_config(time_datetype, new_config)
+        # Переподключение с уже записанной конфигурацией хранит только ссылку на тело
+        if event == 'reconnect' and known:
+            new_config_str = None
+    if old_config:
+        old_config_str, old_config_hash, _ = remember_config(time_datetype, old_config)
+
+    buffers['intercom_configs'].add([
         notification_type,
         time_datetype,
         mac,
         event,
         new_config_str,
-        old_config_str
-    ]])
-    logger.info("Inserted new config")
+        old_config_str,
+        new_config_hash,
+        old_config_hash
+    ])
+    logger.debug("Queued new config", extra={"mac": mac, "kind": "config"})
 
 
 async def clickhouse_insert_message(time: str, mac: str, event: str, status: str, door_status: str,
                                     reason: str | None, key: int | None, result: str | None, apartment: str | None,
                                     location: str | None):
-
-    logger.info("Inserting new message")
-    global client
-    client = await init_client()
-
     notification_type = 'message'
     time_datetype = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
     str_key = str(key)
 
-    await client.insert('intercom_messages', [[
+    buffers['intercom_messages'].add([
         notification_type,
         time_datetype,
         mac,
@@ -129,44 +443,85 @@ async def clickhouse_insert_message(time: str, mac: str, event: str, status: str
         result,
         apartment,
         location
-    ]])
-    logger.info("Inserted new message")
+    ])
+    logger.debug("Queued new message", extra={"mac": mac, "kind": "message"})
 
 
 async def clickhouse_insert_life(time: str, mac: str, status: str):
-
-    logger.info("Inserting new life-message")
-    global client
-    client = await init_client()
-
     notification_type = 'life'
     time_datetype = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
 
-    await client.insert('intercom_life', [[
+    buffers['intercom_life'].add([
         notification_type,
         time_datetype,
         mac,
         status
-    ]])
-    logger.info("Inserted new life-message")
+    ])
+    logger.debug("Queued new life-message", extra={"mac": mac, "kind": "life"})
+
+
+async def clickhouse_insert_life_summary(time: datetime, mac: str, heartbeats: int, raw_rows: int,
+                                        first_seen: datetime, last_seen: datetime, max_gap: float):
+    buffers['intercom_life_summary'].add([
+        time,
+        mac,
+        heartbeats,
+        raw_rows,
+        first_seen,
+        last_seen,
+        max_gap
+    ])
+    logger.debug("Queued heartbeat summary", extra={"mac": mac, "kind": "life"})
+
+
+def clickhouse_insert_command_ack(time: datetime, mac: str, command_id: str, event: str, status: str,
+                                 latency: float | None):
+    # Синхронная: вызывается и при применении изменений от других реплик (cluster.MqttBackend.apply)
+    buffers['command_acks'].add([
+        time,
+        mac,
+        command_id,
+        event,
+        status,
+        latency
+    ])
+    logger.debug("Queued command acknowledgement", extra={"mac": mac, "event": event})
 
 
 async def clickhouse_insert_commands(time: str, mac: str, event: str, status: str):
+    await clickhouse_insert_command_batch([(time, mac, event, status)])
 
-    logger.info("Inserting new management commands")
-    global client
-    client = await init_client()
 
-    notification_type = 'management_commands'
-    time_datetype = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
+async def clickhouse_insert_command_batch(commands: list):
+    # commands: (time, mac, event, status); массовая команда записывается одной вставкой
 
-    await client.insert('management_commands', [[
+    logger.info("Inserting %d management commands", len(commands))
+    notification_type = 'management_commands'
+    rows = [[
         notification_type,
-        time_datetype,
+        datetime.strptime(time, "%Y-%m-%d %H:%M:%S"),
         mac,
         event,
         status
-    ]])
+    ] for time, mac, event, status in commands]
+    if not schema_ready:
+        # Во время миграции таблица может перестраиваться, строка, записанная напрямую, пропала бы при EXCHANGE
+        for row in rows:
+            buffers['management_commands'].add(row)
+        logger.info("Management commands queued until migrations finish")
+        return
+
+    global client
+    client = await init_client()
+    try:
+        await timed_insert(client, 'management_commands', rows)
+    except Exception as e:
+        # Команда уже отправлена домофону, поэтому запись о ней не теряется, а ждёт в спуле
+        if not await buffers['management_commands'].spill(rows):
+            raise
+        logger.error(f"Ошибка при записи команды в Clickhouse: {e}")
+        return
+    query_cache.invalidate('management_commands', {row[2] for row in rows})
     logger.info("Inserted new management commands")
 
 
@@ -181,47 +536,250 @@ async def json_config_to_clickhouse(mac, payload, reconnect):
     await clickhouse_insert_config(my_time, mac, event, new_config, old_config)
 
 
-async def clickhouse_get(table_name, message_name, selected_mac, selected_type, selected_time):
-    logger.info(f"Getting {message_name} with {selected_mac}, {selected_type}, {selected_time}")
-    global client
-    client = await init_client()
+def time_from(selected_time):
+    now = datetime.now()
+    if selected_time == '1m':
+        return now - timedelta(minutes=1)
+    elif selected_time == '10m':
+        return now - timedelta(minutes=10)
+    elif selected_time == '1h':
+        return now - timedelta(hours=1)
+    elif selected_time == '24h':
+        return now - timedelta(hours=24)
+    return None
+
 
+def filter_conditions(selected_mac, selected_type, selected_time):
+    # Значения из запроса передаются параметрами, а не подставляются в текст SQL
     conditions = []
+    parameters = {}
 
     if selected_mac and selected_mac != 'all':
-        conditions.append(f"mac = '{selected_mac}'")
+        conditions.append("mac = {mac:String}")
+        parameters["mac"] = selected_mac
 
     if selected_type:
-        conditions.append(f"notification_type = '{selected_type}'")
+        conditions.append("notification_type = {type:String}")
+        parameters["type"] = selected_type
 
     if selected_time and selected_time != 'all':
-        now = datetime.now()
-        if selected_time == '1m':
-            time_from = now - timedelta(minutes=1)
-        elif selected_time == '10m':
-            time_from = now - timedelta(minutes=10)
-        elif selected_time == '1h':
-            time_from = now - timedelta(hours=1)
-        elif selected_time == '24h':
-            time_from = now - timedelta(hours=24)
-        else:
-            time_from = None
-
-        if time_from:
-            conditions.append(f"time >= '{time_from.strftime('%Y-%m-%d %H:%M:%S')}'")
+        selected_from = time_from(selected_time)
+        if selected_from:
+            conditions.append("time >= {time_from:DateTime}")
+            parameters["time_from"] = selected_from.replace(microsecond=0)
+
+    return conditions, parameters
+
+
+def encode_cursor(time: str, mac: str, skip: int):
+    return urlsafe_b64encode(json.dumps([time, mac, skip]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        time, mac, skip = json.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.strptime(time, "%Y-%m-%d %H:%M:%S"), str(mac), int(skip)
+    except Exception:
+        raise ValueError(f"Invalid cursor {cursor!r}")
+
+
+async def clickhouse_get_page(table_name, selected_mac, selected_type, selected_time, cursor=None,
+                              limit=PAGE_SIZE):
+    logger.info(f"Getting page of {table_name} with {selected_mac}, {selected_type}, {selected_time}, {cursor}")
+    cache_key = (table_name, selected_mac or 'all', selected_type, selected_time, cursor, limit)
+    cached = query_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Page of {table_name} served from cache")
+        return cached
+
+    global client
+    client = await init_client()
 
+    conditions, parameters = filter_conditions(selected_mac, selected_type, selected_time)
+    skip = 0
+    if cursor:
+        cursor_time, cursor_mac, skip = decode_cursor(cursor)
+        # Строки с тем же (time, mac), что и последняя строка прошлой страницы, идут первыми - их пропускаем через OFFSET
+        conditions.append("time <= {cursor_time:DateTime}")
+        conditions.append("(time, mac) <= ({cursor_time:DateTime}, {cursor_mac:String})")
+        parameters.update(cursor_time=cursor_time, cursor_mac=cursor_mac)
     sql_conditions = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # Остальные колонки задают порядок строк с одинаковыми (time, mac), иначе OFFSET мог бы
+    # пропустить или повторить строку. Полностью совпадающие строки неразличимы, их порядок не важен
+    columns = VIEW_COLUMNS[table_name]
+    tiebreak = ''.join(f", {column} DESC" for column in columns if column not in ('time', 'mac'))
+
+    query = f'''
+            SELECT {', '.join(columns)}
+            FROM {table_name}
+            {sql_conditions}
+            ORDER BY time DESC, mac DESC{tiebreak}
+            LIMIT {limit + 1} OFFSET {skip}
+        '''
+    logger.debug("query: %s", query)
+
+    result = await timed_query(client, table_name, query, parameters=parameters)
+    rows = list(result.named_results())
+    logger.info(f"Got {len(rows)} rows of {table_name}")
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_time = rows[-1]["time"].strftime("%Y-%m-%d %H:%M:%S")
+        last_mac = rows[-1]["mac"]
+        tail = sum(1 for row in rows if row["mac"] == last_mac and row["time"] == rows[-1]["time"])
+        if cursor and cursor_mac == last_mac and cursor_time.strftime("%Y-%m-%d %H:%M:%S") == last_time:
+            tail += skip
+        next_cursor = encode_cursor(last_time, last_mac, tail)
+
+    query_cache.put(cache_key, (rows, next_cursor))
+    return rows, next_cursor
+
+
+def plan_tables(selected_type):
+    if not selected_type:
+        return list(TYPE_TABLES.values())
+    if selected_type in TYPE_TABLES:
+        return [TYPE_TABLES[selected_type]]
+    return []
+
+
+def encode_cursors(cursors: dict):
+    return urlsafe_b64encode(json.dumps(cursors).encode()).decode()
+
+
+def decode_cursors(token: str):
+    try:
+        cursors = json.loads(urlsafe_b64decode(token.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor {token!r}")
+    if not isinstance(cursors, dict) or not set(cursors) <= set(TYPE_TABLES.values()):
+        raise ValueError(f"Invalid cursor {token!r}")
+    return cursors
+
+
+async def clickhouse_get_notifications(selected_mac, selected_type, selected_time, cursor=None, limit=PAGE_SIZE):
+    tables = plan_tables(selected_type)
+    # У каждой таблицы своя позиция; таблицы, которых нет в курсоре, уже прочитаны до конца
+    cursors = {}
+    if cursor:
+        cursors = decode_cursors(cursor)
+        tables = [table for table in tables if table in cursors]
+    logger.info(f"Query plan for type {selected_type}: {tables}")
+    # Тип уже определяется таблицей, поэтому фильтр по notification_type не нужен
+    pages = await asyncio.gather(*(clickhouse_get_page(table, selected_mac, None, selected_time,
+                                                       cursors.get(table), limit)
+                                   for table in tables))
+
+    results = {table: [] for table in TYPE_TABLES.values()}
+    next_cursors = {}
+    for table, (rows, table_cursor) in zip(tables, pages):
+        results[table] = rows
+        if table_cursor:
+            next_cursors[table] = table_cursor
+    return results, encode_cursors(next_cursors) if next_cursors else None
+
+
+async def export_chunks(stream, chunk_size: int = EXPORT_CHUNK_SIZE):
+    # Ответ Clickhouse читается кусками в потоке, в памяти одновременно не больше одного куска
+    try:
+        while True:
+            chunk = await asyncio.to_thread(stream.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        stream.close()
+
+
+async def clickhouse_export(table_name, selected_mac, range_from: datetime | None, range_to: datetime | None,
+                            export_format: str):
+    logger.info(f"Exporting {table_name} as {export_format} for {selected_mac} from {range_from} to {range_to}")
+    global client
+    client = await init_client()
 
+    conditions = []
+    parameters = {}
+    if selected_mac and selected_mac != 'all':
+        conditions.append("mac = {mac:String}")
+        parameters["mac"] = selected_mac
+    if range_from:
+        conditions.append("time >= {range_from:DateTime}")
+        parameters["range_from"] = range_from
+    if range_to:
+        conditions.append("time <= {range_to:DateTime}")
+        parameters["range_to"] = range_to
+    sql_conditions = f"WHERE {' AND '.join(conditions)}" if conditions else ""
 
+    # Порядок совпадает с ключом сортировки таблиц, поэтому Clickhouse отдаёт строки по мере чтения без полной сортировки
     query = f'''
-            SELECT *
+            SELECT {', '.join(TABLE_COLUMNS[table_name])}
             FROM {table_name}
             {sql_conditions}
-            ORDER BY time DESC
+            ORDER BY mac, time
         '''
-    logger.info(f"query: {query}")
+    # Форматирование выполняет Clickhouse, сервис только передаёт байты клиенту
+    stream = await client.raw_stream(query, parameters=parameters, fmt=EXPORT_FORMATS[export_format][0],
+                                     settings={"optimize_read_in_order": 1})
+    return export_chunks(stream, EXPORT_CHUNK_SIZE)
 
-    result = await client.query(query)
-    logger.info(f"Got {message_name}")
 
-    return result.named_results()
+async def clickhouse_device_stats(selected_mac, range_from: datetime | None, range_to: datetime):
+    logger.info(f"Getting device stats for {selected_mac} from {range_from} to {range_to}")
+    global client
+    client = await init_client()
+
+    conditions = ["hour <= {range_to:DateTime}"]
+    parameters = {"range_to": range_to}
+    if range_from:
+        conditions.append("hour >= toStartOfHour({range_from:DateTime})")
+        parameters["range_from"] = range_from
+    if selected_mac and selected_mac != 'all':
+        conditions.append("mac = {mac:String}")
+        parameters["mac"] = selected_mac
+    sql_conditions = ' AND '.join(conditions)
+
+    # Части AggregatingMergeTree могут быть ещё не слиты, поэтому сначала схлопываем по (mac, hour)
+    life = await timed_query(client, 'intercom_life_hourly', f'''
+            SELECT mac, sum(heartbeats) AS heartbeats, sum(failures) AS failures,
+                   countIf(heartbeats > 0) AS online_hours, min(hour) AS first_hour, max(last_heartbeat) AS last_heartbeat
+            FROM (
+                SELECT mac, hour, sum(heartbeats) AS heartbeats, sum(failures) AS failures,
+                       max(last_heartbeat) AS last_heartbeat
+                FROM intercom_life_hourly
+                WHERE {sql_conditions}
+                GROUP BY mac, hour
+            )
+            GROUP BY mac
+        ''', parameters=parameters)
+    messages = await timed_query(client, 'intercom_events_hourly', f'''
+            SELECT mac, sum(events) AS events, sumIf(events, event = 'call-start') AS calls,
+                   sum(denied_keys) AS denied_keys
+            FROM intercom_events_hourly
+            WHERE {sql_conditions}
+            GROUP BY mac
+        ''', parameters=parameters)
+
+    devices = {}
+    for row in life.named_results():
+        first_hour = range_from.replace(minute=0, second=0, microsecond=0) if range_from else row["first_hour"]
+        hours = max(int((range_to - first_hour).total_seconds() // 3600) + 1, 1)
+        devices[row["mac"]] = {
+            "heartbeats": row["heartbeats"],
+            "failures": row["failures"],
+            "online_hours": row["online_hours"],
+            "uptime": min(row["online_hours"] / hours, 1.0),
+            "last_heartbeat": row["last_heartbeat"],
+            "events": 0, "calls": 0, "denied_keys": 0,
+        }
+    for row in messages.named_results():
+        device = devices.setdefault(row["mac"], {"heartbeats": 0, "failures": 0, "online_hours": 0, "uptime": 0.0,
+                                                 "last_heartbeat": None})
+        device.update(events=row["events"], calls=row["calls"], denied_keys=row["denied_keys"])
+
+    fleet = {field: sum(device[field] for device in devices.values())
+             for field in ("heartbeats", "failures", "events", "calls", "denied_keys")}
+    fleet["devices"] = len(devices)
+    fleet["uptime"] = sum(device["uptime"] for device in devices.values()) / len(devices) if devices else 0.0
+    logger.info(f"Got stats for {len(devices)} devices")
+    return {"fleet": fleet, "devices": devices}
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from aiomqtt import Client
+
+import acks
+import events
+import ingest
+import notifications
+import state
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPLICA_ID = os.environ.get("REPLICA_ID") or uuid.uuid4().hex
+TOUCH_INTERVAL = 1.0
+OUTBOX_SIZE = 10_000
+RECONNECT_DELAY = 1
+
+
+def state_topic(group: str) -> str:
+    return f"cluster/{group}/state"
+
+
+class MqttBackend(state.LocalBackend):
+    """Состояние в памяти каждой реплики, изменения рассылаются остальным через MQTT.
+
+    Топик состояния подписывается обычной (не общей) подпиской, поэтому каждое изменение
+    получают все реплики группы. Пульсы рассылаются пачкой раз в touch_interval.
+    """
+
+    def __init__(self, group: str, replica_id: str = REPLICA_ID, hostname: str = "mqtt",
+                 touch_interval: float = TOUCH_INTERVAL, client_factory=None):
+        self.topic = state_topic(group)
+        self.replica_id = replica_id
+        self.touch_interval = touch_interval
+        self.client_factory = client_factory or (lambda: Client(hostname))
+        self.outbox = None
+        self.touches = {}
+        self.stats = {"sent": 0, "received": 0, "dropped": 0, "errors": 0}
+
+    def _get_outbox(self):
+        if self.outbox is None:
+            self.outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        return self.outbox
+
+    def _send(self, op: str, data=None):
+        payload = json.dumps({"origin": self.replica_id, "op": op, "data": data}, default=str)
+        try:
+            self._get_outbox().put_nowait(payload)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning(f"Очередь репликации переполнена, изменение {op} не отправлено")
+
+    def put_device(self, device: state.DoorPhone):
+        super().put_device(device)
+        self._send("put", {"mac": device.mac, "config": device.to_dict()})
+
+    def set_status(self, mac: str, active: bool, error: bool):
+        super().set_status(mac, active, error)
+        self._send("status", {"mac": mac, "active": active, "error": error})
+
+    def remove_device(self, mac: str):
+        super().remove_device(mac)
+        self.touches.pop(mac, None)
+        self._send("remove", {"mac": mac})
+
+    def touch(self, mac: str, time: datetime):
+        super().touch(mac, time)
+        self.touches[mac] = time
+
+    def forget(self, mac: str):
+        super().forget(mac)
+        self.touches.pop(mac, None)
+        self._send("forget", {"mac": mac})
+
+    def start_call(self, mac: str, call: dict):
+        super().start_call(mac, call)
+        self._send("call-start", {"mac": mac, "call": call})
+
+    def end_call(self, mac: str):
+        super().end_call(mac)
+        self._send("call-end", {"mac": mac})
+
+    def command_sent(self, mac: str, command_id: str, event: str):
+        self._send("command", {"mac": mac, "command_id": command_id, "event": event})
+
+    def command_resolved(self, mac: str, command_id: str, status: str | None):
+        # status None: команда отменена до отправки
+        self._send("command-ack", {"mac": mac, "command_id": command_id, "status": status})
+
+    def flush_touches(self):
+        if not self.touches:
+            return
+        touches, self.touches = self.touches, {}
+        self._send("touch", {mac: time.isoformat() for mac, time in touches.items()})
+
+    def dump(self) -> dict:
+        return {"door_phones": state.door_phones.to_dict(), "current_calls": state.current_calls,
+                "last_seen": {mac: time.isoformat() for mac, time in state.last_seen.items()}}
+
+    def _apply_touch(self, macs: dict):
+        for mac, time in macs.items():
+            time = datetime.fromisoformat(time)
+            if mac in state.last_seen and state.last_seen[mac] >= time:
+                continue
+            super().touch(mac, time)
+            notifications.release(mac)
+
+    def apply(self, payload):
+        message = json.loads(payload)
+        if message["origin"] == self.replica_id:
+            return
+        self.stats["received"] += 1
+        op, data = message["op"], message["data"]
+
+        # Изменения от других реплик применяются без повторной рассылки
+        if op == "put":
+            config = data["config"]
+            super().put_device(state.DoorPhone(data["mac"], config, config["active"], config["error"]))
+            state._publish_door_phone(data["mac"])
+        elif op == "status":
+            if data["mac"] in state.door_phones:
+                super().set_status(data["mac"], data["active"], data["error"])
+                state._publish_door_phone(data["mac"])
+        elif op == "remove":
+            super().remove_device(data["mac"])
+            events.publish("doorphones", "remove", {"mac": data["mac"]})
+        elif op == "touch":
+            self._apply_touch(data)
+        elif op == "forget":
+            super().forget(data["mac"])
+        elif op == "call-start":
+            super().start_call(data["mac"], data["call"])
+            events.publish("calls", "call-start", {"mac": data["mac"], "call": data["call"]})
+        elif op == "call-end":
+            super().end_call(data["mac"])
+            events.publish("calls", "call-end", {"mac": data["mac"]})
+        elif op == "command":
+            # Ответ домофона может прийти на эту реплику через общую подписку
+            acks.tracker.add_remote(data["mac"], data["command_id"], data["event"])
+        elif op == "command-ack":
+            acks.tracker.resolve_remote(data["mac"], data["command_id"], data["status"])
+        elif op == "hello":
+            # Новая реплика просит текущее состояние
+            self._send("sync", self.dump())
+        elif op == "sync":
+            for mac, config in data["door_phones"].items():
+                if mac not in state.door_phones:
+                    super().put_device(state.DoorPhone(mac, config, config["active"], config["error"]))
+            for mac, call in data["current_calls"].items():
+                state.current_calls.setdefault(mac, call)
+            self._apply_touch(data["last_seen"])
+        else:
+            logger.warning(f"Неизвестная операция репликации {op}")
+
+    async def _receive(self, client):
+        async for message in client.messages:
+            try:
+                self.apply(message.payload)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка при применении изменения состояния: {e}")
+
+    async def _publish(self, client, outbox: asyncio.Queue):
+        while True:
+            payload = await outbox.get()
+            try:
+                await client.publish(self.topic, payload=payload, qos=1)
+            except BaseException:
+                try:
+                    outbox.put_nowait(payload)
+                except asyncio.QueueFull:
+                    self.stats["dropped"] += 1
+                raise
+            self.stats["sent"] += 1
+
+    async def _flush_touches(self):
+        while True:
+            await asyncio.sleep(self.touch_interval)
+            self.flush_touches()
+
+    async def run(self):
+        outbox = self._get_outbox()
+        while True:
+            try:
+                async with self.client_factory() as client:
+                    await client.subscribe(self.topic, qos=1)
+                    logger.info(f"Replica {self.replica_id} joined {self.topic}")
+                    self._send("hello")
+                    async with asyncio.TaskGroup() as group:
+                        group.create_task(self._receive(client))
+                        group.create_task(self._publish(client, outbox))
+                        group.create_task(self._flush_touches())
+            except* Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка репликации состояния через MQTT: {e.exceptions[0]}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+def enabled() -> bool:
+    return ingest.SHARE_GROUP is not None
+
+
+def configure() -> MqttBackend:
+    backend = MqttBackend(ingest.SHARE_GROUP)
+    state.backend = backend
+    return backend
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+import acks
+import state
+from clickhouse import clickhouse_insert_command_batch
+from publisher import publisher
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BULK_EVENTS = ("open-door", "call-response")
+BULK_MAX_TARGETS = 1000
+
+command_router = APIRouter()
+
+
+class BulkCommand(BaseModel):
+    event: str = "open-door"
+    macs: list[str] = []
+    location: str | None = None
+    apartment: str | None = None
+
+
+def resolve_targets(command: BulkCommand) -> list:
+    # Цели объединяются: явный список mac, все домофоны адреса и все домофоны квартиры
+    targets = set(command.macs)
+    if command.location is not None:
+        targets |= state.door_phones.find_by_location(command.location)
+    if command.apartment is not None:
+        targets |= state.door_phones.find_by_apartment(command.apartment)
+    return sorted(targets)
+
+
+async def send_command(time: str, mac: str, event: str) -> dict:
+    if mac not in state.door_phones:
+        return {"status": "fail", "error": "Домофон не найден"}
+    command_id = acks.tracker.new_command(mac, event)
+    try:
+        await publisher.publish(f'intercom/{mac}/management',
+                                payload=json.dumps({"time": time,
+                                                    "event": event,
+                                                    "status": "success",
+                                                    "command_id": command_id}),
+                                qos=1)
+    except Exception as e:
+        acks.tracker.cancel(mac, command_id)
+        logger.error(f"Не удалось отправить {event} на {mac}: {e!r}")
+        return {"status": "fail", "error": repr(e)}
+    return {"status": "success", "command_id": command_id}
+
+
+@command_router.post("/api/commands/bulk")
+async def bulk_command(command: BulkCommand):
+    if command.event not in BULK_EVENTS:
+        raise HTTPException(status_code=400, detail=f"Неизвестная команда {command.event}")
+    targets = resolve_targets(command)
+    if not targets:
+        raise HTTPException(status_code=404, detail="Не найдено ни одного домофона")
+    if len(targets) > BULK_MAX_TARGETS:
+        raise HTTPException(status_code=400, detail=f"Больше {BULK_MAX_TARGETS} домофонов в одной команде")
+
+    time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Все публикации идут параллельно через общее соединение публикатора
+    outcomes = await asyncio.gather(*(send_command(time, mac, command.event) for mac in targets))
+    results = dict(zip(targets, outcomes))
+
+    try:
+        await clickhouse_insert_command_batch([(time, mac, command.event, result["status"])
+                                               for mac, result in results.items()])
+    except Exception as e:
+        logger.error(f"Ошибка при записи массовой команды в Clickhouse: {e}")
+
+    succeeded = sum(result["status"] == "success" for result in results.values())
+    logger.info(f"Bulk {command.event}: {succeeded}/{len(targets)} door phones")
+    return {"event": command.event, "time": time, "total": len(targets), "succeeded": succeeded,
+            "failed": len(targets) - succeeded, "results": results}
+
+
+@command_router.get("/api/commands/acks")
+async def command_acks():
+    return {"stats": acks.tracker.stats, "pending": len(acks.tracker.pending),
+            "latency": acks.tracker.latency_stats()}
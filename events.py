@@ -0,0 +1,60 @@
+import asyncio
+import json
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_INTERVAL = 15
+
+# Канал ('doorphones', 'calls') -> очереди подключённых дашбордов
+subscribers = {}
+
+
+def format_event(kind: str, data) -> str:
+    return f"event: {kind}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def subscribe(channel: str) -> asyncio.Queue:
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    subscribers.setdefault(channel, set()).add(queue)
+    return queue
+
+
+def unsubscribe(channel: str, queue: asyncio.Queue):
+    subscribers.get(channel, set()).discard(queue)
+
+
+def publish(channel: str, kind: str, data):
+    queues = subscribers.get(channel)
+    if not queues:
+        return
+    event = format_event(kind, data)
+    for queue in list(queues):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: закрываем поток, браузер переподключится и получит свежий снимок
+            logger.warning(f"Подписчик канала {channel} не успевает, соединение закрыто")
+            queues.discard(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+async def stream(channel: str, snapshot, keepalive: float = KEEPALIVE_INTERVAL):
+    queue = subscribe(channel)
+    try:
+        yield format_event("snapshot", snapshot())
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield event
+    finally:
+        unsubscribe(channel, queue)
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import os
+import zlib
+from collections import deque
+from time import monotonic
+
+from aiomqtt import Client, ProtocolVersion
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1
+INGEST_WORKERS = 8
+INGEST_QUEUE_SIZE = 1000
+# 'block' — приём из MQTT ждёт, пока освободится место в очереди; 'drop' — новое сообщение отбрасывается;
+# 'drop-oldest' — отбрасывается самое старое сообщение очереди
+OVERFLOW_POLICIES = ("block", "drop", "drop-oldest")
+OVERFLOW_POLICY = os.environ.get("INGEST_OVERFLOW", "block")
+# Очередь пульсов не должна останавливать приём: иначе вызовы за ними в сокете ждут, пока она разгрузится
+LOW_OVERFLOW_POLICY = os.environ.get("INGEST_LOW_OVERFLOW", "drop-oldest")
+
+LATENCY_SAMPLES = 1000
+# Имя группы общей подписки MQTT v5: реплики одной группы делят между собой поток сообщений.
+# Без него сервис работает одним экземпляром и получает все сообщения
+SHARE_GROUP = os.environ.get("CLUSTER_GROUP") or None
+
+# Классы приоритета: меньшее значение обрабатывается раньше
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+MESSAGES = metrics.Counter("mqtt_messages_received_total", "MQTT messages received by topic kind", ["kind"])
+PARSE_FAILURES = metrics.Counter("mqtt_parse_failures_total", "MQTT payloads that are not valid JSON", ["kind"])
+HANDLER_SECONDS = metrics.Histogram("ingest_handler_seconds", "Handler run time by topic kind", ["kind"])
+RECONNECTS = metrics.Counter("mqtt_ingest_reconnects_total", "Reconnects of the ingest MQTT connection")
+
+# Тип сообщения (последний уровень топика intercom/<mac>/<kind>) -> обработчик
+handlers = {}
+# Тип сообщения -> класс приоритета
+priorities = {}
+
+
+def register_handler(kind: str, handler, priority: int = NORMAL):
+    handlers[kind] = handler
+    priorities[kind] = priority
+
+
+def percentile(values, q: float):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def subscription_topics():
+    prefix = f"$share/{SHARE_GROUP}/" if SHARE_GROUP else ""
+    return [f"{prefix}intercom/+/{kind}" for kind in handlers]
+
+
+def connect(hostname: str = "mqtt") -> Client:
+    # Общие подписки есть только в MQTT v5
+    if SHARE_GROUP:
+        return Client(hostname, protocol=ProtocolVersion.V5)
+    return Client(hostname)
+
+
+async def dispatch(message):
+    parts = message.topic.value.split("/")
+    if len(parts) != 3:
+        logger.warning(f"Неизвестный топик {message.topic}")
+        return
+    handler = handlers.get(parts[2])
+    if handler is None:
+        logger.warning(f"Нет обработчика для топика {message.topic}")
+        return
+
+    try:
+        payload = json.loads(message.payload)
+    except ValueError:
+        PARSE_FAILURES.inc(parts[2])
+        raise
+    logger.info("New MQTT message: topic=%s, payload=%s", message.topic, payload,
+                extra={"mac": parts[1], "kind": parts[2]})
+    started = monotonic()
+    try:
+        await handler(parts[1], payload)
+    finally:
+        HANDLER_SECONDS.observe(monotonic() - started, parts[2])
+
+
+class Shard:
+    def __init__(self, queue_size: int):
+        # Отдельная очередь на каждый класс: поток пульсов не занимает место событий вызова
+        self.lanes = [asyncio.Queue(maxsize=queue_size) for _ in PRIORITY_NAMES]
+        self.ready = asyncio.Semaphore(0)
+
+    async def get(self):
+        await self.ready.acquire()
+        for lane in self.lanes:
+            if not lane.empty():
+                return lane, lane.get_nowait()
+
+
+class IngestQueue:
+    def __init__(self, workers: int = INGEST_WORKERS, queue_size: int = INGEST_QUEUE_SIZE,
+                 policy: str = OVERFLOW_POLICY, low_policy: str = LOW_OVERFLOW_POLICY):
+        for name in (policy, low_policy):
+            if name not in OVERFLOW_POLICIES:
+                raise ValueError(f"Unknown overflow policy {name}")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        # Класс -> поведение при переполнении его очереди
+        self.policies = {HIGH: policy, NORMAL: policy, LOW: low_policy}
+        self.shards = None
+        self.stats = {"received": 0, "processed": 0, "dropped": 0, "blocked": 0, "errors": 0}
+        # Класс -> время от приёма до конца обработки по последним сообщениям
+        self.latencies = {priority: deque(maxlen=LATENCY_SAMPLES) for priority in PRIORITY_NAMES}
+
+    def _get_shards(self):
+        if self.shards is None:
+            self.shards = [Shard(self.queue_size) for _ in range(self.workers)]
+        return self.shards
+
+    def shard(self, mac: str) -> int:
+        # Сообщения одного домофона одного класса обрабатывает один воркер, поэтому их порядок сохраняется.
+        # Между классами порядок не гарантируется: вызов обгоняет ожидающие пульсы
+        return zlib.crc32(mac.encode()) % self.workers
+
+    async def put(self, message):
+        parts = message.topic.value.split("/")
+        if len(parts) != 3:
+            logger.warning(f"Неизвестный топик {message.topic}")
+            return
+        shard = self._get_shards()[self.shard(parts[1])]
+        priority = priorities.get(parts[2], NORMAL)
+        lane = shard.lanes[priority]
+        item = (message, priority, monotonic())
+        self.stats["received"] += 1
+        MESSAGES.inc(parts[2])
+        policy = self.policies[priority]
+        if policy == "drop":
+            try:
+                lane.put_nowait(item)
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1
+                logger.warning(f"Очередь обработки переполнена, сообщение {message.topic} отброшено")
+                return
+        elif policy == "drop-oldest":
+            if lane.full():
+                dropped = lane.get_nowait()
+                lane.task_done()
+                lane.put_nowait(item)
+                self.stats["dropped"] += 1
+                logger.warning(f"Очередь обработки переполнена, сообщение {dropped[0].topic} отброшено")
+                # Новое сообщение заняло место отброшенного, счётчик готовых сообщений не меняется
+                return
+            lane.put_nowait(item)
+        else:
+            if lane.full():
+                self.stats["blocked"] += 1
+            await lane.put(item)
+        shard.ready.release()
+
+    async def _worker(self, shard: Shard):
+        while True:
+            lane, (message, priority, received) = await shard.get()
+            try:
+                await dispatch(message)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка при обработке MQTT-сообщения: {e}")
+            finally:
+                self.latencies[priority].append(monotonic() - received)
+                lane.task_done()
+
+    async def join(self):
+        for shard in self._get_shards():
+            for lane in shard.lanes:
+                await lane.join()
+
+    def depth(self):
+        return {name: sum(shard.lanes[priority].qsize() for shard in self._get_shards())
+                for priority, name in PRIORITY_NAMES.items()}
+
+    def latency_stats(self):
+        return {name: {"p50": percentile(self.latencies[priority], 0.5),
+                       "p95": percentile(self.latencies[priority], 0.95),
+                       "p99": percentile(self.latencies[priority], 0.99),
+                       "count": len(self.latencies[priority])}
+                for priority, name in PRIORITY_NAMES.items()}
+
+    async def run(self):
+        await asyncio.gather(*(self._worker(shard) for shard in self._get_shards()))
+
+
+ingest_queue = IngestQueue()
+
+QUEUE_DEPTH = metrics.Gauge("ingest_queue_depth", "Messages waiting for a worker by priority class", ["priority"],
+                            function=lambda: ingest_queue.depth())
+DROPPED = metrics.Counter("ingest_dropped_total", "Messages dropped because the ingest queue was full",
+                          function=lambda: ingest_queue.stats["dropped"])
+
+
+async def listen():
+    logger.info(f"Listening for {', '.join(handlers)}")
+    # Воркеры переживают переподключения: очередь не теряется при обрыве связи с брокером
+    workers = asyncio.create_task(ingest_queue.run())
+    try:
+        await receive()
+    finally:
+        workers.cancel()
+
+
+async def receive():
+    while True:
+        try:
+            async with connect() as client:
+                await client.subscribe([(topic, 0) for topic in subscription_topics()])
+                logger.info("Connected to MQTT broker")
+
+                async for message in client.messages:
+                    await ingest_queue.put(message)
+        except Exception as e:
+            logger.error(f"Ошибка при подписке на MQTT: {e}")
+        RECONNECTS.inc()
+        await asyncio.sleep(RECONNECT_DELAY)
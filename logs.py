@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = 10_000
+# Тип сообщения -> не чаще одной записи INFO/DEBUG на домофон за столько секунд
+RATE_LIMITS = {"life": float(os.environ.get("LOG_HEARTBEAT_INTERVAL", 60))}
+# Тип сообщения -> доля записей, пропускаемых сверх лимита (выборка)
+SAMPLE_RATES = {"life": float(os.environ.get("LOG_HEARTBEAT_SAMPLE", 0))}
+
+# Аргументы этих типов не меняются, пока запись ждёт в очереди, поэтому форматирование можно отложить
+IMMUTABLE_ARGS = (str, int, float, bool, bytes, type(None), datetime)
+
+# Поля, передаваемые через extra=, которые попадают в структурированную запись
+FIELDS = ("mac", "kind", "topic", "table", "event", "transition", "suppressed")
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает поток INFO/DEBUG записей о пульсах.
+
+    Ошибки, предупреждения и записи с extra={"transition": True} пропускаются всегда.
+    Пропущенная запись несёт число подавленных перед ней в поле suppressed.
+    """
+
+    def __init__(self, rate_limits=None, sample_rates=None):
+        super().__init__()
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        self.sample_rates = SAMPLE_RATES if sample_rates is None else sample_rates
+        # (тип, mac) -> [время последней пропущенной записи, подавлено с тех пор]
+        self.windows = {}
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or getattr(record, "transition", False):
+            return True
+        kind = getattr(record, "kind", None)
+        interval = self.rate_limits.get(kind)
+        if interval is None:
+            return True
+
+        key = (kind, getattr(record, "mac", None))
+        now = monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= interval or random.random() < self.sample_rates.get(kind, 0):
+            record.suppressed = window[1] if window else 0
+            self.windows[key] = [now, 0]
+            return True
+        window[1] += 1
+        self.suppressed += 1
+        return False
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Стандартный QueueHandler форматирует сообщение в вызывающем потоке, то есть в цикле событий.
+        # Здесь запись уходит в очередь как есть, а форматирует её поток QueueListener.
+        # Изменяемые аргументы (словари состояния) подставляются сразу: к моменту вывода они могут измениться
+        args = record.args
+        if args:
+            values = args.values() if isinstance(args, dict) else args
+            if not all(isinstance(value, IMMUTABLE_ARGS) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Лучше потерять строку лога, чем остановить цикл событий
+            pass
+
+
+class LoggingPipeline:
+    def __init__(self, listener: QueueListener, handler: QueueHandler, previous: list, level: int):
+        self.listener = listener
+        self.handler = handler
+        self.previous = previous
+        self.level = level
+
+    def stop(self):
+        root = logging.getLogger()
+        self.listener.stop()
+        root.removeHandler(self.handler)
+        for handler in self.previous:
+            root.addHandler(handler)
+        root.setLevel(self.level)
+
+
+def setup_logging(level: int = logging.INFO, stream=None) -> LoggingPipeline:
+    root = logging.getLogger()
+    previous = list(root.handlers)
+    previous_level = root.level
+    for handler in previous:
+        root.removeHandler(handler)
+
+    output = logging.StreamHandler(stream)
+    if LOG_FORMAT == "json":
+        output.setFormatter(StructuredFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return LoggingPipeline(listener, handler, previous, previous_level)
@@ -1,92 +1,150 @@
 import uvicorn
 from fastapi import FastAPI, Request, Path, HTTPException
-from starlette.responses import RedirectResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import PlainTextResponse, RedirectResponse, StreamingResponse, Response
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
 from contextlib import asynccontextmanager
+from time import monotonic
 import asyncio
-from aiomqtt import Client
+import hashlib
+from publisher import publisher
 
 import json
 
+import events
 import state
 from state import add_or_update, remove
 import logging
 
-from clickhouse import clickhouse_tables, json_config_to_clickhouse, clickhouse_get, clickhouse_insert_commands
-from notifications import listen_for_notifications, get_life
+from clickhouse import (json_config_to_clickhouse, clickhouse_get_notifications,
+                        clickhouse_insert_commands, clickhouse_device_stats, time_from, run_buffers,
+                        flush_buffers, buffer_stats, cache_stats, clickhouse_export, plan_tables, EXPORT_FORMATS,
+                        PAGE_SIZE, VIEW_COLUMNS, CACHE_TTL)
+from notifications import check_life_status, set_life_timeout, run_life_summaries, flush_life_summaries
+import ingest
+from migrations import migrate
+import snapshot
+import cluster
+import metrics
+import logs
 
 from datetime import datetime
 
+import acks
 import call
+import commands
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PAGE_MAX_SIZE = 500
+GZIP_MIN_SIZE = 1000
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await clickhouse_tables()
-    task_check = asyncio.create_task(listen_for_configs())
-    task_life = asyncio.create_task(get_life())
-    task_listen_messages = asyncio.create_task(listen_for_notifications())
+    # Запись логов уходит в отдельный поток, цикл событий только кладёт записи в очередь
+    logging_pipeline = logs.setup_logging()
+    # Дашборд сразу показывает парк из снимка, не дожидаясь повторной рассылки retained-конфигураций
+    await snapshot.restore()
+    # В кластерном режиме реплики делят поток MQTT и обмениваются изменениями состояния
+    task_cluster = asyncio.create_task(cluster.configure().run()) if cluster.enabled() else None
+    task_migrate = asyncio.create_task(migrate())
+    task_buffers = asyncio.create_task(run_buffers())
+    task_publisher = asyncio.create_task(publisher.run())
+    task_ingest = asyncio.create_task(ingest.listen())
+    task_check_life = asyncio.create_task(check_life_status())
+    task_life_summaries = asyncio.create_task(run_life_summaries())
+    task_snapshots = asyncio.create_task(snapshot.run_snapshots())
+    task_loop_lag = asyncio.create_task(metrics.monitor_event_loop())
+    task_acks = asyncio.create_task(acks.tracker.run())
     yield
-    task_check.cancel()
-    task_life.cancel()
-    task_listen_messages.cancel()
+    task_acks.cancel()
+    task_loop_lag.cancel()
+    task_snapshots.cancel()
+    if task_cluster is not None:
+        task_cluster.cancel()
+    task_migrate.cancel()
+    task_ingest.cancel()
+    task_check_life.cancel()
+    task_life_summaries.cancel()
+    task_publisher.cancel()
+    task_buffers.cancel()
+    try:
+        await task_buffers
+    except asyncio.CancelledError:
+        pass
+    try:
+        await snapshot.save()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении снимка состояния: {e}")
+    try:
+        # Недописанная сводка пульсов попадает в буфер до его последнего сброса
+        await flush_life_summaries()
+    except Exception as e:
+        logger.error(f"Ошибка при записи сводки пульсов: {e}")
+    try:
+        await flush_buffers()
+    except Exception as e:
+        logger.error(f"Ошибка при записи буферов в Clickhouse: {e}")
+    logging_pipeline.stop()
 
 
-async def listen_for_configs():
-    logger.info('Listening for configs')
-    while True:
-        try:
-            async with Client("mqtt") as client:
-                await client.subscribe("intercom/+/config")
-                logger.info("Connected to MQTT broker")
-
-                async for message in client.messages:
-                    try:
-                        my_topic = message.topic
-                        my_payload = json.loads(message.payload)
-                        logger.info(f"New MQTT message: topic={message.topic}, payload={my_payload}")
-
-                        if my_payload != "":
-
-                            mac = str(my_topic).split("/")[1]
-                            reconnect = False
-
-                            event = my_payload.get("event")
-                            if event == "added" or event == "modified":
-                                config = my_payload.get("new_config")
-                                logger.info(f"[CONFIG] {config}")
-                                new_or_reconnect = await add_or_update(mac, config)
-                                if new_or_reconnect == 'new/mod':
-                                    logger.info(f"[{event.upper()}] {mac} добавлен/обновлён")
-                                else:
-                                    logger.info(f"[CONNECT] {mac} подключение восстановлено")
-                                    reconnect = True
-                            else:
-                                old_config = my_payload.get("old_config")
-                                await remove(mac, old_config)
-                                logger.info(f"[REMOVED] {mac} удалён")
-                            await json_config_to_clickhouse(mac, my_payload, reconnect)
-                            logger.info(f"json sent")
-                    except Exception as e:
-                        logger.error(f"Ошибка при обработке MQTT-сообщения: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка при подписке на MQTT: {e}")
+async def handle_config(mac: str, payload):
+    if payload != "":
+        reconnect = False
+
+        event = payload.get("event")
+        if event == "added" or event == "modified":
+            config = payload.get("new_config")
+            logger.info("[CONFIG] %s", config, extra={"mac": mac, "kind": "config"})
+            new_or_reconnect = await add_or_update(mac, config)
+            if config.get("life_timeout"):
+                set_life_timeout(mac, config["life_timeout"])
+            if new_or_reconnect == 'new/mod':
+                logger.info("[%s] %s добавлен/обновлён", event.upper(), mac, extra={"mac": mac, "transition": True})
+            else:
+                logger.info("[CONNECT] %s подключение восстановлено", mac, extra={"mac": mac, "transition": True})
+                reconnect = True
+        else:
+            old_config = payload.get("old_config")
+            await remove(mac, old_config)
+            logger.info("[REMOVED] %s удалён", mac, extra={"mac": mac, "transition": True})
+        await json_config_to_clickhouse(mac, payload, reconnect)
+        logger.debug("json sent", extra={"mac": mac, "kind": "config"})
+
+
+ingest.register_handler("config", handle_config, ingest.NORMAL)
 
 
 app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
+# Потоки событий (text/event-stream) GZipMiddleware не сжимает
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
 app.include_router(call.call_router)
+app.include_router(commands.command_router)
+
+HTTP_SECONDS = metrics.Histogram("http_request_seconds", "HTTP request latency by route",
+                                 ["method", "route", "status"])
+
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    started = monotonic()
+    response = await call_next(request)
+    # Шаблон пути, а не сам путь: mac в URL не должен размножать серии
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(monotonic() - started, request.method, route.path if route else "unmatched",
+                         response.status_code)
+    return response
 
 
 @app.get("/")
 async def main(request: Request):
-    logger.info(f"{state.door_phones}")
+    logger.info(f"{len(state.door_phones)} door phones, {len(state.door_phones.active)} active")
     return templates.TemplateResponse(
         request, "main.html", {"door_phones": state.door_phones}
     )
@@ -97,24 +155,85 @@ async def main(request: Request):
     selected_mac = request.query_params.get("mac", "all")
     selected_type = request.query_params.get("type", "config")
     selected_time = request.query_params.get("time", "all")
-    logger.info(f"selected_mac={selected_mac}, selected_type={selected_type}, selected_time={selected_time}")
-    configs = await clickhouse_get('intercom_configs', 'configs',
-                                   selected_mac, selected_type, selected_time)
-    messages = await clickhouse_get('intercom_messages', 'messages',
-                                    selected_mac, selected_type, selected_time)
-    life = await clickhouse_get('intercom_life', 'life',
-                                selected_mac, selected_type, selected_time)
-    management_commands = await clickhouse_get('management_commands', 'commands',
-                                               selected_mac, selected_type, selected_time)
+    # Страница отдаётся без строк, их подгружает скрипт страницы из /api/notifications/page
     return templates.TemplateResponse(
-        request, "notifications.html", {"configs": configs, "messages": messages,
-                                        "life": life, "commands": management_commands,
-                                        "door_phones": state.door_phones,
+        request, "notifications.html", {"door_phones": state.door_phones,
                                         "selected_mac": selected_mac, "selected_type": selected_type,
                                         "selected_time": selected_time}
     )
 
 
+@app.get("/api/notifications/page")
+async def notifications_page(request: Request):
+    selected_mac = request.query_params.get("mac", "all")
+    selected_type = request.query_params.get("type", "config")
+    selected_time = request.query_params.get("time", "all")
+    cursor = request.query_params.get("cursor")
+    logger.info(f"selected_mac={selected_mac}, selected_type={selected_type}, selected_time={selected_time}")
+    try:
+        limit = min(max(int(request.query_params.get("limit", PAGE_SIZE)), 1), PAGE_MAX_SIZE)
+        results, next_cursor = await clickhouse_get_notifications(selected_mac, selected_type, selected_time, cursor,
+                                                                  limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Строки передаются массивами значений, имена колонок один раз на таблицу
+    tables = {table: {"columns": VIEW_COLUMNS[table],
+                      "rows": [[row.get(column) for column in VIEW_COLUMNS[table]] for row in rows]}
+              for table, rows in results.items() if rows}
+    body = json.dumps({"tables": tables, "next": next_cursor}, ensure_ascii=False, separators=(",", ":"),
+                      default=str)
+    headers = {"ETag": f'"{hashlib.sha1(body.encode()).hexdigest()}"',
+               "Cache-Control": f"private, max-age={int(CACHE_TTL)}"}
+    if headers["ETag"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/notifications/stats")
+async def notifications_stats(request: Request):
+    selected_mac = request.query_params.get("mac", "all")
+    selected_time = request.query_params.get("time", "24h")
+    try:
+        range_to = datetime.fromisoformat(request.query_params["to"]) if "to" in request.query_params \
+            else datetime.now()
+        if "from" in request.query_params:
+            range_from = datetime.fromisoformat(request.query_params["from"])
+        else:
+            range_from = time_from(selected_time)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    stats = await clickhouse_device_stats(selected_mac, range_from, range_to)
+    return {"from": range_from, "to": range_to, **stats}
+
+
+@app.get("/notifications/export")
+async def notifications_export(request: Request):
+    selected_mac = request.query_params.get("mac", "all")
+    selected_type = request.query_params.get("type", "config")
+    selected_time = request.query_params.get("time", "all")
+    export_format = request.query_params.get("format", "csv")
+    # Выгружается одна таблица: у типов уведомлений разные колонки
+    tables = plan_tables(selected_type) if selected_type else []
+    if len(tables) != 1:
+        raise HTTPException(status_code=400, detail=f"Неизвестный тип уведомлений {selected_type}")
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат {export_format}")
+    try:
+        range_to = datetime.fromisoformat(request.query_params["to"]) if "to" in request.query_params else None
+        if "from" in request.query_params:
+            range_from = datetime.fromisoformat(request.query_params["from"])
+        else:
+            range_from = time_from(selected_time)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    chunks = await clickhouse_export(tables[0], selected_mac, range_from, range_to, export_format)
+    _, media_type, extension = EXPORT_FORMATS[export_format]
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{tables[0]}.{extension}"'})
+
+
 @app.get("/calls")
 async def main(request: Request):
     return templates.TemplateResponse(
@@ -135,14 +254,19 @@ async def open_door(mac: str = Path(..., min_length=17, max_length=17)):
         time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         event = "open-door"
         status = "success"
-        async with Client("mqtt") as client:
-            await client.publish(f'intercom/{mac}/management',
-                                 payload=json.dumps({"time": time,
-                                                     "event": event,
-                                                     "status": status}),
-                                 qos=1)
-            await clickhouse_insert_commands(time, mac, event, status)
-            logger.info(f'Отправлен запрос на {mac} - Открыть дверь')
+        command_id = acks.tracker.new_command(mac, event)
+        try:
+            await publisher.publish(f'intercom/{mac}/management',
+                                    payload=json.dumps({"time": time,
+                                                        "event": event,
+                                                        "status": status,
+                                                        "command_id": command_id}),
+                                    qos=1)
+        except BaseException:
+            acks.tracker.cancel(mac, command_id)
+            raise
+        await clickhouse_insert_commands(time, mac, event, status)
+        logger.info(f'Отправлен запрос на {mac} - Открыть дверь')
     except Exception as e:
         logger.error(e)
     return RedirectResponse(f"/doorphones/{mac}/", status_code=303)
@@ -157,18 +281,46 @@ async def delete_old_intercom(mac: str = Path(..., min_length=17, max_length=17)
 
     state.full_remove(mac)
     logger.info(f"Данные об {mac} удалены из управляющего сервиса")
-    async with Client("mqtt") as client:
-        await client.publish(f'intercom/{mac}/config',
-                             payload=json.dumps(""), qos=1, retain=True)
-        logger.info(f"Обнуление mqtt для {mac}")
+    try:
+        await publisher.publish(f'intercom/{mac}/config',
+                                payload=json.dumps(""), qos=1, retain=True)
+    except Exception as e:
+        logger.error(f"Не удалось обнулить mqtt для {mac}: {e}")
+        await clickhouse_insert_commands(time, mac, "mac-info-delete", "fail")
+        raise HTTPException(status_code=503, detail="MQTT недоступен")
+    logger.info(f"Обнуление mqtt для {mac}")
     await clickhouse_insert_commands(time, mac, "mac-info-delete", "success")
     return RedirectResponse(f"/", status_code=303)
 
 
 @app.get('/api/doorphones/data')
 async def doorphones_data():
-    return state.door_phones
+    return state.door_phones.to_dict()
+
+
+@app.get('/api/doorphones/events')
+async def doorphones_events():
+    return StreamingResponse(events.stream("doorphones", lambda: state.door_phones.to_dict()),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get('/api/clickhouse/stats')
+async def clickhouse_stats():
+    return {"buffers": buffer_stats(), "cache": cache_stats()}
+
+
+@app.get('/api/mqtt/stats')
+async def mqtt_stats():
+    return {"publisher": {**publisher.stats, "connected": publisher.connected},
+            "ingest": {**ingest.ingest_queue.stats, "depth": ingest.ingest_queue.depth(),
+                       "policy": {ingest.PRIORITY_NAMES[priority]: policy
+                                  for priority, policy in ingest.ingest_queue.policies.items()}, "latency": ingest.ingest_queue.latency_stats()}}
+
 
+@app.get('/metrics')
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import asyncio
+from bisect import bisect_left
+from time import monotonic
+
+# Все метрики процесса в порядке объявления; /metrics выводит их в текстовом формате Prometheus
+registry = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 1.0
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Значения, которые уже считаются в другом месте (stats-словари, размеры структур), читаются при выгрузке
+        self.function = function
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        if self.function is None:
+            return self.values.items()
+        value = self.function()
+        if isinstance(value, dict):
+            return [(labels if isinstance(labels, tuple) else (labels,), v) for labels, v in value.items()]
+        return [((), value)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # Счётчики корзин хранятся не накопительно: на запись одно сложение, суммирование при выгрузке
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = f'le="{format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+LOOP_LAG = Gauge("event_loop_lag_seconds", "Delay of the last event loop wakeup behind schedule")
+LOOP_LAG_HISTOGRAM = Histogram("event_loop_lag_histogram_seconds", "Event loop wakeup delays")
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL):
+    while True:
+        started = monotonic()
+        await asyncio.sleep(interval)
+        lag = max(monotonic() - started - interval, 0.0)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_HISTOGRAM.observe(lag)
@@ -0,0 +1,282 @@
+import asyncio
+import logging
+from datetime import datetime
+
+import clickhouse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# (версия, название, функция); применяются по возрастанию версии ровно один раз
+MIGRATIONS = []
+MIGRATION_RETRY_DELAY = 1.0
+MIGRATION_MAX_DELAY = 30.0
+
+
+def migration(version: int, name: str):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+# Колонки таблиц на момент миграции 2: последующие миграции добавляют колонки в TABLE_COLUMNS,
+# а перестройка должна копировать только те, что уже были
+V2_COLUMNS = {
+    'intercom_configs': ['notification_type', 'time', 'mac', 'event', 'new_config', 'old_config'],
+    'intercom_messages': ['notification_type', 'time', 'mac', 'event', 'status', 'door_status', 'reason', 'key',
+                          'result', 'apartment', 'location'],
+    'intercom_life': ['notification_type', 'time', 'mac', 'status'],
+    'management_commands': ['notification_type', 'time', 'mac', 'event', 'status'],
+}
+
+
+async def rebuild_table(client, table: str, columns_sql: str, engine_sql: str, column_names: list):
+    # Ключ сортировки и партиционирование нельзя изменить через ALTER, поэтому таблица
+    # пересоздаётся рядом и подменяется через EXCHANGE. Каждый шаг можно безопасно повторить
+    new_table = f"{table}_new"
+    columns = ', '.join(column_names)
+    await client.command(f"DROP TABLE IF EXISTS {new_table}")
+    await client.command(f"CREATE TABLE {new_table} ({columns_sql}) {engine_sql}")
+    await client.command(f"INSERT INTO {new_table} ({columns}) SELECT {columns} FROM {table}")
+    await client.command(f"EXCHANGE TABLES {table} AND {new_table}")
+    await client.command(f"DROP TABLE IF EXISTS {new_table}")
+    logger.info(f"Table {table} rebuilt")
+
+
+@migration(1, "initial tables")
+async def initial_tables(client):
+    await clickhouse.clickhouse_tables()
+
+
+@migration(2, "mac-first sort key, monthly partitions, low cardinality, codecs, ttl")
+async def sorted_tables(client):
+    await rebuild_table(client, 'intercom_configs', '''
+        notification_type LowCardinality(String),
+        time DateTime CODEC(DoubleDelta, ZSTD(1)),
+        mac LowCardinality(String),
+        event LowCardinality(String),
+        new_config Nullable(String) CODEC(ZSTD(3)),
+        old_config Nullable(String) CODEC(ZSTD(3))
+    ''', '''
+        ENGINE = MergeTree()
+        PARTITION BY toYYYYMM(time)
+        ORDER BY (mac, time)
+        TTL time + INTERVAL 3 YEAR
+    ''', V2_COLUMNS['intercom_configs'])
+
+    await rebuild_table(client, 'intercom_messages', '''
+        notification_type LowCardinality(String),
+        time DateTime CODEC(DoubleDelta, ZSTD(1)),
+        mac LowCardinality(String),
+        event LowCardinality(String),
+        status LowCardinality(String),
+        door_status LowCardinality(String),
+        reason LowCardinality(Nullable(String)),
+        key Nullable(String),
+        result LowCardinality(Nullable(String)),
+        apartment LowCardinality(Nullable(String)),
+        location LowCardinality(Nullable(String))
+    ''', '''
+        ENGINE = MergeTree()
+        PARTITION BY toYYYYMM(time)
+        ORDER BY (mac, time)
+        TTL time + INTERVAL 1 YEAR
+    ''', V2_COLUMNS['intercom_messages'])
+
+    await rebuild_table(client, 'intercom_life', '''
+        notification_type LowCardinality(String),
+        time DateTime CODEC(DoubleDelta, ZSTD(1)),
+        mac LowCardinality(String),
+        status LowCardinality(String)
+    ''', '''
+        ENGINE = MergeTree()
+        PARTITION BY toYYYYMM(time)
+        ORDER BY (mac, time)
+        TTL time + INTERVAL 90 DAY
+    ''', V2_COLUMNS['intercom_life'])
+
+    await rebuild_table(client, 'management_commands', '''
+        notification_type LowCardinality(String),
+        time DateTime CODEC(DoubleDelta, ZSTD(1)),
+        mac LowCardinality(String),
+        event LowCardinality(String),
+        status LowCardinality(String)
+    ''', '''
+        ENGINE = MergeTree()
+        PARTITION BY toYYYYMM(time)
+        ORDER BY (mac, time)
+        TTL time + INTERVAL 3 YEAR
+    ''', V2_COLUMNS['management_commands'])
+
+
+@migration(3, "hourly rollups of life and message events")
+async def hourly_rollups(client):
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS intercom_life_hourly (
+        hour DateTime,
+        mac LowCardinality(String),
+        heartbeats SimpleAggregateFunction(sum, UInt64),
+        failures SimpleAggregateFunction(sum, UInt64),
+        last_heartbeat SimpleAggregateFunction(max, DateTime)
+    ) ENGINE = AggregatingMergeTree()
+    PARTITION BY toYYYYMM(hour)
+    ORDER BY (mac, hour)
+    TTL hour + INTERVAL 3 YEAR
+    ''')
+    life_select = '''
+        SELECT
+            toStartOfHour(time) AS hour,
+            mac,
+            countIf(status NOT IN ('fail', 'deleted', 'restored')) AS heartbeats,
+            countIf(status = 'fail') AS failures,
+            maxIf(time, status NOT IN ('fail', 'deleted', 'restored')) AS last_heartbeat
+        FROM intercom_life
+        GROUP BY hour, mac
+    '''
+    await client.command(f"CREATE MATERIALIZED VIEW IF NOT EXISTS intercom_life_hourly_mv "
+                         f"TO intercom_life_hourly AS {life_select}")
+
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS intercom_events_hourly (
+        hour DateTime,
+        mac LowCardinality(String),
+        event LowCardinality(String),
+        status LowCardinality(String),
+        events SimpleAggregateFunction(sum, UInt64),
+        denied_keys SimpleAggregateFunction(sum, UInt64)
+    ) ENGINE = AggregatingMergeTree()
+    PARTITION BY toYYYYMM(hour)
+    ORDER BY (mac, hour, event, status)
+    TTL hour + INTERVAL 3 YEAR
+    ''')
+    events_select = '''
+        SELECT
+            toStartOfHour(time) AS hour,
+            mac,
+            event,
+            status,
+            count() AS events,
+            countIf(key IS NOT NULL AND key != 'None' AND status != 'success') AS denied_keys
+        FROM intercom_messages
+        GROUP BY hour, mac, event, status
+    '''
+    await client.command(f"CREATE MATERIALIZED VIEW IF NOT EXISTS intercom_events_hourly_mv "
+                         f"TO intercom_events_hourly AS {events_select}")
+
+    # Буферы стоят на паузе во время миграций, поэтому история переносится без двойного счёта
+    await client.command("TRUNCATE TABLE intercom_life_hourly")
+    await client.command(f"INSERT INTO intercom_life_hourly {life_select}")
+    await client.command("TRUNCATE TABLE intercom_events_hourly")
+    await client.command(f"INSERT INTO intercom_events_hourly {events_select}")
+    logger.info("Rollup tables created")
+
+
+@migration(4, "canonical json configs with content-addressed bodies")
+async def config_bodies(client):
+    await client.command("ALTER TABLE intercom_configs ADD COLUMN IF NOT EXISTS new_config_hash String DEFAULT ''")
+    await client.command("ALTER TABLE intercom_configs ADD COLUMN IF NOT EXISTS old_config_hash String DEFAULT ''")
+    # Тело каждой различной конфигурации хранится один раз, строки intercom_configs ссылаются на него по хэшу.
+    # Типизированные колонки позволяют фильтровать по адресу, квартирам и ключам без разбора JSON
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS intercom_config_bodies (
+        config_hash String,
+        time DateTime,
+        location LowCardinality(String),
+        apartments Array(String),
+        allowed_keys Array(String),
+        body String CODEC(ZSTD(3))
+    ) ENGINE = ReplacingMergeTree()
+    ORDER BY config_hash
+    ''')
+    logger.info("Config bodies table created")
+
+
+@migration(5, "periodic heartbeat summaries")
+async def life_summaries(client):
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS intercom_life_summary (
+        time DateTime,
+        mac LowCardinality(String),
+        heartbeats UInt32,
+        raw_rows UInt32,
+        first_seen DateTime,
+        last_seen DateTime,
+        max_gap Float32
+    ) ENGINE = MergeTree()
+    PARTITION BY toYYYYMM(time)
+    ORDER BY (mac, time)
+    TTL time + INTERVAL 3 YEAR
+    ''')
+    # Пульсы, записанные строкой intercom_life, уже учтены представлением intercom_life_hourly_mv
+    await client.command('''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS intercom_life_summary_hourly_mv TO intercom_life_hourly AS
+        SELECT
+            toStartOfHour(last_seen) AS hour,
+            mac,
+            toUInt64(heartbeats - raw_rows) AS heartbeats,
+            toUInt64(0) AS failures,
+            last_seen AS last_heartbeat
+        FROM intercom_life_summary
+    ''')
+    logger.info("Heartbeat summary table created")
+
+
+@migration(6, "command acknowledgements")
+async def command_acks(client):
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS command_acks (
+        time DateTime,
+        mac LowCardinality(String),
+        command_id String,
+        event LowCardinality(String),
+        status LowCardinality(String),
+        latency Nullable(Float32)
+    ) ENGINE = MergeTree()
+    PARTITION BY toYYYYMM(time)
+    ORDER BY (mac, time)
+    TTL time + INTERVAL 3 YEAR
+    ''')
+    logger.info("Command acknowledgements table created")
+
+
+async def applied_versions(client):
+    await client.command('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version UInt32,
+        name String,
+        applied_at DateTime
+    ) ENGINE = MergeTree()
+    ORDER BY version
+    ''')
+    result = await client.query("SELECT version FROM schema_migrations")
+    return {row[0] for row in result.result_rows}
+
+
+async def apply_migrations():
+    client = await clickhouse.init_client()
+    applied = await applied_versions(client)
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {name}")
+        await func(client)
+        await client.insert('schema_migrations', [[version, name, datetime.now()]],
+                            column_names=['version', 'name', 'applied_at'])
+        logger.info(f"Migration {version} applied")
+
+
+async def migrate(delay: float = MIGRATION_RETRY_DELAY):
+    # Буферы стоят на паузе, пока схема не готова: при старте контейнера Clickhouse часто ещё недоступен,
+    # и записи в таблицы без новых колонок только копились бы в спуле
+    clickhouse.schema_ready = False
+    while True:
+        try:
+            await apply_migrations()
+            break
+        except Exception as e:
+            logger.error(f"Ошибка при миграции схемы Clickhouse: {e}, повтор через {delay:.1f}с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MIGRATION_MAX_DELAY)
+    clickhouse.schema_ready = True
@@ -1,103 +1,215 @@
 import asyncio
-from aiomqtt import Client
-import json
+import heapq
 import logging
+import os
 
-from clickhouse import clickhouse_insert_message, clickhouse_insert_life
-from datetime import datetime
+from clickhouse import clickhouse_insert_message, clickhouse_insert_life, clickhouse_insert_life_summary
+from datetime import datetime, timedelta
 
+import acks
 import call
+import ingest
 
 import state
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-async def listen_for_notifications():
-    while True:
-        try:
-            async with Client("mqtt") as client:
-                await client.subscribe("intercom/+/message")
-
-                async for message in client.messages:
-                    try:
-                        my_topic = message.topic
-                        my_payload = json.loads(message.payload)
-                        logger.info(f"New MQTT message: topic={message.topic}, payload={my_payload}")
-                        mac = str(my_topic).split("/")[1]
-
-                        time = my_payload.get("time")
-                        event = my_payload.get("event")
-                        status = my_payload.get("status")
-                        door_status = my_payload.get("door_status")
-                        reason = my_payload.get("reason", None)
-                        key = my_payload.get("key", None)
-                        result = my_payload.get("result", None)
-
-                        apartment = my_payload.get("apartment", None)
-                        location = my_payload.get("location", None)
-
-                        if event == "call-start" or event == "call-end":
-                            await call.call_handler(time, mac, event, apartment, location)
-
-                        await clickhouse_insert_message(time, mac, event, status, door_status, reason, key, result,
-                                                        apartment, location)
-
-                    except Exception as e:
-                        logger.error(f"Ошибка при обработке MQTT-сообщения: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка при подписке на MQTT: {e}")
+LIFE_TIMEOUT = 12
+# raw: каждый пульс пишется в intercom_life; compact: только смены статуса и периодическая сводка
+LIFE_MODE = os.environ.get("LIFE_MODE", "compact")
+LIFE_SUMMARY_INTERVAL = 300
+
+# Переопределённые таймауты отдельных домофонов, сек
+life_timeouts = {}
+# Куча (срок, mac): ближайший срок пропуска heartbeat-а всегда наверху
+deadlines = []
+# Актуальный срок каждого отслеживаемого mac; записи кучи с другим сроком устарели и пропускаются
+next_deadline = {}
+offline = set()
+wakeup = None
+
+
+class HeartbeatSummary:
+    __slots__ = ("heartbeats", "raw_rows", "first_seen", "last_seen", "max_gap")
+
+    def __init__(self, now: datetime):
+        self.heartbeats = 0
+        # Пульсы периода, которые записаны ещё и строкой intercom_life (смена статуса)
+        self.raw_rows = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.max_gap = 0.0
+
+    def add(self, now: datetime, previous: datetime | None):
+        self.heartbeats += 1
+        self.last_seen = now
+        if previous is not None:
+            self.max_gap = max(self.max_gap, (now - previous).total_seconds())
+
+
+# mac -> сводка пульсов за текущий период (режим compact)
+summaries = {}
+# mac -> последний статус, записанный строкой в intercom_life (режим compact)
+life_status = {}
+
+
+async def handle_message(mac: str, payload: dict):
+    time = payload.get("time")
+    event = payload.get("event")
+    status = payload.get("status")
+    door_status = payload.get("door_status")
+    reason = payload.get("reason", None)
+    key = payload.get("key", None)
+    result = payload.get("result", None)
+
+    apartment = payload.get("apartment", None)
+    location = payload.get("location", None)
+
+    if event == "call-start" or event == "call-end":
+        await call.call_handler(time, mac, event, apartment, location)
+    else:
+        acks.tracker.match(mac, payload)
+
+    await clickhouse_insert_message(time, mac, event, status, door_status, reason, key, result,
+                                    apartment, location)
+
+
+def life_timeout(mac: str) -> float:
+    return life_timeouts.get(mac, LIFE_TIMEOUT)
+
+
+def set_life_timeout(mac: str, seconds: float):
+    life_timeouts[mac] = seconds
+    if mac in state.last_seen:
+        schedule(mac)
+
+
+def schedule(mac: str):
+    deadline = state.last_seen[mac] + timedelta(seconds=life_timeout(mac))
+    heapq.heappush(deadlines, (deadline, mac))
+    next_deadline[mac] = deadline
+    if wakeup is not None and deadlines[0] == (deadline, mac):
+        wakeup.set()
+
+
+async def track_heartbeat(mac: str, now: datetime):
+    if mac in offline:
+        offline.discard(mac)
+        logger.info("[RESTORED] Life-сообщения от %s снова приходят", mac, extra={"mac": mac, "transition": True})
+        await clickhouse_insert_life(now.strftime("%Y-%m-%d %H:%M:%S"), mac, "restored")
+    if mac not in next_deadline:
+        schedule(mac)
+
+
+def release(mac: str):
+    # В кластере пульс принят другой репликой: срок отслеживает она, а здесь ожидание снимается,
+    # чтобы о пропуске не сообщили сразу несколько реплик
+    next_deadline.pop(mac, None)
+    offline.discard(mac)
+
+
+async def expire_deadlines(now: datetime):
+    while deadlines and deadlines[0][0] <= now:
+        popped, mac = heapq.heappop(deadlines)
+        if next_deadline.get(mac) != popped:
+            continue
+        last_time = state.last_seen.get(mac)
+        if last_time is None:
+            # Домофон удалён или прислал deleted
+            next_deadline.pop(mac, None)
+            offline.discard(mac)
+            continue
+
+        # Heartbeat-ы только обновляют last_seen, поэтому срок пересчитывается здесь
+        deadline = last_time + timedelta(seconds=life_timeout(mac))
+        if deadline > now:
+            heapq.heappush(deadlines, (deadline, mac))
+            next_deadline[mac] = deadline
+            continue
+
+        next_deadline.pop(mac, None)
+        offline.add(mac)
+        # Первый пульс после пропуска снова пишется строкой
+        life_status.pop(mac, None)
+        delta = (now - last_time).total_seconds()
+        logger.warning(f"[FAIL] Life-сообщение от {mac} не приходило {delta} сек.")
+        door_phone = state.door_phones.get(mac)
+        if door_phone and door_phone.active:
+            await state.remove(mac, error=True)
+            logger.info("mac %s отключен из-за ошибки", mac, extra={"mac": mac, "transition": True})
+        await clickhouse_insert_life(now.strftime("%Y-%m-%d %H:%M:%S"), mac, "fail")
 
 
 async def check_life_status():
+    global wakeup
+    wakeup = asyncio.Event()
     while True:
-        await asyncio.sleep(12)
-
-        now = datetime.now()
-        for last_mac, last_time in list(state.last_seen.items()):
-            delta = (now - last_time).total_seconds()
-            if delta > 12:
-                logger.warning(f"[FAIL] Life-сообщение от {last_mac} не приходило {delta} сек.")
-                if state.door_phones[last_mac]["active"]:
-                    await state.remove(last_mac, error=True)
-                    logger.info(f"mac {last_mac} отключен из-за ошибки")
-                await clickhouse_insert_life(now.strftime("%Y-%m-%d %H:%M:%S"), last_mac, "fail")
-
-
-async def get_life():
-
-    check_life_task = asyncio.create_task(check_life_status())
-
+        timeout = None
+        if deadlines:
+            timeout = max((deadlines[0][0] - datetime.now()).total_seconds(), 0)
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        await expire_deadlines(datetime.now())
+
+
+async def compact_heartbeat(time: str, mac: str, status: str, previous: datetime | None):
+    now = state.last_seen[mac]
+    summary = summaries.get(mac)
+    if summary is None:
+        summary = summaries[mac] = HeartbeatSummary(now)
+    summary.add(now, previous)
+    if life_status.get(mac) != status:
+        life_status[mac] = status
+        summary.raw_rows += 1
+        await clickhouse_insert_life(time, mac, status)
+
+
+async def flush_life_summaries(now: datetime | None = None):
+    if not summaries:
+        return
+    now = now or datetime.now()
+    pending = list(summaries.items())
+    summaries.clear()
+    for mac, summary in pending:
+        await clickhouse_insert_life_summary(now, mac, summary.heartbeats, summary.raw_rows, summary.first_seen,
+                                             summary.last_seen, summary.max_gap)
+    logger.debug("Flushed %d heartbeat summaries", len(pending))
+
+
+async def run_life_summaries(interval: float = LIFE_SUMMARY_INTERVAL):
     while True:
+        await asyncio.sleep(interval)
         try:
-            async with Client("mqtt") as client:
-                await client.subscribe("intercom/+/life")
-
-                async for message in client.messages:
-                    try:
-                        my_topic = message.topic
-                        my_payload = json.loads(message.payload)
-                        logger.info(f"New MQTT message: topic={message.topic}, payload={my_payload}")
-                        mac = str(my_topic).split("/")[1]
-                        time = my_payload.get("time")
-                        status = my_payload.get("status")
-                        if status != 'deleted':
-                            state.last_seen[mac] = datetime.now()
-                            logger.info(f"последнее сообщение {mac} - {state.last_seen[mac]}")
-                        else:
-                            if mac in state.last_seen:
-                                logger.info(f"{mac} был отключен")
-                                state.last_seen.pop(mac, None)
-
-                        await clickhouse_insert_life(time, mac, status)
-
-                    except Exception as e:
-                        logger.error(f"Ошибка при обработке MQTT-сообщения: {e}")
-        except asyncio.CancelledError:
-            logger.info("get_life task cancelled, cancelling internal task")
-            check_life_task.cancel()
-            await check_life_task
-            raise
+            await flush_life_summaries()
         except Exception as e:
-            logger.error(f"Ошибка при подписке на MQTT: {e}")
+            logger.error(f"Ошибка при записи сводки пульсов: {e}")
+
+
+async def handle_life(mac: str, payload: dict):
+    time = payload.get("time")
+    status = payload.get("status")
+    if status != 'deleted':
+        previous = state.last_seen.get(mac)
+        state.backend.touch(mac, datetime.now())
+        logger.info("последнее сообщение %s - %s", mac, state.last_seen[mac], extra={"mac": mac, "kind": "life"})
+        await track_heartbeat(mac, state.last_seen[mac])
+        if LIFE_MODE == "compact":
+            await compact_heartbeat(time, mac, status, previous)
+            return
+    else:
+        if mac in state.last_seen:
+            logger.info("%s был отключен", mac, extra={"mac": mac, "transition": True})
+            state.backend.forget(mac)
+        offline.discard(mac)
+        life_status.pop(mac, None)
+
+    await clickhouse_insert_life(time, mac, status)
+
+
+# События вызова и двери приходят в топике message и должны обгонять поток пульсов
+ingest.register_handler("message", handle_message, ingest.HIGH)
+ingest.register_handler("life", handle_life, ingest.LOW)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from aiomqtt import Client, MqttError
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PUBLISH_TIMEOUT = 10
+PUBLISH_CONCURRENCY = 8
+QUEUE_SIZE = 1000
+RECONNECT_DELAY = 1
+
+
+class Publisher:
+    def __init__(self, hostname: str = "mqtt", concurrency: int = PUBLISH_CONCURRENCY, queue_size: int = QUEUE_SIZE):
+        self.hostname = hostname
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue = None
+        self.connected = False
+        self.stats = {"published": 0, "errors": 0, "reconnects": 0}
+
+    def _get_queue(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        return self.queue
+
+    async def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False,
+                      timeout: float = PUBLISH_TIMEOUT):
+        future = asyncio.get_running_loop().create_future()
+        await asyncio.wait_for(self._enqueue((topic, payload, qos, retain, future)), timeout)
+
+    async def _enqueue(self, item):
+        # Переполненная очередь притормаживает отправителя, а не отклоняет сообщение
+        await self._get_queue().put(item)
+        await item[4]
+
+    def _requeue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            item[4].cancel()
+
+    async def _worker(self, client: Client, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            topic, payload, qos, retain, future = item
+            if future.done():
+                # Отправитель уже перестал ждать (таймаут)
+                continue
+            try:
+                await client.publish(topic, payload=payload, qos=qos, retain=retain)
+            except (MqttError, asyncio.CancelledError):
+                self._requeue(item)
+                raise
+            except Exception as e:
+                # Ошибка самого сообщения, а не соединения: сообщаем отправителю и продолжаем
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка при публикации в {topic}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.stats["published"] += 1
+            if not future.done():
+                future.set_result(None)
+
+    async def run(self):
+        queue = self._get_queue()
+        while True:
+            try:
+                async with Client(self.hostname) as client:
+                    self.connected = True
+                    logger.info("Publisher connected to MQTT broker")
+                    async with asyncio.TaskGroup() as group:
+                        for _ in range(self.concurrency):
+                            group.create_task(self._worker(client, queue))
+            except* Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка соединения публикатора с MQTT: {e.exceptions[0]}")
+            self.connected = False
+            self.stats["reconnects"] += 1
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+publisher = Publisher()
+
+PUBLISHED = metrics.Counter("mqtt_published_total", "Messages published by the shared MQTT publisher",
+                            function=lambda: publisher.stats["published"])
+RECONNECTS = metrics.Counter("mqtt_publisher_reconnects_total", "Reconnects of the publisher MQTT connection",
+                             function=lambda: publisher.stats["reconnects"])
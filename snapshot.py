@@ -0,0 +1,143 @@
+import ast
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+import clickhouse
+import notifications
+import state
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "snapshot/state.json")
+SNAPSHOT_INTERVAL = 30
+SNAPSHOT_VERSION = 1
+REBUILD_TIMEOUT = 10
+
+
+def dump() -> dict:
+    return {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": datetime.now().isoformat(),
+        "door_phones": state.door_phones.to_dict(),
+        # Время последнего пульса не сохраняется: после перезапуска отсчёт таймаута начинается заново
+        "last_seen": sorted(state.last_seen),
+        "current_calls": state.current_calls,
+        "life_timeouts": notifications.life_timeouts,
+    }
+
+
+def write_atomic(path: str, data: bytes):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    # Читатель видит либо прошлый снимок целиком, либо новый, но никогда не половину
+    os.replace(tmp_path, path)
+
+
+async def save(path: str = SNAPSHOT_PATH):
+    data = json.dumps(dump(), default=str).encode()
+    await asyncio.to_thread(write_atomic, path, data)
+    logger.info(f"State snapshot saved: {len(state.door_phones)} door phones")
+
+
+def restore_last_seen(macs):
+    now = datetime.now()
+    for mac in macs:
+        state.last_seen[mac] = now
+        notifications.schedule(mac)
+
+
+def load(path: str = SNAPSHOT_PATH) -> bool:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return False
+    except ValueError as e:
+        logger.error(f"Снимок состояния {path} повреждён: {e}")
+        return False
+    if data.get("version") != SNAPSHOT_VERSION:
+        logger.warning(f"Снимок состояния {path} другой версии, пропущен")
+        return False
+
+    registry = state.Registry.load(data["door_phones"])
+    state.door_phones.clear()
+    for device in registry.devices.values():
+        state.door_phones.put(device)
+    state.current_calls.update(data["current_calls"])
+    notifications.life_timeouts.update(data["life_timeouts"])
+    restore_last_seen(data["last_seen"])
+    logger.info(f"State restored from snapshot {data['saved_at']}: {len(state.door_phones)} door phones")
+    return True
+
+
+def parse_config(text: str) -> dict:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        # Строки, записанные до миграции 4, хранят str(dict)
+        return ast.literal_eval(text)
+
+
+async def rebuild_from_clickhouse() -> bool:
+    client = await clickhouse.init_client()
+    # Переподключение с известной конфигурацией хранит только хэш, тело берётся из intercom_config_bodies
+    result = await client.query('''
+        SELECT c.mac, c.event, coalesce(c.new_config, nullIf(b.body, '')), c.old_config
+        FROM (
+            SELECT mac, argMax(event, time) AS event, argMax(new_config, time) AS new_config,
+                   argMax(new_config_hash, time) AS new_config_hash, argMax(old_config, time) AS old_config
+            FROM intercom_configs
+            GROUP BY mac
+        ) AS c
+        LEFT JOIN (
+            SELECT config_hash, any(body) AS body FROM intercom_config_bodies GROUP BY config_hash
+        ) AS b ON b.config_hash = c.new_config_hash
+    ''')
+    macs = []
+    for mac, event, new_config, old_config in result.result_rows:
+        # Удалённый домофон остаётся в списке неактивным, как и после state.remove
+        active = event in ('added', 'modified', 'reconnect') and bool(new_config)
+        config = new_config if active else old_config
+        if not config:
+            continue
+        try:
+            parsed = parse_config(config)
+        except (ValueError, SyntaxError):
+            logger.warning(f"Не удалось разобрать конфигурацию {mac} из Clickhouse")
+            continue
+        state.door_phones.put(state.DoorPhone(mac, parsed, active=active))
+        if active:
+            macs.append(mac)
+    # Домофоны, которые так и не пришлют пульс, будут отмечены ошибкой обычным таймаутом
+    restore_last_seen(macs)
+    logger.info(f"State rebuilt from Clickhouse: {len(state.door_phones)} door phones")
+    return len(state.door_phones) > 0
+
+
+async def restore() -> str | None:
+    if load():
+        return "snapshot"
+    try:
+        if await asyncio.wait_for(rebuild_from_clickhouse(), REBUILD_TIMEOUT):
+            return "clickhouse"
+    except Exception as e:
+        logger.error(f"Не удалось восстановить состояние из Clickhouse: {e}")
+    return None
+
+
+async def run_snapshots(interval: float = SNAPSHOT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении снимка состояния: {e}")
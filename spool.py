@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from time import monotonic
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+SPOOL_MAX_BYTES = 256 * 1024 * 1024
+
+
+def write_segment(path: Path, data: bytes):
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_segment(path: Path):
+    rows = []
+    corrupt = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            # Недописанная при падении последняя строка не имеет перевода строки
+            if not line.endswith("\n"):
+                corrupt += 1
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                corrupt += 1
+    return rows, corrupt
+
+
+class Spool:
+    def __init__(self, directory, segment_max_bytes: int = SEGMENT_MAX_BYTES, max_bytes: int = SPOOL_MAX_BYTES):
+        self.directory = Path(directory)
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self.segment = None
+        # Путь сегмента -> [байты, строки]
+        self.sizes = {}
+        self.recovered = False
+        self.stats = {"spooled_rows": 0, "replayed_rows": 0, "dropped_rows": 0, "corrupt_rows": 0,
+                      "replay_rate": 0.0}
+
+    def recover(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sizes = {}
+        for path in sorted(self.directory.glob("*.jsonl")):
+            with open(path, "rb") as f:
+                rows = sum(1 for line in f if line.endswith(b"\n"))
+            self.sizes[path] = [path.stat().st_size, rows]
+        # После перезапуска дописываем только в новый сегмент
+        self.segment = None
+        self.recovered = True
+        if self.sizes:
+            logger.info(f"Spool {self.directory}: recovered {self.depth()['rows']} rows")
+
+    def depth(self):
+        return {"segments": len(self.sizes),
+                "bytes": sum(size for size, _ in self.sizes.values()),
+                "rows": sum(rows for _, rows in self.sizes.values())}
+
+    def _next_segment(self):
+        last = max(self.sizes, default=None)
+        number = int(last.stem) + 1 if last else 1
+        return self.directory / f"{number:012d}.jsonl"
+
+    async def append(self, rows: list):
+        if not self.recovered:
+            self.recover()
+        if self.segment is None or self.sizes[self.segment][0] >= self.segment_max_bytes:
+            self.segment = self._next_segment()
+            self.sizes[self.segment] = [0, 0]
+        segment = self.segment
+
+        data = "".join(json.dumps(row, default=str) + "\n" for row in rows).encode()
+        await asyncio.to_thread(write_segment, segment, data)
+        if segment in self.sizes:
+            self.sizes[segment][0] += len(data)
+            self.sizes[segment][1] += len(rows)
+        self.stats["spooled_rows"] += len(rows)
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        while self.depth()["bytes"] > self.max_bytes and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            _, rows = self.sizes.pop(oldest)
+            oldest.unlink(missing_ok=True)
+            self.stats["dropped_rows"] += rows
+            logger.error(f"Spool {self.directory} переполнен, удалён сегмент {oldest.name} ({rows} строк)")
+
+    async def replay(self, insert):
+        if not self.recovered:
+            self.recover()
+        # Новые строки пишутся в следующий сегмент, пока текущие отправляются
+        self.segment = None
+        started = monotonic()
+        replayed = 0
+        for path in sorted(self.sizes):
+            rows, corrupt = await asyncio.to_thread(read_segment, path)
+            self.stats["corrupt_rows"] += corrupt
+            if rows:
+                await insert(rows)
+            path.unlink(missing_ok=True)
+            self.sizes.pop(path, None)
+            replayed += len(rows)
+            self.stats["replayed_rows"] += len(rows)
+
+        elapsed = monotonic() - started
+        if replayed:
+            self.stats["replay_rate"] = replayed / elapsed if elapsed else float(replayed)
+            logger.info(f"Spool {self.directory}: replayed {replayed} rows in {elapsed:.3f}s")
+        return replayed
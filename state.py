@@ -1,34 +1,200 @@
+import hashlib
+import json
+from datetime import datetime
 from typing import Optional
 
-door_phones = {}
+import events
+import metrics
+
+# Поля конфигурации, изменение которых означает новую или изменённую конфигурацию домофона
+IDENTITY_FIELDS = ("location", "apartments", "allowed_keys")
+
+
+def config_hash(config: dict) -> str:
+    identity = {field: config.get(field) for field in IDENTITY_FIELDS}
+    return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class DoorPhone:
+    __slots__ = ("mac", "location", "apartments", "allowed_keys", "config", "config_hash", "active", "error")
+
+    def __init__(self, mac: str, config: dict, active: bool = True, error: bool = False):
+        self.mac = mac
+        self.config = {key: value for key, value in config.items() if key not in ("active", "error")}
+        self.location = config.get("location")
+        self.apartments = tuple(config.get("apartments") or ())
+        self.allowed_keys = tuple(config.get("allowed_keys") or ())
+        self.config_hash = config_hash(config)
+        self.active = active
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {**self.config, "location": self.location, "apartments": list(self.apartments),
+                "allowed_keys": list(self.allowed_keys), "active": self.active, "error": self.error}
+
+
+class Registry:
+    def __init__(self):
+        self.devices = {}
+        # Вторичные индексы: поиск по квартире или адресу не перебирает весь парк
+        self.by_apartment = {}
+        self.by_location = {}
+        self.active = set()
+        self.errors = set()
+
+    @classmethod
+    def load(cls, configs: dict):
+        registry = cls()
+        for mac, config in configs.items():
+            registry.put(DoorPhone(mac, config, config.get("active", True), config.get("error", False)))
+        return registry
+
+    def __contains__(self, mac):
+        return mac in self.devices
+
+    def __getitem__(self, mac) -> DoorPhone:
+        return self.devices[mac]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def get(self, mac) -> Optional[DoorPhone]:
+        return self.devices.get(mac)
+
+    def items(self):
+        return self.devices.items()
+
+    def put(self, device: DoorPhone):
+        self.pop(device.mac)
+        self.devices[device.mac] = device
+        for apartment in device.apartments:
+            self.by_apartment.setdefault(str(apartment), set()).add(device.mac)
+        self.by_location.setdefault(device.location, set()).add(device.mac)
+        self.set_status(device.mac, device.active, device.error)
+
+    def pop(self, mac) -> Optional[DoorPhone]:
+        device = self.devices.pop(mac, None)
+        if device is None:
+            return None
+        for apartment in device.apartments:
+            self._unindex(self.by_apartment, str(apartment), mac)
+        self._unindex(self.by_location, device.location, mac)
+        self.active.discard(mac)
+        self.errors.discard(mac)
+        return device
+
+    @staticmethod
+    def _unindex(index: dict, key, mac: str):
+        macs = index.get(key)
+        if macs is not None:
+            macs.discard(mac)
+            if not macs:
+                del index[key]
+
+    def set_status(self, mac: str, active: bool, error: bool):
+        device = self.devices[mac]
+        device.active = active
+        device.error = error
+        if active:
+            self.active.add(mac)
+        else:
+            self.active.discard(mac)
+        if error:
+            self.errors.add(mac)
+        else:
+            self.errors.discard(mac)
+
+    def find_by_apartment(self, apartment) -> set:
+        return set(self.by_apartment.get(str(apartment), ()))
+
+    def find_by_location(self, location: str) -> set:
+        return set(self.by_location.get(location, ()))
+
+    def clear(self):
+        self.__init__()
+
+    def to_dict(self) -> dict:
+        return {mac: device.to_dict() for mac, device in self.devices.items()}
+
+
+door_phones = Registry()
 last_seen = {}
+current_calls = {}
+
+
+class LocalBackend:
+    """Состояние живёт только в памяти этого процесса.
+
+    Все изменения реестра, пульсов и вызовов проходят через бэкенд, чтобы в кластерном режиме
+    их можно было разослать другим репликам (см. cluster.MqttBackend).
+    """
+
+    def put_device(self, device: DoorPhone):
+        door_phones.put(device)
+
+    def set_status(self, mac: str, active: bool, error: bool):
+        door_phones.set_status(mac, active, error)
+
+    def remove_device(self, mac: str):
+        door_phones.pop(mac)
+        last_seen.pop(mac, None)
+
+    def touch(self, mac: str, time: datetime):
+        last_seen[mac] = time
+
+    def forget(self, mac: str):
+        last_seen.pop(mac, None)
+
+    def start_call(self, mac: str, call: dict):
+        current_calls[mac] = call
+
+    def end_call(self, mac: str):
+        current_calls.pop(mac, None)
+
+    def command_sent(self, mac: str, command_id: str, event: str):
+        # Ожидающие команды хранит acks.tracker; одной реплике рассылать их некому
+        pass
+
+    def command_resolved(self, mac: str, command_id: str, status: str | None):
+        pass
+
+
+backend = LocalBackend()
+
+STATE_ENTRIES = metrics.Gauge("state_entries", "Entries in in-memory state structures", ["structure"],
+                              function=lambda: {"door_phones": len(door_phones), "last_seen": len(last_seen),
+                                                "current_calls": len(current_calls)})
+
+
+def _publish_door_phone(mac: str):
+    events.publish("doorphones", "update", {"mac": mac, "config": door_phones[mac].to_dict()})
 
 
 async def add_or_update(mac: str, config: dict):
-    if mac in door_phones:
-        if (door_phones[mac]["location"] == config["location"] and
-                door_phones[mac]["apartments"] == config["apartments"] and
-                door_phones[mac]["allowed_keys"] == config["allowed_keys"]):
-            door_phones[mac]["active"] = True
-            door_phones[mac]["error"] = False
-            return 'connect'
-    door_phones[mac] = config
-    door_phones[mac]["active"] = True
-    door_phones[mac]["error"] = False
+    device = door_phones.get(mac)
+    if device is not None and device.config_hash == config_hash(config):
+        backend.set_status(mac, active=True, error=False)
+        _publish_door_phone(mac)
+        return 'connect'
+    backend.put_device(DoorPhone(mac, config))
+    _publish_door_phone(mac)
     return 'new/mod'
 
 
 async def remove(mac: str, config: Optional[dict] = None, error=False):
-    if mac not in door_phones:
-        door_phones[mac] = config
-    door_phones[mac]["active"] = False
-    if error:
-        door_phones[mac]["error"] = True
+    device = door_phones.get(mac)
+    if device is None:
+        if config is None:
+            return
+        device = DoorPhone(mac, config)
+        backend.put_device(device)
+    backend.set_status(mac, active=False, error=device.error or error)
+    _publish_door_phone(mac)
 
 
 def full_remove(mac: str):
-    door_phones.pop(mac, None)
-    last_seen.pop(mac, None)
-
-
-current_calls = {}
+    backend.remove_device(mac)
+    events.publish("doorphones", "remove", {"mac": mac})
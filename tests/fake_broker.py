@@ -0,0 +1,68 @@
+import asyncio
+
+from aiomqtt import Topic
+
+
+class FakeMessage:
+    def __init__(self, topic: str, payload):
+        self.topic = Topic(topic)
+        self.payload = payload.encode() if isinstance(payload, str) else payload
+
+
+class FakeClient:
+    """Подменяет aiomqtt.Client: подписки, публикация и поток сообщений через FakeBroker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = []
+        self.queue = asyncio.Queue()
+        self.published = []
+
+    async def __aenter__(self):
+        self.broker.clients.append(self)
+        return self
+
+    async def __aexit__(self, *args):
+        self.broker.clients.remove(self)
+
+    async def subscribe(self, topic, qos: int = 0):
+        topics = [topic] if isinstance(topic, str) else [item[0] for item in topic]
+        self.subscriptions.extend(topics)
+
+    async def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.published.append((topic, payload))
+        self.broker.deliver(topic, payload)
+
+    @property
+    def messages(self):
+        return self._messages()
+
+    async def _messages(self):
+        while True:
+            yield await self.queue.get()
+
+
+class FakeBroker:
+    """Брокер в памяти с поддержкой общих подписок $share/<группа>/<фильтр> (по очереди между участниками)."""
+
+    def __init__(self):
+        self.clients = []
+        self.turns = {}
+
+    def client(self, *args, **kwargs) -> FakeClient:
+        return FakeClient(self)
+
+    def deliver(self, topic: str, payload):
+        shared = {}
+        for client in self.clients:
+            for subscription in client.subscriptions:
+                if subscription.startswith("$share/"):
+                    _, group, pattern = subscription.split("/", 2)
+                    if Topic(topic).matches(pattern):
+                        shared.setdefault((group, pattern), []).append(client)
+                elif Topic(topic).matches(subscription):
+                    client.queue.put_nowait(FakeMessage(topic, payload))
+        for key, members in shared.items():
+            turn = self.turns.get(key, 0)
+            members[turn % len(members)].queue.put_nowait(FakeMessage(topic, payload))
+            self.turns[key] = turn + 1
@@ -0,0 +1,96 @@
+import pytest
+
+import acks
+
+
+@pytest.fixture
+def mock_insert(mocker):
+    return mocker.patch("acks.clickhouse_insert_command_ack")
+
+
+def test_ack_matched_by_command_id(mocker, mock_insert):
+    tracker = acks.AckTracker()
+    clock = mocker.patch("acks.monotonic", return_value=100.0)
+    first = tracker.new_command("00:11:22:33:44:55", "open-door")
+    second = tracker.new_command("00:11:22:33:44:55", "open-door")
+
+    clock.return_value = 100.25
+    assert tracker.match("00:11:22:33:44:55", {"event": "open-door", "status": "success",
+                                                     "command_id": second})
+
+    assert list(tracker.pending) == [("00:11:22:33:44:55", first)]
+    args = mock_insert.call_args.args
+    assert args[1:] == ("00:11:22:33:44:55", second, "open-door", "success", 0.25)
+    assert tracker.stats["acked"] == 1
+
+
+def test_ack_without_id_matches_oldest_command(mock_insert):
+    tracker = acks.AckTracker()
+    first = tracker.new_command("00:11:22:33:44:55", "call-response")
+    tracker.new_command("00:11:22:33:44:55", "call-response")
+
+    assert tracker.match("00:11:22:33:44:55", {"event": "open-door", "status": "fail"})
+    assert not tracker.match("00:11:22:33:44:66", {"event": "open-door", "status": "success"})
+
+    assert mock_insert.call_args.args[2:5] == (first, "call-response", "fail")
+    assert tracker.stats["failed"] == 1
+
+
+def test_unacknowledged_command_times_out(mocker, mock_insert):
+    tracker = acks.AckTracker(timeout=5)
+    mocker.patch("acks.monotonic", return_value=0.0)
+    late = tracker.new_command("00:11:22:33:44:55", "open-door")
+    mocker.patch("acks.monotonic", return_value=3.0)
+    tracker.new_command("00:11:22:33:44:66", "open-door")
+
+    tracker.expire(now=6.0)
+
+    mock_insert.assert_called_once()
+    assert mock_insert.call_args.args[1:] == ("00:11:22:33:44:55", late, "open-door", "timeout", None)
+    assert len(tracker.pending) == 1
+    assert tracker.stats["timeouts"] == 1
+
+
+def test_latency_percentiles_per_device(mocker, mock_insert):
+    tracker = acks.AckTracker()
+    clock = mocker.patch("acks.monotonic", return_value=0.0)
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        clock.return_value = 0.0
+        command_id = tracker.new_command("00:11:22:33:44:55", "open-door")
+        clock.return_value = latency
+        tracker.match("00:11:22:33:44:55", {"status": "success", "command_id": command_id})
+
+    assert tracker.latency_stats() == {"00:11:22:33:44:55": {"p50": 0.3, "p95": 0.4, "p99": 0.4, "count": 4}}
+
+
+def test_ack_fallback_ignores_expired_commands(mocker, mock_insert):
+    tracker = acks.AckTracker(timeout=5)
+    clock = mocker.patch("acks.monotonic", return_value=0.0)
+    tracker.new_command("00:11:22:33:44:55", "open-door")
+
+    clock.return_value = 6.0
+    assert not tracker.match("00:11:22:33:44:55", {"event": "open-door", "status": "success"})
+    mock_insert.assert_not_called()
+
+
+def test_remote_command_ack_is_recorded_by_sender(mocker, mock_insert):
+    sender_backend = mocker.patch.object(acks.state, "backend")
+    sender = acks.AckTracker()
+    command_id = sender.new_command("00:11:22:33:44:55", "open-door")
+    sender_backend.command_sent.assert_called_once_with("00:11:22:33:44:55", command_id, "open-door")
+
+    # Ответ домофона пришёл на другую реплику
+    receiver = acks.AckTracker()
+    receiver.add_remote("00:11:22:33:44:55", command_id, "open-door")
+    assert receiver.match("00:11:22:33:44:55", {"status": "success", "command_id": command_id})
+    mock_insert.assert_not_called()
+    sender_backend.command_resolved.assert_called_with("00:11:22:33:44:55", command_id, "success")
+    assert receiver.pending == {}
+
+    sender.resolve_remote("00:11:22:33:44:55", command_id, "success")
+    assert mock_insert.call_args.args[1:5] == ("00:11:22:33:44:55", command_id, "open-door", "success")
+    assert sender.pending == {} and sender.by_mac == {}
+    # Копия команды на другой реплике истекает без записи таймаута
+    receiver.add_remote("00:11:22:33:44:55", "other", "open-door")
+    receiver.expire(now=acks.monotonic() + 60)
+    mock_insert.assert_called_once()
@@ -0,0 +1,23 @@
+import pytest
+
+from benchmarks.harness import SCENARIOS, compare, run_benchmark
+
+
+@pytest.mark.asyncio
+async def test_smoke_benchmark_stores_every_message():
+    report = await run_benchmark(**{**SCENARIOS["smoke"], "devices": 5, "duration": 0.2})
+
+    assert report["published"] > 5
+    assert report["stored"] == report["published"]
+    assert 0 < report["latency_p50"] <= report["latency_p99"]
+    assert report["cpu_per_message_us"] > 0
+    # Пачка без пауз проходит быстрее, чем её предлагает расписание
+    assert report["throughput"] > report["offered_rate"]
+
+
+def test_compare_flags_regressions():
+    baseline = {"throughput": 1000, "latency_p99": 0.5, "cpu_per_message_us": 100}
+
+    assert compare({"throughput": 900, "latency_p99": 0.6, "cpu_per_message_us": 120}, baseline) == []
+    regressions = compare({"throughput": 500, "latency_p99": 1.0, "cpu_per_message_us": 120}, baseline)
+    assert [regression.split(":")[0] for regression in regressions] == ["throughput", "latency_p99"]
@@ -12,8 +12,8 @@ import state
     ("2025-07-01 12:00:10", "00:11:22:33:44:60", "call-start", "4", "X2"),
 ])
 async def test_call_handler(time, mac, event, apartment, location):
-    state.door_phones = {"00:11:22:33:44:55": {"location": "X2", "apartments": [1, 3], "allowed_keys": [2, 4],
-                                               "active": True, "error": False}}
+    state.door_phones = state.Registry.load({"00:11:22:33:44:55": {"location": "X2", "apartments": [1, 3],
+                                                                   "allowed_keys": [2, 4]}})
     if event == "call-end":
         state.current_calls[mac] = {"time": "2025-07-01 12:00:00", "apartment": apartment, "location": location}
     else:
@@ -28,13 +28,27 @@ async def test_call_handler(time, mac, event, apartment, location):
         assert state.current_calls == {}
 
 
+@pytest.mark.asyncio
+async def test_call_handler_publishes_events(mocker):
+    mac = "00:11:22:33:44:55"
+    mock_publish = mocker.patch("call.events.publish")
+    state.door_phones = state.Registry.load({mac: {"location": "X2", "apartments": [1, 3], "allowed_keys": [2, 4]}})
+    state.current_calls = {}
+
+    await call.call_handler("2025-07-01 12:00:00", mac, "call-start", "5", "X2")
+    await call.call_handler("2025-07-01 12:00:05", mac, "call-end", "5", "X2")
+
+    assert mock_publish.call_args_list[0].args == (
+        "calls", "call-start", {"mac": mac, "call": {"time": "2025-07-01 12:00:00", "apartment": "5", "location": "X2"}}
+    )
+    assert mock_publish.call_args_list[1].args == ("calls", "call-end", {"mac": mac})
+
+
 @pytest.mark.asyncio
 async def test_call_open(mocker):
     mac = "00:11:22:33:44:55"
 
-    mock_client = AsyncMock()
-    mock_client.__aenter__.return_value = mock_client
-    mocker.patch("call.Client", return_value=mock_client)
+    mock_publish = mocker.patch("call.publisher.publish", new_callable=AsyncMock)
 
     mock_insert = mocker.patch("call.clickhouse_insert_commands", new_callable=AsyncMock)
 
@@ -44,9 +58,9 @@ async def test_call_open(mocker):
     assert response.status_code == 303
     assert response.headers["location"] == "/calls/"
 
-    topic = mock_client.publish.call_args[0][0]
+    topic = mock_publish.call_args[0][0]
     assert "00:11:22:33:44:55" in topic
-    payload = mock_client.publish.call_args[1]["payload"]
+    payload = mock_publish.call_args[1]["payload"]
     assert "call-response" in payload
     assert mock_insert.call_count == 1
 
@@ -1,3 +1,6 @@
+import asyncio
+import io
+from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
@@ -5,6 +8,12 @@ import pytest
 import clickhouse
 
 
+@pytest.fixture(autouse=True)
+def fresh_cache(mocker):
+    mocker.patch.object(clickhouse, "query_cache", clickhouse.QueryCache())
+    mocker.patch.object(clickhouse, "known_config_hashes", set())
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("time,mac,event,new_config,old_config", [
     ("2025-07-01 12:00:00", "00:11:22:33:44:55", "added", {"location": "Hall", "apartments": [101]}, None),
@@ -16,24 +25,49 @@ async def test_clickhouse_insert_config(mocker, time, mac, event, new_config, ol
     clickhouse.client = mock_client
 
     await clickhouse.clickhouse_insert_config(time, mac, event, new_config, old_config)
+    mock_client.insert.assert_not_called()
+    await clickhouse.flush_buffers()
 
-    mock_client.insert.assert_called_once()
-
-    called_table = mock_client.insert.call_args[0][0]
-    assert called_table == "intercom_configs"
-
-    data = mock_client.insert.call_args[0][1]
-    row = data[0]
+    inserts = {call.args[0]: call.args[1] for call in mock_client.insert.call_args_list}
+    assert set(inserts) == {"intercom_configs", "intercom_config_bodies"}
+    row = inserts["intercom_configs"][0]
+    body, config_hash = clickhouse.canonical_config(new_config or old_config)
 
     assert row[0] == "config"
     assert row[3] == event
 
     if new_config:
-        assert row[4] == str(new_config)
-        assert row[5] is None
+        assert (row[4], row[5], row[6], row[7]) == (body, None, config_hash, "")
     elif old_config:
-        assert row[5] == str(old_config)
-        assert row[4] is None
+        assert (row[4], row[5], row[6], row[7]) == (None, body, "", config_hash)
+    assert inserts["intercom_config_bodies"] == [[config_hash, datetime(2025, 7, 1, 12), "Hall", ["101"], [], body]]
+
+
+def test_canonical_config_ignores_key_order():
+    first = clickhouse.canonical_config({"location": "Hall", "apartments": [101], "allowed_keys": ["A"]})
+    second = clickhouse.canonical_config({"allowed_keys": ["A"], "apartments": [101], "location": "Hall"})
+
+    assert first == second
+    assert first[0] == '{"allowed_keys":["A"],"apartments":[101],"location":"Hall"}'
+
+
+@pytest.mark.asyncio
+async def test_reconnect_with_known_config_stores_hash_only(mocker):
+    mock_client = mocker.AsyncMock()
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    config = {"location": "Hall", "apartments": [101]}
+
+    await clickhouse.clickhouse_insert_config("2025-07-01 12:00:00", "00:11:22:33:44:55", "added", config, None)
+    await clickhouse.clickhouse_insert_config("2025-07-01 12:05:00", "00:11:22:33:44:55", "reconnect",
+                                              dict(reversed(config.items())), None)
+    await clickhouse.flush_buffers()
+
+    inserts = {call.args[0]: call.args[1] for call in mock_client.insert.call_args_list}
+    added, reconnect = inserts["intercom_configs"]
+    assert added[4] is not None
+    assert reconnect[4] is None
+    assert reconnect[6] == added[6]
+    assert len(inserts["intercom_config_bodies"]) == 1
 
 
 @pytest.mark.asyncio
@@ -53,6 +87,7 @@ async def test_clickhouse_insert_message(mocker, time, mac, event, status, door_
     await clickhouse.clickhouse_insert_message(
         time, mac, event, status, door_status, reason, key, result, apartment, location
     )
+    await clickhouse.flush_buffers()
 
     mock_client.insert.assert_called_once()
 
@@ -86,6 +121,7 @@ async def test_clickhouse_insert_life(mocker, time, mac, status):
     clickhouse.client = mock_client
 
     await clickhouse.clickhouse_insert_life(time, mac, status)
+    await clickhouse.flush_buffers()
 
     mock_client.insert.assert_called_once()
 
@@ -130,6 +166,191 @@ async def test_clickhouse_insert_commands(mocker, time, mac, event, status):
     assert row[3] == event
 
 
+@pytest.mark.asyncio
+async def test_insert_buffer_batches_rows(mocker):
+    mock_client = mocker.AsyncMock()
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life')
+
+    for i in range(3):
+        buffer.add(["life", f"2025-07-01 12:00:0{i}", "00:11:22:33:44:55", "online"])
+    flushed = await buffer.flush()
+
+    assert flushed == 3
+    mock_client.insert.assert_awaited_once()
+    args, kwargs = mock_client.insert.call_args
+    assert args[0] == "intercom_life"
+    assert len(args[1]) == 3
+    assert kwargs["column_names"] == clickhouse.TABLE_COLUMNS["intercom_life"]
+    assert buffer.rows == []
+    assert buffer.stats["flushes"] == 1
+    assert buffer.stats["last_size"] == 3
+
+    assert await buffer.flush() == 0
+    mock_client.insert.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_keeps_rows_on_error(mocker):
+    mock_client = mocker.AsyncMock()
+    mock_client.insert.side_effect = Exception("clickhouse is down")
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life', max_pending=2)
+
+    buffer.add(["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"])
+    buffer.add(["life", "2025-07-01 12:00:01", "00:11:22:33:44:55", "online"])
+    with pytest.raises(Exception):
+        await buffer.flush()
+    assert len(buffer.rows) == 2
+
+    buffer.add(["life", "2025-07-01 12:00:02", "00:11:22:33:44:55", "online"])
+    with pytest.raises(Exception):
+        await buffer.flush()
+    assert [row[1] for row in buffer.rows] == ["2025-07-01 12:00:01", "2025-07-01 12:00:02"]
+    assert buffer.stats["errors"] == 2
+    assert buffer.stats["dropped"] == 1
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_flushes_when_full(mocker):
+    mock_client = mocker.AsyncMock()
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life', max_rows=2, max_delay=60)
+
+    task = asyncio.create_task(buffer.run())
+    await asyncio.sleep(0)
+    buffer.add(["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"])
+    await asyncio.sleep(0)
+    mock_client.insert.assert_not_called()
+
+    buffer.add(["life", "2025-07-01 12:00:01", "00:11:22:33:44:55", "online"])
+    for _ in range(5):
+        await asyncio.sleep(0)
+    task.cancel()
+
+    mock_client.insert.assert_awaited_once()
+    assert len(mock_client.insert.call_args[0][1]) == 2
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_backs_off_after_error(mocker):
+    mock_client = mocker.AsyncMock()
+    mock_client.insert.side_effect = Exception("clickhouse is down")
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life', max_rows=1, max_delay=60)
+
+    task = asyncio.create_task(buffer.run())
+    await asyncio.sleep(0)
+    for i in range(50):
+        buffer.add(["life", f"2025-07-01 12:00:{i:02}", "00:11:22:33:44:55", "online"])
+        await asyncio.sleep(0)
+    task.cancel()
+
+    assert mock_client.insert.await_count == 1
+    assert len(buffer.rows) == 50
+    assert buffer.backoff == 60
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_keeps_rows_when_cancelled(mocker):
+    mock_client = mocker.AsyncMock()
+    started = asyncio.Event()
+
+    async def slow_insert(*args, **kwargs):
+        started.set()
+        await asyncio.sleep(60)
+
+    mock_client.insert.side_effect = slow_insert
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life')
+    buffer.add(["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"])
+
+    task = asyncio.create_task(buffer.flush())
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert len(buffer.rows) == 1
+    assert buffer.stats["errors"] == 0
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_spools_and_replays(mocker, tmp_path):
+    mock_client = mocker.AsyncMock()
+    mock_client.insert.side_effect = Exception("clickhouse is down")
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life', spool=clickhouse.Spool(tmp_path))
+
+    buffer.add(["life", datetime(2025, 7, 1, 12, 0, 0), "00:11:22:33:44:55", "online"])
+    with pytest.raises(Exception):
+        await buffer.flush()
+    assert buffer.rows == []
+    assert buffer.spool.depth()["rows"] == 1
+
+    mock_client.insert.side_effect = None
+    assert await buffer.replay() == 1
+    args, kwargs = mock_client.insert.call_args
+    assert args[1] == [["life", datetime(2025, 7, 1, 12, 0, 0), "00:11:22:33:44:55", "online"]]
+    assert kwargs["column_names"] == clickhouse.TABLE_COLUMNS["intercom_life"]
+    assert buffer.spool.depth()["rows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_insert_buffer_replays_all_datetime_columns(mocker, tmp_path):
+    mock_client = mocker.AsyncMock()
+    mock_client.insert.side_effect = Exception("clickhouse is down")
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('intercom_life_summary', spool=clickhouse.Spool(tmp_path))
+    row = [datetime(2025, 7, 1, 12, 5), "00:11:22:33:44:55", 3, 1, datetime(2025, 7, 1, 12, 0),
+           datetime(2025, 7, 1, 12, 0, 15), 10.0]
+
+    buffer.add(list(row))
+    with pytest.raises(Exception):
+        await buffer.flush()
+
+    mock_client.insert.side_effect = None
+    assert await buffer.replay() == 1
+    assert mock_client.insert.call_args.args[1] == [row]
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_insert_commands_spools_on_error(mocker, tmp_path):
+    mock_client = mocker.AsyncMock()
+    mock_client.insert.side_effect = Exception("clickhouse is down")
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    buffer = clickhouse.InsertBuffer('management_commands', spool=clickhouse.Spool(tmp_path))
+    mocker.patch.dict(clickhouse.buffers, {'management_commands': buffer})
+
+    await clickhouse.clickhouse_insert_commands("2025-07-01 12:00:00", "00:11:22:33:44:55", "open_door", "success")
+
+    assert buffer.spool.depth()["rows"] == 1
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_insert_commands_waits_for_migrations(mocker):
+    mock_client = mocker.AsyncMock()
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    mocker.patch.object(clickhouse, "schema_ready", False)
+    buffer = clickhouse.InsertBuffer('management_commands')
+    mocker.patch.dict(clickhouse.buffers, {'management_commands': buffer})
+
+    await clickhouse.clickhouse_insert_commands("2025-07-01 12:00:00", "00:11:22:33:44:55", "open-door", "success")
+
+    mock_client.insert.assert_not_called()
+    assert [row[2:] for row in buffer.rows] == [["00:11:22:33:44:55", "open-door", "success"]]
+
+
+def test_insert_buffer_add_respects_max_pending():
+    buffer = clickhouse.InsertBuffer('intercom_life', max_pending=3)
+
+    for n in range(5):
+        buffer.add(["life", datetime(2025, 7, 1, 12, 0, n), "00:11:22:33:44:55", "online"])
+
+    assert [row[1].second for row in buffer.rows] == [2, 3, 4]
+    assert buffer.stats["dropped"] == 2
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "mac, payload, reconnect, expected_event",
@@ -155,45 +376,167 @@ async def test_json_config_to_clickhouse(mocker, mac, payload, reconnect, expect
     assert called_args[4] == payload.get('old_config', None)
 
 
-@pytest.mark.asyncio
 @pytest.mark.parametrize(
-    "table_name, message_name, selected_mac, selected_type, selected_time, expected_conditions",
+    "selected_mac, selected_type, selected_time, expected_conditions",
     [
-        ("intercom_messages", "messages", "00:11:22:33:44:55", "message", "1m", [
-            "mac = '00:11:22:33:44:55'",
-            "notification_type = 'message'",
-        ]),
-        ("intercom_life", "life", "all", None, "all", []),
-        ("management_commands", "commands", None, "management_commands", "10m", [
-            "notification_type = 'management_commands'",
-        ]),
-        ("intercom_configs", "configs", "00:11:22:33:44:56", None, None, [
-            "mac = '00:11:22:33:44:56'",
-        ]),
+        ("00:11:22:33:44:55", "message", "1m", ["mac = {mac:String}", "notification_type = {type:String}"]),
+        ("all", None, "all", []),
+        (None, "management_commands", "10m", ["notification_type = {type:String}"]),
+        ("' OR 1=1 --", None, None, ["mac = {mac:String}"]),
     ],
 )
-async def test_clickhouse_get(mocker, table_name, message_name, selected_mac, selected_type, selected_time, expected_conditions):
+def test_filter_conditions(selected_mac, selected_type, selected_time, expected_conditions):
+    conditions, parameters = clickhouse.filter_conditions(selected_mac, selected_type, selected_time)
+
+    if selected_time and selected_time != 'all':
+        assert conditions[-1] == "time >= {time_from:DateTime}"
+        assert isinstance(parameters.pop("time_from"), datetime)
+        conditions = conditions[:-1]
+    assert conditions == expected_conditions
+    if selected_mac and selected_mac != 'all':
+        assert parameters["mac"] == selected_mac
+    assert parameters.get("type") == selected_type
+
+
+def make_rows(*keys):
+    return [{"time": datetime.strptime(time, "%Y-%m-%d %H:%M:%S"), "mac": mac, "status": "online"}
+            for time, mac in keys]
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_page(mocker):
     mock_client = AsyncMock()
     mock_result = MagicMock()
-    mock_result.named_results.return_value = [{"dummy": "result"}]
+    mock_result.named_results.return_value = iter(make_rows(
+        ("2025-07-01 12:00:02", "00:11:22:33:44:55"),
+        ("2025-07-01 12:00:01", "00:11:22:33:44:56"),
+        ("2025-07-01 12:00:01", "00:11:22:33:44:55"),
+    ))
     mock_client.query.return_value = mock_result
-
     mocker.patch("clickhouse.init_client", return_value=mock_client)
 
-    result = await clickhouse.clickhouse_get(table_name, message_name, selected_mac, selected_type, selected_time)
+    rows, next_cursor = await clickhouse.clickhouse_get_page("intercom_life", "all", "life", "all", limit=2)
 
-    mock_client.query.assert_awaited_once()
     called_query = mock_client.query.call_args[0][0]
+    assert "SELECT notification_type, time, mac, status" in called_query
+    assert "notification_type = {type:String}" in called_query
+    assert mock_client.query.call_args.kwargs["parameters"] == {"type": "life"}
+    assert "ORDER BY time DESC, mac DESC, notification_type DESC, status DESC" in called_query
+    assert "LIMIT 3 OFFSET 0" in called_query
+    assert len(rows) == 2
+    assert clickhouse.decode_cursor(next_cursor) == (datetime(2025, 7, 1, 12, 0, 1), "00:11:22:33:44:56", 1)
 
-    assert f"FROM {table_name}" in called_query
 
-    for cond in expected_conditions:
-        assert cond in called_query
+@pytest.mark.asyncio
+async def test_clickhouse_get_page_continues_from_cursor(mocker):
+    mock_client = AsyncMock()
+    mock_result = MagicMock()
+    mock_result.named_results.return_value = iter(make_rows(
+        ("2025-07-01 12:00:01", "00:11:22:33:44:56"),
+        ("2025-07-01 12:00:01", "00:11:22:33:44:56"),
+        ("2025-07-01 12:00:00", "00:11:22:33:44:55"),
+    ))
+    mock_client.query.return_value = mock_result
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    cursor = clickhouse.encode_cursor("2025-07-01 12:00:01", "00:11:22:33:44:56", 1)
+
+    rows, next_cursor = await clickhouse.clickhouse_get_page("intercom_life", "all", None, "all", cursor, limit=2)
+
+    args, kwargs = mock_client.query.call_args
+    assert "time <= {cursor_time:DateTime}" in args[0]
+    assert "(time, mac) <= ({cursor_time:DateTime}, {cursor_mac:String})" in args[0]
+    assert "LIMIT 3 OFFSET 1" in args[0]
+    assert kwargs["parameters"] == {"cursor_time": datetime(2025, 7, 1, 12, 0, 1), "cursor_mac": "00:11:22:33:44:56"}
+    assert len(rows) == 2
+    assert clickhouse.decode_cursor(next_cursor) == (datetime(2025, 7, 1, 12, 0, 1), "00:11:22:33:44:56", 3)
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_page_last_page(mocker):
+    mock_client = AsyncMock()
+    mock_result = MagicMock()
+    mock_result.named_results.return_value = iter(make_rows(("2025-07-01 12:00:00", "00:11:22:33:44:55")))
+    mock_client.query.return_value = mock_result
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+
+    rows, next_cursor = await clickhouse.clickhouse_get_page("intercom_life", "all", None, "all", limit=2)
+
+    assert len(rows) == 1
+    assert next_cursor is None
+
+
+@pytest.mark.parametrize("selected_type, expected_tables", [
+    ("config", ["intercom_configs"]),
+    ("life", ["intercom_life"]),
+    (None, ["intercom_configs", "intercom_messages", "intercom_life", "management_commands"]),
+    ("unknown", []),
+])
+def test_plan_tables(selected_type, expected_tables):
+    assert clickhouse.plan_tables(selected_type) == expected_tables
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_notifications_queries_only_planned_tables(mocker):
+    mock_page = mocker.patch("clickhouse.clickhouse_get_page", new_callable=AsyncMock,
+                             return_value=([{"mac": "00:11:22:33:44:55"}], "next"))
+
+    results, next_cursor = await clickhouse.clickhouse_get_notifications("all", "message", "1h")
+
+    mock_page.assert_awaited_once_with("intercom_messages", "all", None, "1h", None, clickhouse.PAGE_SIZE)
+    assert results["intercom_messages"] == [{"mac": "00:11:22:33:44:55"}]
+    assert results["intercom_configs"] == []
+    assert clickhouse.decode_cursors(next_cursor) == {"intercom_messages": "next"}
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_notifications_keeps_cursor_per_table(mocker):
+    async def fake_page(table, mac, selected_type, selected_time, cursor, limit):
+        if table == "intercom_life":
+            return [{"table": table, "cursor": cursor}], "life-2"
+        return [{"table": table, "cursor": cursor}], None
+
+    mock_page = mocker.patch("clickhouse.clickhouse_get_page", side_effect=fake_page)
+    token = clickhouse.encode_cursors({"intercom_life": "life-1", "intercom_messages": "messages-1"})
+
+    results, next_cursor = await clickhouse.clickhouse_get_notifications("all", None, "all", token)
+
+    assert mock_page.await_count == 2
+    assert results["intercom_life"] == [{"table": "intercom_life", "cursor": "life-1"}]
+    assert results["intercom_messages"] == [{"table": "intercom_messages", "cursor": "messages-1"}]
+    assert results["intercom_configs"] == []
+    assert clickhouse.decode_cursors(next_cursor) == {"intercom_life": "life-2"}
 
-    if selected_time and selected_time != 'all':
-        assert "time >=" in called_query or "time >=" in called_query
 
-    assert result == mock_result.named_results()
+def test_decode_cursors_invalid():
+    with pytest.raises(ValueError):
+        clickhouse.decode_cursors(clickhouse.encode_cursors({"users": "x"}))
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_notifications_runs_concurrently(mocker):
+    running = 0
+    max_running = 0
+
+    async def fake_page(table, *args):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0)
+        running -= 1
+        return [{"table": table}], None
+
+    mocker.patch("clickhouse.clickhouse_get_page", side_effect=fake_page)
+
+    results, next_cursor = await clickhouse.clickhouse_get_notifications("all", None, "all")
+
+    assert max_running == 4
+    assert results["management_commands"] == [{"table": "management_commands"}]
+    assert next_cursor is None
+
+
+def test_decode_cursor_invalid():
+    with pytest.raises(ValueError):
+        clickhouse.decode_cursor("not-a-cursor")
 
 
 @pytest.mark.asyncio
@@ -212,3 +555,121 @@ async def test_clickhouse_tables(mocker):
     assert any("CREATE TABLE IF NOT EXISTS intercom_messages" in c for c in calls)
     assert any("CREATE TABLE IF NOT EXISTS intercom_life" in c for c in calls)
     assert any("CREATE TABLE IF NOT EXISTS management_commands" in c for c in calls)
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_device_stats(mocker):
+    life_result = MagicMock()
+    life_result.named_results.return_value = iter([
+        {"mac": "00:11:22:33:44:55", "heartbeats": 600, "failures": 1, "online_hours": 2,
+         "first_hour": datetime(2025, 7, 1, 10), "last_heartbeat": datetime(2025, 7, 1, 11, 59, 55)},
+    ])
+    messages_result = MagicMock()
+    messages_result.named_results.return_value = iter([
+        {"mac": "00:11:22:33:44:55", "events": 10, "calls": 3, "denied_keys": 1},
+        {"mac": "00:11:22:33:44:56", "events": 2, "calls": 0, "denied_keys": 2},
+    ])
+    mock_client = AsyncMock()
+    mock_client.query.side_effect = [life_result, messages_result]
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+
+    stats = await clickhouse.clickhouse_device_stats("all", datetime(2025, 7, 1, 8, 30), datetime(2025, 7, 1, 11, 30))
+
+    life_query, life_kwargs = mock_client.query.call_args_list[0].args[0], mock_client.query.call_args_list[0].kwargs
+    assert "FROM intercom_life_hourly" in life_query
+    assert "mac = {mac:String}" not in life_query
+    assert life_kwargs["parameters"]["range_from"] == datetime(2025, 7, 1, 8, 30)
+    assert "FROM intercom_events_hourly" in mock_client.query.call_args_list[1].args[0]
+
+    device = stats["devices"]["00:11:22:33:44:55"]
+    assert device["calls"] == 3
+    assert device["uptime"] == 0.5
+    assert stats["devices"]["00:11:22:33:44:56"]["heartbeats"] == 0
+    assert stats["fleet"]["devices"] == 2
+    assert stats["fleet"]["denied_keys"] == 3
+    assert stats["fleet"]["heartbeats"] == 600
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_get_page_uses_cache(mocker):
+    mock_client = AsyncMock()
+    mock_result = MagicMock()
+    mock_result.named_results.side_effect = lambda: iter(make_rows(("2025-07-01 12:00:00", "00:11:22:33:44:55")))
+    mock_client.query.return_value = mock_result
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+
+    first = await clickhouse.clickhouse_get_page("intercom_life", "00:11:22:33:44:55", None, "1h")
+    second = await clickhouse.clickhouse_get_page("intercom_life", "00:11:22:33:44:55", None, "1h")
+    assert first == second
+    assert mock_client.query.await_count == 1
+
+    clickhouse.query_cache.invalidate("intercom_life", {"00:11:22:33:44:55"})
+    await clickhouse.clickhouse_get_page("intercom_life", "00:11:22:33:44:55", None, "1h")
+    assert mock_client.query.await_count == 2
+    assert clickhouse.cache_stats()["hit_rate"] == 1 / 3
+
+
+def test_query_cache_invalidates_table_and_mac():
+    cache = clickhouse.QueryCache()
+    cache.put(("intercom_life", "00:11:22:33:44:55", None, "1h", None, 100), "mac")
+    cache.put(("intercom_life", "00:11:22:33:44:56", None, "1h", None, 100), "other mac")
+    cache.put(("intercom_life", "all", None, "1h", None, 100), "all")
+    cache.put(("intercom_messages", "00:11:22:33:44:55", None, "1h", None, 100), "other table")
+
+    cache.invalidate("intercom_life", {"00:11:22:33:44:55"})
+
+    assert cache.get(("intercom_life", "00:11:22:33:44:55", None, "1h", None, 100)) is None
+    assert cache.get(("intercom_life", "all", None, "1h", None, 100)) is None
+    assert cache.get(("intercom_life", "00:11:22:33:44:56", None, "1h", None, 100)) == "other mac"
+    assert cache.get(("intercom_messages", "00:11:22:33:44:55", None, "1h", None, 100)) == "other table"
+
+
+def test_query_cache_lru_and_ttl(mocker):
+    cache = clickhouse.QueryCache(max_size=2, ttl=5)
+    now = mocker.patch("clickhouse.monotonic", return_value=100.0)
+    cache.put(("intercom_life", "a", None, None, None, 1), 1)
+    cache.put(("intercom_life", "b", None, None, None, 1), 2)
+    cache.get(("intercom_life", "a", None, None, None, 1))
+    cache.put(("intercom_life", "c", None, None, None, 1), 3)
+
+    assert cache.get(("intercom_life", "b", None, None, None, 1)) is None
+    assert cache.get(("intercom_life", "a", None, None, None, 1)) == 1
+    assert cache.stats["evictions"] == 1
+
+    now.return_value = 106.0
+    assert cache.get(("intercom_life", "c", None, None, None, 1)) is None
+    assert ("intercom_life", "c") not in cache.index
+
+
+@pytest.mark.asyncio
+async def test_flush_invalidates_cache(mocker):
+    mocker.patch("clickhouse.init_client", return_value=mocker.AsyncMock())
+    mock_invalidate = mocker.patch.object(clickhouse.query_cache, "invalidate")
+    buffer = clickhouse.InsertBuffer('intercom_life')
+    buffer.add(["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"])
+
+    await buffer.flush()
+
+    mock_invalidate.assert_called_once_with("intercom_life", {"00:11:22:33:44:55"})
+
+
+@pytest.mark.asyncio
+async def test_clickhouse_export_streams_chunks(mocker):
+    stream = io.BytesIO(b"a" * 10)
+    mock_client = MagicMock()
+    mock_client.raw_stream = AsyncMock(return_value=stream)
+    mocker.patch("clickhouse.init_client", new_callable=AsyncMock, return_value=mock_client)
+    mocker.patch("clickhouse.EXPORT_CHUNK_SIZE", 4)
+
+    chunks = await clickhouse.clickhouse_export("intercom_life", "00:11:22:33:44:55", datetime(2025, 7, 1), None,
+                                                "parquet")
+    received = [chunk async for chunk in chunks]
+
+    assert received == [b"aaaa", b"aaaa", b"aa"]
+    assert stream.closed
+    query = mock_client.raw_stream.call_args.args[0]
+    assert "mac = {mac:String}" in query and "time >= {range_from:DateTime}" in query
+    assert "time <=" not in query
+    assert mock_client.raw_stream.call_args.kwargs["fmt"] == "Parquet"
+    assert mock_client.raw_stream.call_args.kwargs["parameters"] == {"mac": "00:11:22:33:44:55",
+                                                                      "range_from": datetime(2025, 7, 1)}
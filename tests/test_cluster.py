@@ -0,0 +1,151 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from aiomqtt import ProtocolVersion
+
+import cluster
+import ingest
+import notifications
+import state
+from tests.fake_broker import FakeBroker
+
+
+@pytest.fixture
+def fresh_state(mocker):
+    mocker.patch.object(state, "door_phones", state.Registry())
+    mocker.patch.object(state, "last_seen", {})
+    mocker.patch.object(state, "current_calls", {})
+    mocker.patch.object(notifications, "next_deadline", {"00:11:22:33:44:55": datetime(2025, 7, 1)})
+    mocker.patch.object(notifications, "offline", set())
+    mocker.patch("cluster.events.publish")
+
+
+def remote(op, data):
+    return json.dumps({"origin": "other", "op": op, "data": data})
+
+
+def test_shared_subscription_topics(mocker):
+    mocker.patch.object(ingest, "handlers", {"config": None, "life": None})
+    mocker.patch.object(ingest, "SHARE_GROUP", "notifications")
+    mock_client = mocker.patch("ingest.Client")
+
+    assert ingest.subscription_topics() == ["$share/notifications/intercom/+/config",
+                                            "$share/notifications/intercom/+/life"]
+    ingest.connect()
+    mock_client.assert_called_once_with("mqtt", protocol=ProtocolVersion.V5)
+
+
+@pytest.mark.asyncio
+async def test_shared_subscription_splits_messages(mocker):
+    broker = FakeBroker()
+    mocker.patch.object(ingest, "handlers", {"life": None})
+    mocker.patch.object(ingest, "SHARE_GROUP", "notifications")
+    replicas = [broker.client(), broker.client()]
+    for replica in replicas:
+        await replica.__aenter__()
+        await replica.subscribe([(topic, 0) for topic in ingest.subscription_topics()])
+
+    for i in range(4):
+        broker.deliver(f"intercom/00:11:22:33:44:5{i}/life", json.dumps({"status": "online"}))
+
+    assert [replica.queue.qsize() for replica in replicas] == [2, 2]
+
+
+def test_backend_replicates_local_changes(fresh_state):
+    backend = cluster.MqttBackend("g", replica_id="me")
+    backend.put_device(state.DoorPhone("00:11:22:33:44:55", {"location": "X1", "apartments": [1],
+                                                             "allowed_keys": [2]}))
+    backend.touch("00:11:22:33:44:55", datetime(2025, 7, 1, 12, 0, 0))
+    backend.touch("00:11:22:33:44:55", datetime(2025, 7, 1, 12, 0, 5))
+    backend.start_call("00:11:22:33:44:55", {"time": "2025-07-01 12:00:05", "apartment": "1", "location": "X1"})
+    backend.flush_touches()
+
+    sent = []
+    while not backend.outbox.empty():
+        sent.append(json.loads(backend.outbox.get_nowait()))
+    assert [message["op"] for message in sent] == ["put", "call-start", "touch"]
+    assert all(message["origin"] == "me" for message in sent)
+    # Пульсы одного домофона за интервал схлопываются в одно изменение
+    assert sent[2]["data"] == {"00:11:22:33:44:55": "2025-07-01T12:00:05"}
+    assert state.door_phones["00:11:22:33:44:55"].location == "X1"
+
+
+def test_backend_applies_remote_changes(fresh_state):
+    backend = cluster.MqttBackend("g", replica_id="me")
+    mac = "00:11:22:33:44:55"
+
+    backend.apply(remote("put", {"mac": mac, "config": {"location": "X1", "apartments": [1], "allowed_keys": [2],
+                                                        "active": True, "error": False}}))
+    backend.apply(remote("status", {"mac": mac, "active": False, "error": True}))
+    backend.apply(remote("touch", {mac: "2025-07-01T12:00:05"}))
+    backend.apply(remote("call-start", {"mac": mac, "call": {"apartment": "1"}}))
+
+    assert state.door_phones.errors == {mac}
+    assert state.last_seen[mac] == datetime(2025, 7, 1, 12, 0, 5)
+    # Срок пульса теперь отслеживает реплика, получившая его
+    assert mac not in notifications.next_deadline
+    assert state.current_calls == {mac: {"apartment": "1"}}
+    # Применённые изменения не рассылаются повторно
+    assert backend.outbox is None or backend.outbox.empty()
+
+    backend.apply(remote("call-end", {"mac": mac}))
+    backend.apply(remote("remove", {"mac": mac}))
+    assert state.current_calls == {}
+    assert mac not in state.door_phones
+    assert mac not in state.last_seen
+
+
+def test_backend_ignores_own_changes(fresh_state):
+    backend = cluster.MqttBackend("g", replica_id="me")
+    backend.apply(json.dumps({"origin": "me", "op": "remove", "data": {"mac": "00:11:22:33:44:55"}}))
+    assert backend.stats["received"] == 0
+
+
+def test_backend_answers_hello_with_sync(fresh_state):
+    backend = cluster.MqttBackend("g", replica_id="me")
+    state.door_phones.put(state.DoorPhone("00:11:22:33:44:55", {"location": "X1", "apartments": [1],
+                                                                "allowed_keys": [2]}))
+
+    backend.apply(remote("hello", None))
+    sync = json.loads(backend.outbox.get_nowait())
+    assert sync["op"] == "sync"
+
+    other = cluster.MqttBackend("g", replica_id="other")
+    state.door_phones.clear()
+    other.apply(json.dumps(sync))
+    assert state.door_phones["00:11:22:33:44:55"].apartments == (1,)
+
+
+@pytest.mark.asyncio
+async def test_backend_run_over_broker(fresh_state):
+    broker = FakeBroker()
+    observer = broker.client()
+    await observer.__aenter__()
+    await observer.subscribe(cluster.state_topic("g"))
+
+    backend = cluster.MqttBackend("g", replica_id="me", client_factory=broker.client)
+    task = asyncio.create_task(backend.run())
+    hello = json.loads((await asyncio.wait_for(observer.queue.get(), 1)).payload)
+    backend.end_call("00:11:22:33:44:55")
+    end = json.loads((await asyncio.wait_for(observer.queue.get(), 1)).payload)
+    task.cancel()
+
+    assert (hello["op"], end["op"]) == ("hello", "call-end")
+    assert backend.stats["sent"] == 2
+
+
+def test_backend_replicates_pending_commands(fresh_state, mocker):
+    tracker = mocker.patch("cluster.acks.tracker")
+    backend = cluster.MqttBackend("g", replica_id="me")
+
+    backend.command_sent("00:11:22:33:44:55", "abc", "open-door")
+    backend.command_resolved("00:11:22:33:44:55", "abc", "success")
+    sent = [json.loads(backend.outbox.get_nowait()) for _ in range(2)]
+    assert [message["op"] for message in sent] == ["command", "command-ack"]
+
+    backend.apply(remote("command", {"mac": "00:11:22:33:44:55", "command_id": "abc", "event": "open-door"}))
+    backend.apply(remote("command-ack", {"mac": "00:11:22:33:44:55", "command_id": "abc", "status": "fail"}))
+    tracker.add_remote.assert_called_once_with("00:11:22:33:44:55", "abc", "open-door")
+    tracker.resolve_remote.assert_called_once_with("00:11:22:33:44:55", "abc", "fail")
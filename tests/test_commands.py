@@ -0,0 +1,65 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import HTTPException
+
+import commands
+import state
+
+
+@pytest.fixture
+def fleet(mocker):
+    registry = state.Registry()
+    registry.put(state.DoorPhone("00:11:22:33:44:01", {"location": "X1", "apartments": [1, 2], "allowed_keys": []}))
+    registry.put(state.DoorPhone("00:11:22:33:44:02", {"location": "X1", "apartments": [3], "allowed_keys": []}))
+    registry.put(state.DoorPhone("00:11:22:33:44:03", {"location": "X2", "apartments": [1], "allowed_keys": []}))
+    mocker.patch.object(state, "door_phones", registry)
+
+
+def test_resolve_targets_merges_selectors(fleet):
+    command = commands.BulkCommand(location="X1", apartment="1", macs=["00:11:22:33:44:09"])
+
+    assert commands.resolve_targets(command) == ["00:11:22:33:44:01", "00:11:22:33:44:02", "00:11:22:33:44:03",
+                                                 "00:11:22:33:44:09"]
+
+
+@pytest.mark.asyncio
+async def test_bulk_command_publishes_concurrently_and_audits_once(mocker, fleet):
+    started = []
+
+    async def publish(topic, payload=None, qos=0):
+        started.append(topic)
+        # Ни одна публикация не завершается, пока не начаты все
+        while len(started) < 2:
+            await asyncio.sleep(0)
+        if "44:02" in topic:
+            raise TimeoutError()
+
+    mocker.patch("commands.publisher.publish", side_effect=publish)
+    mock_insert = mocker.patch("commands.clickhouse_insert_command_batch", new_callable=AsyncMock)
+
+    result = await commands.bulk_command(commands.BulkCommand(location="X1", macs=["00:11:22:33:44:09"]))
+
+    assert (result["total"], result["succeeded"], result["failed"]) == (3, 1, 2)
+    assert result["results"]["00:11:22:33:44:01"]["status"] == "success"
+    assert result["results"]["00:11:22:33:44:02"]["status"] == "fail"
+    assert result["results"]["00:11:22:33:44:09"] == {"status": "fail", "error": "Домофон не найден"}
+    mock_insert.assert_awaited_once()
+    rows = mock_insert.call_args.args[0]
+    assert [(mac, event, status) for _, mac, event, status in rows] == [
+        ("00:11:22:33:44:01", "open-door", "success"),
+        ("00:11:22:33:44:02", "open-door", "fail"),
+        ("00:11:22:33:44:09", "open-door", "fail"),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("command,status_code", [
+    (commands.BulkCommand(event="reboot", location="X1"), 400),
+    (commands.BulkCommand(location="nowhere"), 404),
+])
+async def test_bulk_command_rejects(fleet, command, status_code):
+    with pytest.raises(HTTPException) as error:
+        await commands.bulk_command(command)
+    assert error.value.status_code == status_code
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import events
+
+
+@pytest.fixture(autouse=True)
+def clean_subscribers(mocker):
+    mocker.patch.object(events, "subscribers", {})
+
+
+def parse(event):
+    kind, data = event.strip().split("\n")
+    return kind.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_publish_without_subscribers():
+    events.publish("calls", "call-start", {"mac": "00:11:22:33:44:55"})
+
+
+@pytest.mark.asyncio
+async def test_publish_reaches_channel_subscribers():
+    calls = events.subscribe("calls")
+    doorphones = events.subscribe("doorphones")
+
+    events.publish("calls", "call-start", {"mac": "00:11:22:33:44:55"})
+
+    assert parse(calls.get_nowait()) == ("call-start", {"mac": "00:11:22:33:44:55"})
+    assert doorphones.empty()
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_disconnected(mocker):
+    mocker.patch("events.SUBSCRIBER_QUEUE_SIZE", 2)
+    queue = events.subscribe("calls")
+
+    for i in range(3):
+        events.publish("calls", "call-end", {"mac": str(i)})
+
+    assert queue not in events.subscribers["calls"]
+    assert queue.get_nowait() is None
+
+
+@pytest.mark.asyncio
+async def test_stream_sends_snapshot_then_changes():
+    snapshot = {"00:11:22:33:44:55": {"time": "2025-07-01 12:00:00"}}
+    stream = events.stream("calls", lambda: snapshot, keepalive=0.01)
+
+    assert parse(await anext(stream)) == ("snapshot", snapshot)
+    assert await anext(stream) == ": keepalive\n\n"
+
+    events.publish("calls", "call-end", {"mac": "00:11:22:33:44:55"})
+    assert parse(await anext(stream)) == ("call-end", {"mac": "00:11:22:33:44:55"})
+
+    await stream.aclose()
+    assert events.subscribers["calls"] == set()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiomqtt import Topic
+
+import ingest
+
+
+def make_message(topic, payload):
+    message = MagicMock()
+    message.topic = Topic(topic)
+    message.payload = json.dumps(payload)
+    return message
+
+
+@pytest.fixture
+def handlers(mocker):
+    table = {"config": AsyncMock(), "message": AsyncMock(), "life": AsyncMock()}
+    mocker.patch.object(ingest, "handlers", table)
+    mocker.patch.object(ingest, "priorities", {"config": ingest.NORMAL, "message": ingest.HIGH, "life": ingest.LOW})
+    return table
+
+
+@pytest.fixture
+def ingest_queue(mocker):
+    queue = ingest.IngestQueue(workers=4, queue_size=2)
+    mocker.patch.object(ingest, "ingest_queue", queue)
+    return queue
+
+
+def test_subscription_topics(handlers):
+    assert ingest.subscription_topics() == ["intercom/+/config", "intercom/+/message", "intercom/+/life"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["config", "message", "life"])
+async def test_dispatch_routes_by_topic(handlers, kind):
+    mac = "AA:BB:CC:DD:EE:FF"
+    payload = {"time": "2025-07-01 12:00:00", "status": "online"}
+
+    await ingest.dispatch(make_message(f"intercom/{mac}/{kind}", payload))
+
+    handlers[kind].assert_awaited_once_with(mac, payload)
+    for other, handler in handlers.items():
+        if other != kind:
+            handler.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("topic", ["intercom/AA:BB:CC:DD:EE:FF/management", "intercom/life"])
+async def test_dispatch_ignores_unknown_topics(handlers, topic):
+    await ingest.dispatch(make_message(topic, {}))
+
+    for handler in handlers.values():
+        handler.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_listen_single_connection(mocker, handlers, ingest_queue):
+    messages = [
+        make_message("intercom/AA:BB:CC:DD:EE:FF/config", {"event": "added"}),
+        MagicMock(topic=Topic("intercom/AA:BB:CC:DD:EE:FF/life"), payload=b"not json"),
+        make_message("intercom/AA:BB:CC:DD:EE:FF/life", {"status": "online"}),
+    ]
+
+    async def stream():
+        for message in messages:
+            yield message
+        await ingest_queue.join()
+        raise asyncio.CancelledError()
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mock_client.messages.__aiter__.side_effect = stream
+    mock_client_class = mocker.patch("ingest.Client", return_value=mock_client)
+
+    with pytest.raises(asyncio.CancelledError):
+        await ingest.listen()
+
+    mock_client_class.assert_called_once_with("mqtt")
+    mock_client.subscribe.assert_awaited_once_with([
+        ("intercom/+/config", 0), ("intercom/+/message", 0), ("intercom/+/life", 0)
+    ])
+    handlers["config"].assert_awaited_once()
+    handlers["life"].assert_awaited_once_with("AA:BB:CC:DD:EE:FF", {"status": "online"})
+    assert ingest_queue.stats["processed"] == 2
+    assert ingest_queue.stats["errors"] == 1
+    assert ingest.PARSE_FAILURES.values[("life",)] >= 1
+    assert ingest.HANDLER_SECONDS.values[("config",)][2] >= 1
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_keeps_order_per_mac(handlers, ingest_queue):
+    seen = []
+
+    async def slow_life(mac, payload):
+        # Первое сообщение обрабатывается дольше остальных, но не обгоняется
+        if payload["n"] == 0:
+            await asyncio.sleep(0.01)
+        seen.append((mac, payload["n"]))
+
+    handlers["life"].side_effect = slow_life
+    workers = asyncio.create_task(ingest_queue.run())
+    for n in range(2):
+        for mac in ("AA:BB:CC:DD:EE:01", "AA:BB:CC:DD:EE:02"):
+            await ingest_queue.put(make_message(f"intercom/{mac}/life", {"n": n}))
+    await ingest_queue.join()
+    workers.cancel()
+
+    for mac in ("AA:BB:CC:DD:EE:01", "AA:BB:CC:DD:EE:02"):
+        assert [n for seen_mac, n in seen if seen_mac == mac] == [0, 1]
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_drop_policy(handlers):
+    queue = ingest.IngestQueue(workers=1, queue_size=1, policy="drop")
+    message = make_message("intercom/AA:BB:CC:DD:EE:FF/life", {"status": "online"})
+
+    await queue.put(message)
+    await queue.put(message)
+
+    assert queue.stats == {"received": 2, "processed": 0, "dropped": 1, "blocked": 0, "errors": 0}
+    assert queue.depth() == {"high": 0, "normal": 0, "low": 1}
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_block_policy_waits_for_worker(handlers):
+    queue = ingest.IngestQueue(workers=1, queue_size=1)
+    message = make_message("intercom/AA:BB:CC:DD:EE:FF/config", {"event": "added"})
+    await queue.put(message)
+
+    blocked = asyncio.create_task(queue.put(message))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+    assert queue.stats["blocked"] == 1
+
+    workers = asyncio.create_task(queue.run())
+    await blocked
+    await queue.join()
+    workers.cancel()
+    assert queue.stats["processed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_full_life_lane_does_not_block_calls(handlers):
+    queue = ingest.IngestQueue(workers=1, queue_size=2)
+    for n in range(5):
+        await asyncio.wait_for(queue.put(make_message("intercom/AA:BB:CC:DD:EE:FF/life", {"n": n})), 0.1)
+    await asyncio.wait_for(queue.put(make_message("intercom/AA:BB:CC:DD:EE:FF/message", {"event": "call-start"})),
+                           0.1)
+
+    assert queue.stats["dropped"] == 3
+    assert queue.depth() == {"high": 1, "normal": 0, "low": 2}
+
+    seen = []
+    handlers["life"].side_effect = lambda mac, payload: seen.append(payload["n"])
+    handlers["message"].side_effect = lambda mac, payload: seen.append(payload["event"])
+    workers = asyncio.create_task(queue.run())
+    await queue.join()
+    workers.cancel()
+    # Вызов обрабатывается первым, из пульсов остались самые свежие
+    assert seen == ["call-start", 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_serves_high_priority_first(handlers):
+    queue = ingest.IngestQueue(workers=1, queue_size=100)
+    seen = []
+    handlers["life"].side_effect = lambda mac, payload: seen.append("life")
+    handlers["message"].side_effect = lambda mac, payload: seen.append("message")
+
+    for _ in range(5):
+        await queue.put(make_message("intercom/AA:BB:CC:DD:EE:FF/life", {"status": "online"}))
+    await queue.put(make_message("intercom/AA:BB:CC:DD:EE:FF/message", {"event": "call-start"}))
+
+    workers = asyncio.create_task(queue.run())
+    await queue.join()
+    workers.cancel()
+
+    assert seen == ["message"] + ["life"] * 5
+    latency = queue.latency_stats()
+    assert latency["high"]["count"] == 1
+    assert latency["low"]["count"] == 5
+    assert latency["high"]["p99"] <= latency["low"]["p99"]
+
+
+def test_percentile():
+    assert ingest.percentile([], 0.5) == 0.0
+    assert ingest.percentile([3, 1, 2, 4], 0.5) == 3
+    assert ingest.percentile([3, 1, 2, 4], 0.99) == 4
@@ -0,0 +1,79 @@
+import io
+import json
+import logging
+import queue
+
+import logs
+
+
+def make_record(level=logging.INFO, **extra):
+    record = logging.LogRecord("test", level, __file__, 1, "heartbeat %s", ("AA",), None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def test_sampling_filter_rate_limits_heartbeats_per_mac(mocker):
+    clock = mocker.patch("logs.monotonic", return_value=100.0)
+    sampler = logs.SamplingFilter(rate_limits={"life": 60}, sample_rates={})
+
+    assert sampler.filter(make_record(kind="life", mac="AA")) is True
+    assert sampler.filter(make_record(kind="life", mac="AA")) is False
+    assert sampler.filter(make_record(kind="life", mac="AA")) is False
+    assert sampler.filter(make_record(kind="life", mac="BB")) is True
+
+    clock.return_value = 161.0
+    record = make_record(kind="life", mac="AA")
+    assert sampler.filter(record) is True
+    assert record.suppressed == 2
+    assert sampler.suppressed == 2
+
+
+def test_sampling_filter_always_passes_errors_and_transitions():
+    sampler = logs.SamplingFilter(rate_limits={"life": 60}, sample_rates={})
+    sampler.filter(make_record(kind="life", mac="AA"))
+
+    assert sampler.filter(make_record(logging.ERROR, kind="life", mac="AA")) is True
+    assert sampler.filter(make_record(kind="life", mac="AA", transition=True)) is True
+    assert sampler.filter(make_record(kind="config", mac="AA")) is True
+
+
+def test_structured_formatter():
+    record = make_record(mac="AA", kind="life")
+    entry = json.loads(logs.StructuredFormatter().format(record))
+
+    assert entry["message"] == "heartbeat AA"
+    assert entry["level"] == "INFO"
+    assert entry["mac"] == "AA"
+    assert entry["kind"] == "life"
+    assert "transition" not in entry
+
+
+def test_setup_logging_writes_through_listener():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    previous = list(root.handlers)
+    pipeline = logs.setup_logging(stream=stream)
+    try:
+        logging.getLogger("test").warning("door %s opened", "AA", extra={"mac": "AA"})
+    finally:
+        pipeline.stop()
+
+    entry = json.loads(stream.getvalue().splitlines()[-1])
+    assert entry["message"] == "door AA opened"
+    assert entry["mac"] == "AA"
+    assert root.handlers == previous
+
+
+def test_deferred_handler_renders_mutable_args():
+    handler = logs.DeferredQueueHandler(queue.Queue())
+    calls = {"00:11:22:33:44:55": {"apartment": "1"}}
+    deferred = logging.LogRecord("call", logging.INFO, __file__, 1, "call from %s at %s", ("X1", 5), None)
+    mutable = logging.LogRecord("call", logging.INFO, __file__, 1, "call start - %s", (calls,), None)
+
+    handler.handle(deferred)
+    handler.handle(mutable)
+    calls.clear()
+
+    assert deferred.args == ("X1", 5)
+    assert mutable.getMessage() == "call start - {'00:11:22:33:44:55': {'apartment': '1'}}"
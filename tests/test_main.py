@@ -1,12 +1,13 @@
 import pytest
 import asyncio
 import json
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock
 
 from fastapi import HTTPException
 from starlette.responses import RedirectResponse
 
 import main
+from datetime import datetime
 
 from fastapi.testclient import TestClient
 import state
@@ -18,27 +19,13 @@ import state
     ({"location": "Hall", "apartments": [101]}, "added", None, True),
     (None, "deleted", {"location": "Hall2", "apartments": [103]}, False),
 ])
-async def test_listen_for_configs_added_once(mocker, config, event, old_config, reconnect):
+async def test_handle_config(mocker, config, event, old_config, reconnect):
     mac = "AA:BB:CC:DD:EE:FF"
     payload = {
         "event": event,
         "new_config": config,
         "old_config": old_config,
     }
-    fake_message = MagicMock()
-    fake_message.topic = f"intercom/{mac}/config"
-    fake_message.payload = json.dumps(payload)
-
-    mock_client = AsyncMock()
-    mock_client.__aenter__.return_value = mock_client
-    mock_client.subscribe = AsyncMock()
-
-    async def single_message():
-        yield fake_message
-        raise asyncio.CancelledError()
-
-    mock_client.messages.__aiter__.side_effect = single_message
-    mocker.patch("main.Client", return_value=mock_client)
 
     if reconnect:
         reconnect_value = "connect"
@@ -50,10 +37,8 @@ async def test_listen_for_configs_added_once(mocker, config, event, old_config,
     mock_remove = mocker.patch("main.remove", new_callable=AsyncMock)
     mock_clickhouse = mocker.patch("main.json_config_to_clickhouse", new_callable=AsyncMock)
 
-    with pytest.raises(asyncio.CancelledError):
-        await main.listen_for_configs()
+    await main.handle_config(mac, payload)
 
-    mock_client.subscribe.assert_awaited_once_with("intercom/+/config")
     if config:
         mock_add_or_update.assert_awaited_once_with(mac, config)
         mock_remove.assert_not_called()
@@ -63,12 +48,37 @@ async def test_listen_for_configs_added_once(mocker, config, event, old_config,
     mock_clickhouse.assert_awaited_once_with(mac, payload, clickhouse_reconnect)
 
 
+@pytest.mark.asyncio
+async def test_handle_config_empty_payload(mocker):
+    mock_clickhouse = mocker.patch("main.json_config_to_clickhouse", new_callable=AsyncMock)
+
+    await main.handle_config("AA:BB:CC:DD:EE:FF", "")
+
+    mock_clickhouse.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_config_life_timeout(mocker):
+    mocker.patch("main.add_or_update", new_callable=AsyncMock, return_value="new/mod")
+    mocker.patch("main.json_config_to_clickhouse", new_callable=AsyncMock)
+    mock_timeout = mocker.patch("main.set_life_timeout")
+    payload = {"event": "added", "new_config": {"location": "Hall", "apartments": [101], "life_timeout": 30}}
+
+    await main.handle_config("AA:BB:CC:DD:EE:FF", payload)
+
+    mock_timeout.assert_called_once_with("AA:BB:CC:DD:EE:FF", 30)
+
+
+def test_config_handler_registered():
+    assert main.ingest.handlers["config"] is main.handle_config
+
+
 client = TestClient(main.app)
 
 
 def test_main_page(mocker):
-    mocker.patch.object(state, "door_phones",
-                        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}})
+    mocker.patch.object(state, "door_phones", state.Registry.load(
+        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}}))
     response = client.get("/")
 
     assert response.status_code == 200
@@ -76,28 +86,50 @@ def test_main_page(mocker):
 
 
 def test_main_notifications(mocker):
-    mocker.patch("main.clickhouse_get", new_callable=AsyncMock, side_effect=[
-        [{"config": "c"}], [{"message": "m"}], [{"life": "l"}], [{"command": "cmd"}]
-    ])
-
-    mocker.patch.object(state, "door_phones",
-                        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}})
+    mock_get = mocker.patch("main.clickhouse_get_notifications", new_callable=AsyncMock)
+    mocker.patch.object(state, "door_phones", state.Registry.load(
+        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}}))
 
     response = client.get("/notifications?mac=AA:BB:CC:DD:EE:FF&type=config&time=1h")
 
     assert response.status_code == 200
     html = response.text
-    assert "notifications.html" not in html
     assert "00:11:22:33:44:55" in html
-    assert "config" in html or "command" in html
+    assert "/api/notifications/page" in html
+    # Оболочка страницы не ждёт Clickhouse
+    mock_get.assert_not_called()
 
 
-def test_main_notifications_empty_data(mocker):
-    mocker.patch("main.clickhouse_get", new_callable=AsyncMock, return_value=[])
-    mocker.patch.object(state, "door_phones", {})
-    response = client.get("/notifications")
+def test_notifications_page_json(mocker):
+    row = {"notification_type": "life", "time": datetime(2025, 7, 1, 12, 0, 0), "mac": "00:11:22:33:44:55",
+           "status": "online"}
+    mock_get = mocker.patch("main.clickhouse_get_notifications", new_callable=AsyncMock, return_value=(
+        {"intercom_configs": [], "intercom_messages": [], "intercom_life": [row] * 30, "management_commands": []},
+        "next"
+    ))
+
+    response = client.get("/api/notifications/page?type=life&limit=10000", headers={"Accept-Encoding": "gzip"})
 
     assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"].startswith("private")
+    page = response.json()
+    assert page["next"] == "next"
+    assert page["tables"] == {"intercom_life": {
+        "columns": ["notification_type", "time", "mac", "status"],
+        "rows": [["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"]] * 30}}
+    assert mock_get.call_args.args == ("all", "life", "all", None, main.PAGE_MAX_SIZE)
+
+    cached = client.get("/api/notifications/page?type=life", headers={"If-None-Match": response.headers["etag"]})
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+
+def test_notifications_page_bad_cursor(mocker):
+    mocker.patch("main.clickhouse_get_notifications", new_callable=AsyncMock, side_effect=ValueError("Invalid cursor"))
+    response = client.get("/api/notifications/page?cursor=broken")
+
+    assert response.status_code == 400
 
 
 @pytest.mark.asyncio
@@ -106,12 +138,7 @@ async def test_open_door(mocker):
 
     mock_insert = mocker.patch("main.clickhouse_insert_commands", new_callable=AsyncMock)
 
-    mock_publish = AsyncMock()
-    mock_client_instance = MagicMock()
-    mock_client_instance.publish = mock_publish
-    mock_client = MagicMock()
-    mock_client.__aenter__.return_value = mock_client_instance
-    mocker.patch("main.Client", return_value=mock_client)
+    mock_publish = mocker.patch("main.publisher.publish", new_callable=AsyncMock)
 
     response = await main.open_door(mac)
 
@@ -125,6 +152,7 @@ async def test_open_door(mocker):
     args, kwargs = mock_publish.call_args
     payload_json = json.loads(kwargs["payload"])
     assert payload_json["event"] == "open-door"
+    assert (mac, payload_json["command_id"]) in main.acks.tracker.pending
     assert kwargs["qos"] == 1
     assert args[0] == f"intercom/{mac}/management"
 
@@ -135,17 +163,12 @@ async def test_open_door(mocker):
 ])
 @pytest.mark.asyncio
 async def test_delete_old_intercom(mocker, mac, exist):
-    mocker.patch.object(state, "door_phones",
-                        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}})
+    mocker.patch.object(state, "door_phones", state.Registry.load(
+        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}}))
 
     mock_insert = mocker.patch("main.clickhouse_insert_commands", new_callable=AsyncMock)
 
-    mock_publish = AsyncMock()
-    mock_client_instance = MagicMock()
-    mock_client_instance.publish = mock_publish
-    mock_client = MagicMock()
-    mock_client.__aenter__.return_value = mock_client_instance
-    mocker.patch("main.Client", return_value=mock_client)
+    mock_publish = mocker.patch("main.publisher.publish", new_callable=AsyncMock)
 
     mock_full_remove = mocker.patch("state.full_remove")
 
@@ -183,10 +206,86 @@ async def test_delete_old_intercom(mocker, mac, exist):
         assert status == "fail"
 
 
+@pytest.mark.asyncio
+async def test_delete_old_intercom_mqtt_unavailable(mocker):
+    mac = "00:11:22:33:44:55"
+    mocker.patch.object(state, "door_phones", state.Registry.load(
+        {mac: {"location": "X1", "apartments": [1], "allowed_keys": [2]}}))
+    mocker.patch("state.full_remove")
+    mock_insert = mocker.patch("main.clickhouse_insert_commands", new_callable=AsyncMock)
+    mocker.patch("main.publisher.publish", new_callable=AsyncMock, side_effect=asyncio.TimeoutError())
+
+    with pytest.raises(HTTPException) as exc_info:
+        await main.delete_old_intercom(mac)
+
+    assert exc_info.value.status_code == 503
+    _, _, event, status = mock_insert.call_args.args
+    assert (event, status) == ("mac-info-delete", "fail")
+
+
 @pytest.mark.asyncio
 async def test_doorphones_data(mocker):
-    mocker.patch.object(state, "door_phones",
-                        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}})
+    mocker.patch.object(state, "door_phones", state.Registry.load(
+        {"00:11:22:33:44:55": {"location": "X1", "apartments": [1], "allowed_keys": [2]}}))
     response = await main.doorphones_data()
     assert isinstance(response, dict)
     assert response["00:11:22:33:44:55"]["location"] == "X1"
+
+
+def test_clickhouse_stats(mocker):
+    mocker.patch("main.buffer_stats", return_value={"intercom_life": {"flushes": 2, "pending": 0}})
+    response = client.get("/api/clickhouse/stats")
+
+    assert response.status_code == 200
+    assert response.json()["buffers"]["intercom_life"]["flushes"] == 2
+
+
+def test_notifications_stats(mocker):
+    mock_stats = mocker.patch("main.clickhouse_device_stats", new_callable=AsyncMock,
+                              return_value={"fleet": {"devices": 1}, "devices": {}})
+
+    response = client.get("/notifications/stats?mac=00:11:22:33:44:55&from=2025-07-01T00:00:00&to=2025-07-02T00:00:00")
+
+    assert response.status_code == 200
+    assert response.json()["fleet"]["devices"] == 1
+    mock_stats.assert_awaited_once_with("00:11:22:33:44:55", datetime(2025, 7, 1), datetime(2025, 7, 2))
+
+
+def test_notifications_stats_bad_range():
+    response = client.get("/notifications/stats?from=yesterday")
+
+    assert response.status_code == 400
+
+
+def test_metrics_endpoint():
+    client.get("/api/mqtt/stats")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert '# TYPE http_request_seconds histogram' in response.text
+    assert 'http_request_seconds_count{method="GET",route="/api/mqtt/stats",status="200"}' in response.text
+    assert 'state_entries{structure="door_phones"}' in response.text
+
+
+def test_notifications_export(mocker):
+    async def chunks():
+        yield b"time,mac\n"
+        yield b"2025-07-01 12:00:00,00:11:22:33:44:55\n"
+
+    mock_export = mocker.patch("main.clickhouse_export", new_callable=AsyncMock, return_value=chunks())
+
+    response = client.get("/notifications/export?type=life&mac=00:11:22:33:44:55&from=2025-07-01T00:00:00"
+                          "&to=2025-07-02T00:00:00")
+
+    assert response.status_code == 200
+    assert response.text == "time,mac\n2025-07-01 12:00:00,00:11:22:33:44:55\n"
+    assert response.headers["content-type"].startswith("text/csv")
+    assert 'filename="intercom_life.csv"' in response.headers["content-disposition"]
+    mock_export.assert_awaited_once_with("intercom_life", "00:11:22:33:44:55", datetime(2025, 7, 1),
+                                         datetime(2025, 7, 2), "csv")
+
+
+@pytest.mark.parametrize("query", ["type=&format=csv", "type=life&format=xlsx", "type=life&from=yesterday"])
+def test_notifications_export_rejects(query):
+    assert client.get(f"/notifications/export?{query}").status_code == 400
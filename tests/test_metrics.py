@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry(mocker):
+    table = []
+    mocker.patch.object(metrics, "registry", table)
+    return table
+
+
+def test_counter_and_gauge_render(registry):
+    counter = metrics.Counter("messages_total", "Messages", ["kind"])
+    counter.inc("life")
+    counter.inc("life")
+    counter.inc('we"ird')
+    metrics.Gauge("entries", "Entries", ["structure"], function=lambda: {"door_phones": 3})
+
+    assert metrics.render() == (
+        '# HELP messages_total Messages\n'
+        '# TYPE messages_total counter\n'
+        'messages_total{kind="life"} 2.0\n'
+        'messages_total{kind="we\\"ird"} 1.0\n'
+        '# HELP entries Entries\n'
+        '# TYPE entries gauge\n'
+        'entries{structure="door_phones"} 3.0\n'
+    )
+
+
+def test_histogram_render(registry):
+    histogram = metrics.Histogram("latency_seconds", "Latency", ["table"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, "life")
+    histogram.observe(0.1, "life")
+    histogram.observe(5, "life")
+
+    lines = metrics.render().splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{table="life",le="0.1"} 2',
+        'latency_seconds_bucket{table="life",le="1.0"} 2',
+        'latency_seconds_bucket{table="life",le="+Inf"} 3',
+        'latency_seconds_sum{table="life"} 5.15',
+        'latency_seconds_count{table="life"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_monitor_event_loop(mocker):
+    mocker.patch.object(metrics, "LOOP_LAG", metrics.Gauge("lag", "Lag"))
+    task = asyncio.create_task(metrics.monitor_event_loop(0.001))
+    await asyncio.sleep(0.01)
+    task.cancel()
+
+    assert metrics.LOOP_LAG.values[()] >= 0.0
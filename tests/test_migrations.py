@@ -0,0 +1,86 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import clickhouse
+import migrations
+
+
+def make_client(applied):
+    mock_client = AsyncMock()
+    mock_result = MagicMock()
+    mock_result.result_rows = [(version,) for version in applied]
+    mock_client.query.return_value = mock_result
+    return mock_client
+
+
+@pytest.mark.asyncio
+async def test_migrate_applies_pending_versions(mocker):
+    mock_client = make_client([1])
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+    mock_tables = mocker.patch("clickhouse.clickhouse_tables", new_callable=AsyncMock)
+
+    await migrations.migrate()
+
+    mock_tables.assert_not_called()
+    commands = [call.args[0] for call in mock_client.command.await_args_list]
+    assert "CREATE TABLE IF NOT EXISTS schema_migrations" in commands[0]
+    for table in ("intercom_configs", "intercom_messages", "intercom_life", "management_commands"):
+        assert f"EXCHANGE TABLES {table} AND {table}_new" in commands
+    create_life = next(c for c in commands if c.startswith("CREATE TABLE intercom_life_new"))
+    assert "ORDER BY (mac, time)" in create_life
+    assert "PARTITION BY toYYYYMM(time)" in create_life
+    assert "LowCardinality" in create_life
+
+    assert any("CREATE MATERIALIZED VIEW IF NOT EXISTS intercom_life_hourly_mv" in c for c in commands)
+    assert any("CREATE MATERIALIZED VIEW IF NOT EXISTS intercom_events_hourly_mv" in c for c in commands)
+    assert "INSERT INTO intercom_life_hourly" in commands[commands.index("TRUNCATE TABLE intercom_life_hourly") + 1]
+
+    recorded = [call.args[1][0][0] for call in mock_client.insert.await_args_list]
+    assert recorded == [version for version, _, _ in migrations.MIGRATIONS if version != 1]
+    assert clickhouse.schema_ready is True
+
+
+@pytest.mark.asyncio
+async def test_migrate_is_idempotent(mocker):
+    mock_client = make_client([version for version, _, _ in migrations.MIGRATIONS])
+    mocker.patch("clickhouse.init_client", return_value=mock_client)
+
+    await migrations.migrate()
+
+    assert mock_client.command.await_count == 1
+    mock_client.insert.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_migrate_retries_until_clickhouse_is_up(mocker):
+    mock_client = make_client([version for version, _, _ in migrations.MIGRATIONS])
+    mock_init = mocker.patch("clickhouse.init_client", side_effect=[Exception("clickhouse is down"),
+                                                                   Exception("clickhouse is down"), mock_client])
+    readiness = []
+
+    async def sleep(delay):
+        readiness.append((delay, clickhouse.schema_ready))
+
+    mocker.patch("migrations.asyncio.sleep", side_effect=sleep)
+
+    await migrations.migrate()
+
+    assert mock_init.call_count == 3
+    # Пока схема не готова, буферы остаются на паузе
+    assert readiness == [(1.0, False), (2.0, False)]
+    assert clickhouse.schema_ready is True
+
+
+@pytest.mark.asyncio
+async def test_rebuild_table_copies_stored_columns():
+    mock_client = AsyncMock()
+
+    await migrations.rebuild_table(mock_client, "intercom_life", "time DateTime", "ENGINE = MergeTree() ORDER BY time",
+                                    migrations.V2_COLUMNS["intercom_life"])
+
+    commands = [call.args[0] for call in mock_client.command.await_args_list]
+    assert commands[0] == "DROP TABLE IF EXISTS intercom_life_new"
+    assert commands[2] == ("INSERT INTO intercom_life_new (notification_type, time, mac, status) "
+                           "SELECT notification_type, time, mac, status FROM intercom_life")
+    assert commands[-1] == "DROP TABLE IF EXISTS intercom_life_new"
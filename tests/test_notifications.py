@@ -2,8 +2,7 @@ from datetime import datetime, timedelta
 
 import pytest
 import asyncio
-import json
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock
 
 import notifications
 import state
@@ -15,7 +14,7 @@ import state
     ("call-end", True),
     ("open-door", False),
 ])
-async def test_listen_for_notifications(mocker, event_type, should_call_handler):
+async def test_handle_message(mocker, event_type, should_call_handler):
     mac = "AA:BB:CC:DD:EE:FF"
     payload = {
         "time": "2025-07-01 12:00:00",
@@ -26,28 +25,11 @@ async def test_listen_for_notifications(mocker, event_type, should_call_handler)
         "location": "Hall"
     }
 
-    fake_message = MagicMock()
-    fake_message.topic = f"intercom/{mac}/message"
-    fake_message.payload = json.dumps(payload)
-
-    mock_client = AsyncMock()
-    mock_client.__aenter__.return_value = mock_client
-    mock_client.subscribe = AsyncMock()
-
-    async def single_message():
-        yield fake_message
-        raise asyncio.CancelledError()
-
-    mock_client.messages.__aiter__.side_effect = single_message
-    mocker.patch("notifications.Client", return_value=mock_client)
-
     mock_call_handler = mocker.patch("notifications.call.call_handler", new_callable=AsyncMock)
     mock_ch_insert = mocker.patch("notifications.clickhouse_insert_message", new_callable=AsyncMock)
 
-    with pytest.raises(asyncio.CancelledError):
-        await notifications.listen_for_notifications()
+    await notifications.handle_message(mac, payload)
 
-    mock_client.subscribe.assert_awaited_once_with("intercom/+/message")
     mock_ch_insert.assert_awaited_once_with(
         payload["time"], mac, payload["event"], payload["status"],
         payload["door_status"], payload.get("reason"), payload.get("key"),
@@ -71,7 +53,7 @@ async def test_listen_for_notifications(mocker, event_type, should_call_handler)
         ("deleted", True,  False),  # удалённое сообщение → должно удалиться из last_seen
     ]
 )
-async def test_get_life_parametrized(mocker, status, init_last_seen, expect_in_last_seen):
+async def test_handle_life(mocker, status, init_last_seen, expect_in_last_seen):
     mac = "AA:BB:CC:DD:EE:FF"
     time_str = "2025-07-01 12:00:00"
 
@@ -80,23 +62,9 @@ async def test_get_life_parametrized(mocker, status, init_last_seen, expect_in_l
         state.last_seen[mac] = datetime.now()
 
     payload = {"time": time_str, "status": status}
-    fake_message = MagicMock()
-    fake_message.topic = f"intercom/{mac}/life"
-    fake_message.payload = json.dumps(payload)
-
-    async def single_message():
-        yield fake_message
-        raise asyncio.CancelledError()
-
-    mock_client = AsyncMock()
-    mock_client.__aenter__.return_value = mock_client
-    mock_client.messages.__aiter__.side_effect = single_message
-    mocker.patch("notifications.Client", return_value=mock_client)
-
     mock_ch = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
 
-    with pytest.raises(asyncio.CancelledError):
-        await notifications.get_life()
+    await notifications.handle_life(mac, payload)
 
     if expect_in_last_seen:
         assert mac in state.last_seen
@@ -106,32 +74,196 @@ async def test_get_life_parametrized(mocker, status, init_last_seen, expect_in_l
     mock_ch.assert_awaited_once_with(time_str, mac, status)
 
 
-@pytest.mark.asyncio
-async def test_check_life_status_detects_stale_and_records(mocker):
-    mac = "AA:BB:CC:DD:EE:FF"
+def test_handlers_registered():
+    assert notifications.ingest.handlers["message"] is notifications.handle_message
+    assert notifications.ingest.handlers["life"] is notifications.handle_life
 
-    state.last_seen.clear()
-    state.last_seen[mac] = datetime.now() - timedelta(seconds=20)
 
+@pytest.fixture
+def tracker(mocker):
+    mocker.patch.object(notifications, "deadlines", [])
+    mocker.patch.object(notifications, "next_deadline", {})
+    mocker.patch.object(notifications, "offline", set())
+    mocker.patch.object(notifications, "life_timeouts", {})
+    mocker.patch.object(notifications, "wakeup", None)
+    state.last_seen.clear()
     state.door_phones.clear()
-    state.door_phones[mac] = {"active": True}
 
-    async def dummy_sleep(seconds):
-        dummy_sleep.count += 1
-        if dummy_sleep.count > 1:
-            raise asyncio.CancelledError()
-    dummy_sleep.count = 0
-    mocker.patch("notifications.asyncio.sleep", dummy_sleep)
+
+@pytest.mark.asyncio
+async def test_expire_deadlines_records_transition_once(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    state.last_seen[mac] = now
+    state.door_phones.put(state.DoorPhone(mac, {"location": "X1", "apartments": [1], "allowed_keys": [2]}))
+    await notifications.track_heartbeat(mac, now)
 
     mock_remove = mocker.patch("notifications.state.remove", new_callable=AsyncMock)
     mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
 
-    with pytest.raises(asyncio.CancelledError):
-        await notifications.check_life_status()
+    await notifications.expire_deadlines(now + timedelta(seconds=11))
+    mock_ch_life.assert_not_called()
 
-    mock_remove.assert_awaited_once_with(mac, error=True)
+    await notifications.expire_deadlines(now + timedelta(seconds=12))
+    await notifications.expire_deadlines(now + timedelta(seconds=60))
 
+    mock_remove.assert_awaited_once_with(mac, error=True)
     mock_ch_life.assert_awaited_once()
     args = mock_ch_life.call_args.args
     assert args[1] == mac
     assert args[2] == "fail"
+    assert mac in notifications.offline
+    assert notifications.deadlines == []
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_pushes_deadline_forward(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    state.last_seen[mac] = now
+    await notifications.track_heartbeat(mac, now)
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    state.last_seen[mac] = now + timedelta(seconds=10)
+    await notifications.track_heartbeat(mac, state.last_seen[mac])
+    assert len(notifications.deadlines) == 1
+
+    await notifications.expire_deadlines(now + timedelta(seconds=15))
+
+    mock_ch_life.assert_not_called()
+    assert notifications.deadlines == [(now + timedelta(seconds=22), mac)]
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_after_fail_records_restore(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    notifications.offline.add(mac)
+    state.last_seen[mac] = now
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    await notifications.track_heartbeat(mac, now)
+    await notifications.track_heartbeat(mac, now)
+
+    mock_ch_life.assert_awaited_once_with("2025-07-01 12:00:00", mac, "restored")
+    assert mac not in notifications.offline
+    assert mac in notifications.next_deadline
+
+
+@pytest.mark.asyncio
+async def test_per_device_timeout(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    state.last_seen[mac] = now
+    notifications.set_life_timeout(mac, 60)
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    await notifications.expire_deadlines(now + timedelta(seconds=30))
+    mock_ch_life.assert_not_called()
+
+    await notifications.expire_deadlines(now + timedelta(seconds=60))
+    assert mock_ch_life.call_args.args[2] == "fail"
+
+
+@pytest.mark.asyncio
+async def test_changing_timeout_of_tracked_device_fails_once(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    state.last_seen[mac] = now
+    await notifications.track_heartbeat(mac, now)
+    notifications.set_life_timeout(mac, 20)
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    await notifications.expire_deadlines(now + timedelta(seconds=15))
+    mock_ch_life.assert_not_called()
+
+    await notifications.expire_deadlines(now + timedelta(seconds=100))
+
+    mock_ch_life.assert_awaited_once()
+    assert mock_ch_life.call_args.args[2] == "fail"
+    assert notifications.deadlines == []
+
+
+@pytest.mark.asyncio
+async def test_removed_device_is_dropped(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    now = datetime(2025, 7, 1, 12, 0, 0)
+    state.last_seen[mac] = now
+    await notifications.track_heartbeat(mac, now)
+    state.full_remove(mac)
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    await notifications.expire_deadlines(now + timedelta(seconds=60))
+
+    mock_ch_life.assert_not_called()
+    assert mac not in notifications.next_deadline
+
+
+@pytest.mark.asyncio
+async def test_check_life_status_fires_at_deadline(mocker, tracker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mocker.patch("notifications.LIFE_TIMEOUT", 0.05)
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    task = asyncio.create_task(notifications.check_life_status())
+    await asyncio.sleep(0)
+    state.last_seen[mac] = datetime.now()
+    await notifications.track_heartbeat(mac, state.last_seen[mac])
+    await asyncio.sleep(0.2)
+    task.cancel()
+
+    mock_ch_life.assert_awaited_once()
+    assert mock_ch_life.call_args.args[2] == "fail"
+
+
+@pytest.fixture
+def compact(mocker, tracker):
+    mocker.patch.object(notifications, "LIFE_MODE", "compact")
+    mocker.patch.object(notifications, "summaries", {})
+    mocker.patch.object(notifications, "life_status", {})
+    mocker.patch.object(state, "door_phones", state.Registry())
+
+
+@pytest.mark.asyncio
+async def test_compact_life_writes_transitions_and_summary(mocker, compact):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+    mock_summary = mocker.patch("notifications.clickhouse_insert_life_summary", new_callable=AsyncMock)
+    clock = mocker.patch("notifications.datetime")
+    times = [datetime(2025, 7, 1, 12, 0, 0), datetime(2025, 7, 1, 12, 0, 5), datetime(2025, 7, 1, 12, 0, 15)]
+
+    for now in times:
+        clock.now.return_value = now
+        await notifications.handle_life(mac, {"time": now.strftime("%Y-%m-%d %H:%M:%S"), "status": "online"})
+
+    # Только первый пульс меняет статус
+    mock_ch_life.assert_awaited_once_with("2025-07-01 12:00:00", mac, "online")
+
+    await notifications.flush_life_summaries(datetime(2025, 7, 1, 12, 5, 0))
+    mock_summary.assert_awaited_once_with(datetime(2025, 7, 1, 12, 5, 0), mac, 3, 1, times[0], times[2], 10.0)
+    assert notifications.summaries == {}
+
+
+@pytest.mark.asyncio
+async def test_compact_life_records_heartbeat_after_fail(mocker, compact):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+    payload = {"time": "2025-07-01 12:00:00", "status": "online"}
+
+    await notifications.handle_life(mac, payload)
+    await notifications.expire_deadlines(datetime.now() + timedelta(seconds=60))
+    await notifications.handle_life(mac, payload)
+
+    assert [call.args[2] for call in mock_ch_life.await_args_list] == ["online", "fail", "restored", "online"]
+
+
+@pytest.mark.asyncio
+async def test_raw_life_writes_every_heartbeat(mocker, compact):
+    mocker.patch.object(notifications, "LIFE_MODE", "raw")
+    mock_ch_life = mocker.patch("notifications.clickhouse_insert_life", new_callable=AsyncMock)
+
+    for _ in range(3):
+        await notifications.handle_life("AA:BB:CC:DD:EE:FF", {"time": "2025-07-01 12:00:00", "status": "online"})
+
+    assert mock_ch_life.await_count == 3
+    assert notifications.summaries == {}
@@ -0,0 +1,86 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from aiomqtt import MqttError
+
+import publisher
+
+
+def make_client(publish):
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mock_client.publish = publish
+    return mock_client
+
+
+@pytest.mark.asyncio
+async def test_publish_uses_shared_connection(mocker):
+    mock_publish = AsyncMock()
+    mock_client_class = mocker.patch("publisher.Client", return_value=make_client(mock_publish))
+    pub = publisher.Publisher(concurrency=2)
+
+    task = asyncio.create_task(pub.run())
+    await pub.publish("intercom/00:11:22:33:44:55/management", payload="a", qos=1)
+    await pub.publish("intercom/00:11:22:33:44:56/management", payload="b", qos=1, retain=True)
+    task.cancel()
+
+    mock_client_class.assert_called_once_with("mqtt")
+    assert mock_publish.await_count == 2
+    args, kwargs = mock_publish.call_args
+    assert args[0] == "intercom/00:11:22:33:44:56/management"
+    assert kwargs == {"payload": "b", "qos": 1, "retain": True}
+    assert pub.stats["published"] == 2
+
+
+@pytest.mark.asyncio
+async def test_publish_retries_after_reconnect(mocker):
+    mock_publish = AsyncMock(side_effect=[MqttError("connection lost"), None])
+    mock_client_class = mocker.patch("publisher.Client", return_value=make_client(mock_publish))
+    mocker.patch("publisher.RECONNECT_DELAY", 0)
+    pub = publisher.Publisher(concurrency=1)
+
+    task = asyncio.create_task(pub.run())
+    await pub.publish("intercom/00:11:22:33:44:55/management", payload="a", qos=1)
+    task.cancel()
+
+    assert mock_client_class.call_count == 2
+    assert mock_publish.await_count == 2
+    assert pub.stats["reconnects"] == 1
+    assert pub.stats["published"] == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_times_out_without_connection():
+    pub = publisher.Publisher()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await pub.publish("intercom/00:11:22:33:44:55/management", payload="a", qos=1, timeout=0.01)
+
+
+@pytest.mark.asyncio
+async def test_publish_error_reaches_caller_and_worker_survives(mocker):
+    mock_publish = AsyncMock(side_effect=[TypeError("bad payload"), None])
+    mock_client_class = mocker.patch("publisher.Client", return_value=make_client(mock_publish))
+    pub = publisher.Publisher(concurrency=1)
+
+    task = asyncio.create_task(pub.run())
+    with pytest.raises(TypeError):
+        await pub.publish("intercom/00:11:22:33:44:55/management", payload=object(), qos=1, timeout=1)
+    await pub.publish("intercom/00:11:22:33:44:55/management", payload="a", qos=1, timeout=1)
+    task.cancel()
+
+    mock_client_class.assert_called_once()
+    assert pub.stats["published"] == 1
+    assert pub.stats["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_waits_for_room_in_full_queue():
+    pub = publisher.Publisher(queue_size=1)
+    first = asyncio.create_task(pub.publish("a", timeout=1))
+    await asyncio.sleep(0)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await pub.publish("b", timeout=0.01)
+    first.cancel()
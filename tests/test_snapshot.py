@@ -0,0 +1,89 @@
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import notifications
+import snapshot
+import state
+
+
+@pytest.fixture
+def fresh_state(mocker):
+    mocker.patch.object(state, "door_phones", state.Registry())
+    mocker.patch.object(state, "last_seen", {})
+    mocker.patch.object(state, "current_calls", {})
+    mocker.patch.object(notifications, "life_timeouts", {})
+    mocker.patch.object(notifications, "deadlines", [])
+    mocker.patch.object(notifications, "next_deadline", {})
+    mocker.patch.object(notifications, "wakeup", None)
+
+
+@pytest.mark.asyncio
+async def test_snapshot_round_trip(fresh_state, tmp_path):
+    path = str(tmp_path / "state.json")
+    state.door_phones.put(state.DoorPhone("00:11:22:33:44:55", {"location": "X1", "apartments": [1],
+                                                                "allowed_keys": [2]}))
+    state.door_phones.put(state.DoorPhone("00:11:22:33:44:60", {"location": "X2", "apartments": [3],
+                                                                "allowed_keys": []}, active=False, error=True))
+    state.last_seen["00:11:22:33:44:55"] = datetime(2025, 7, 1, 12, 0, 0)
+    state.current_calls["00:11:22:33:44:55"] = {"time": "2025-07-01 12:00:00", "apartment": "1", "location": "X1"}
+    notifications.life_timeouts["00:11:22:33:44:55"] = 30
+    await snapshot.save(path)
+
+    state.door_phones.clear()
+    state.last_seen.clear()
+    state.current_calls.clear()
+    notifications.life_timeouts.clear()
+
+    before = datetime.now()
+    assert snapshot.load(path) is True
+    assert state.door_phones["00:11:22:33:44:55"].location == "X1"
+    assert state.door_phones.errors == {"00:11:22:33:44:60"}
+    assert state.door_phones.find_by_apartment(3) == {"00:11:22:33:44:60"}
+    assert state.current_calls["00:11:22:33:44:55"]["apartment"] == "1"
+    assert notifications.life_timeouts == {"00:11:22:33:44:55": 30}
+    # Отсчёт таймаута начинается с момента загрузки
+    assert state.last_seen["00:11:22:33:44:55"] >= before
+    assert "00:11:22:33:44:55" in notifications.next_deadline
+    assert not (tmp_path / "state.json.tmp").exists()
+
+
+def test_snapshot_load_missing_or_corrupt(fresh_state, tmp_path):
+    assert snapshot.load(str(tmp_path / "missing.json")) is False
+    path = tmp_path / "state.json"
+    path.write_text('{"version": 1, "door_ph')
+    assert snapshot.load(str(path)) is False
+
+
+@pytest.mark.asyncio
+async def test_rebuild_from_clickhouse(mocker, fresh_state):
+    mock_client = MagicMock()
+    mock_client.query = AsyncMock(return_value=MagicMock(result_rows=[
+        ("00:11:22:33:44:55", "reconnect", '{"allowed_keys":[2],"apartments":[1],"location":"X1"}', None),
+        ("00:11:22:33:44:60", "removed", None, str({"location": "X2", "apartments": [3], "allowed_keys": []})),
+        ("00:11:22:33:44:70", "added", "not a dict {", None),
+    ]))
+    mocker.patch("snapshot.clickhouse.init_client", new_callable=AsyncMock, return_value=mock_client)
+
+    assert await snapshot.rebuild_from_clickhouse() is True
+
+    assert "argMax" in mock_client.query.call_args.args[0]
+    assert "intercom_config_bodies" in mock_client.query.call_args.args[0]
+    assert state.door_phones["00:11:22:33:44:55"].apartments == (1,)
+    assert state.door_phones.active == {"00:11:22:33:44:55"}
+    assert state.door_phones["00:11:22:33:44:60"].active is False
+    assert "00:11:22:33:44:70" not in state.door_phones
+    assert set(state.last_seen) == {"00:11:22:33:44:55"}
+
+
+@pytest.mark.asyncio
+async def test_restore_falls_back_to_clickhouse(mocker, fresh_state):
+    mocker.patch("snapshot.load", return_value=False)
+    mock_rebuild = mocker.patch("snapshot.rebuild_from_clickhouse", new_callable=AsyncMock, return_value=True)
+
+    assert await snapshot.restore() == "clickhouse"
+    mock_rebuild.assert_awaited_once()
+
+    mock_rebuild.side_effect = Exception("clickhouse is down")
+    assert await snapshot.restore() is None
@@ -0,0 +1,71 @@
+import pytest
+
+from spool import Spool
+
+
+@pytest.mark.asyncio
+async def test_spool_appends_and_replays_in_order(tmp_path):
+    spool = Spool(tmp_path, segment_max_bytes=32)
+    await spool.append([["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"]])
+    await spool.append([["life", "2025-07-01 12:00:01", "00:11:22:33:44:55", "online"],
+                        ["life", "2025-07-01 12:00:02", "00:11:22:33:44:55", "online"]])
+    assert spool.depth()["segments"] == 2
+    assert spool.depth()["rows"] == 3
+
+    batches = []
+
+    async def insert(rows):
+        batches.append(rows)
+
+    assert await spool.replay(insert) == 3
+    assert [len(rows) for rows in batches] == [1, 2]
+    assert batches[1][1][1] == "2025-07-01 12:00:02"
+    assert spool.depth()["rows"] == 0
+    assert list(tmp_path.iterdir()) == []
+    assert spool.stats["replayed_rows"] == 3
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_segment_when_replay_fails(tmp_path):
+    spool = Spool(tmp_path)
+    await spool.append([["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"]])
+
+    async def insert(rows):
+        raise Exception("clickhouse is down")
+
+    with pytest.raises(Exception):
+        await spool.replay(insert)
+    assert spool.depth()["rows"] == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_spool_recovers_after_crash(tmp_path):
+    spool = Spool(tmp_path)
+    await spool.append([["life", "2025-07-01 12:00:00", "00:11:22:33:44:55", "online"]])
+    # Процесс упал посреди записи строки
+    with open(spool.segment, "a") as f:
+        f.write('["life", "2025-07-01 12:0')
+
+    restarted = Spool(tmp_path)
+    restarted.recover()
+    assert restarted.depth()["rows"] == 1
+
+    batches = []
+
+    async def insert(rows):
+        batches.append(rows)
+
+    assert await restarted.replay(insert) == 1
+    assert restarted.stats["corrupt_rows"] == 1
+
+
+@pytest.mark.asyncio
+async def test_spool_drops_oldest_segment_when_full(tmp_path):
+    spool = Spool(tmp_path, segment_max_bytes=1, max_bytes=150)
+    for i in range(4):
+        await spool.append([["life", f"2025-07-01 12:00:0{i}", "00:11:22:33:44:55", "online"]])
+
+    assert spool.depth()["bytes"] <= 150
+    assert spool.stats["dropped_rows"] == 2
+    assert spool.depth()["rows"] == 2
@@ -8,15 +8,32 @@ import state
 ])
 @pytest.mark.asyncio
 async def test_add_or_update(mac, config):
-    state.door_phones = {"00:11:22:33:44:60":
-                             {"location": "X2", "apartments": [1, 3], "allowed_keys": [2, 4]}}
+    state.door_phones = state.Registry.load({"00:11:22:33:44:60":
+                                                 {"location": "X2", "apartments": [1, 3], "allowed_keys": [2, 4],
+                                                  "active": False, "error": True}})
     response = await state.add_or_update(mac, config)
     if mac == "00:11:22:33:44:55":
         assert response == "new/mod"
-        assert state.door_phones[mac]["active"] is True
-        assert state.door_phones[mac]["error"] is False
     else:
         assert response == "connect"
+    assert state.door_phones[mac].active is True
+    assert state.door_phones[mac].error is False
+    assert mac in state.door_phones.active
+    assert mac not in state.door_phones.errors
+
+
+@pytest.mark.asyncio
+async def test_add_or_update_detects_changed_config():
+    mac = "00:11:22:33:44:60"
+    state.door_phones = state.Registry.load({mac: {"location": "X2", "apartments": [1, 3], "allowed_keys": [2, 4]}})
+
+    response = await state.add_or_update(mac, {"location": "X3", "apartments": [3], "allowed_keys": [2, 4]})
+
+    assert response == "new/mod"
+    assert state.door_phones.find_by_location("X2") == set()
+    assert state.door_phones.find_by_location("X3") == {mac}
+    assert state.door_phones.find_by_apartment(1) == set()
+    assert state.door_phones.find_by_apartment("3") == {mac}
 
 
 @pytest.mark.parametrize("mac,config,error", [
@@ -26,25 +43,82 @@ async def test_add_or_update(mac, config):
 ])
 @pytest.mark.asyncio
 async def test_remove(mac, config, error):
-    state.door_phones = {"00:11:22:33:44:55": {"location": "X2",
-                                               "apartments": [1, 3], "allowed_keys": [2, 4], "active": True,
-                                               "error": False}}
+    state.door_phones = state.Registry.load({"00:11:22:33:44:55": {"location": "X2",
+                                                                   "apartments": [1, 3], "allowed_keys": [2, 4],
+                                                                   "active": True, "error": False}})
     await state.remove(mac, config=config, error=error)
-    if mac == "00:11:22:33:44:55":
-        assert state.door_phones[mac]["active"] is False
-        assert state.door_phones[mac]["error"] is True
-    else:
-        assert state.door_phones[mac]["active"] is False
-        assert state.door_phones[mac]["error"] is False
+    assert state.door_phones[mac].active is False
+    assert state.door_phones[mac].error is error
+    assert mac not in state.door_phones.active
+    assert (mac in state.door_phones.errors) is error
+
+
+@pytest.mark.asyncio
+async def test_remove_unknown_without_config():
+    state.door_phones = state.Registry()
+    await state.remove("00:11:22:33:44:55")
+    assert "00:11:22:33:44:55" not in state.door_phones
 
 
 def test_full_remove():
     mac = "00:11:22:33:44:55"
-    state.door_phones = {"00:11:22:33:44:55": {"location": "X2",
-                                               "apartments": [1, 3], "allowed_keys": [2, 4], "active": True,
-                                               "error": False}}
+    state.door_phones = state.Registry.load({"00:11:22:33:44:55": {"location": "X2",
+                                                                   "apartments": [1, 3], "allowed_keys": [2, 4],
+                                                                   "active": True, "error": False}})
     state.last_seen = {"00:11:22:33:44:55": "2025-07-01 16:45:20"}
     state.full_remove(mac)
 
-    assert state.door_phones == {}
+    assert state.door_phones.to_dict() == {}
+    assert state.door_phones.by_apartment == {}
+    assert state.door_phones.by_location == {}
+    assert state.door_phones.active == set()
     assert state.last_seen == {}
+
+
+def test_registry_indexes():
+    registry = state.Registry.load({
+        "00:11:22:33:44:55": {"location": "X1", "apartments": [1, 2], "allowed_keys": []},
+        "00:11:22:33:44:60": {"location": "X1", "apartments": [2], "allowed_keys": [], "active": False,
+                              "error": True},
+    })
+
+    assert registry.find_by_location("X1") == {"00:11:22:33:44:55", "00:11:22:33:44:60"}
+    assert registry.find_by_apartment(2) == {"00:11:22:33:44:55", "00:11:22:33:44:60"}
+    assert registry.find_by_apartment(1) == {"00:11:22:33:44:55"}
+    assert registry.active == {"00:11:22:33:44:55"}
+    assert registry.errors == {"00:11:22:33:44:60"}
+
+
+def test_config_hash_ignores_status_and_key_order():
+    assert state.config_hash({"location": "X1", "apartments": [1], "allowed_keys": [2], "active": True}) == \
+        state.config_hash({"allowed_keys": [2], "apartments": [1], "location": "X1"})
+    assert state.config_hash({"location": "X1", "apartments": [1], "allowed_keys": [2]}) != \
+        state.config_hash({"location": "X1", "apartments": [1], "allowed_keys": [3]})
+
+
+def test_door_phone_to_dict():
+    device = state.DoorPhone("00:11:22:33:44:55", {"location": "X1", "apartments": [1], "allowed_keys": [2],
+                                                   "life_timeout": 30})
+
+    assert device.to_dict() == {"location": "X1", "apartments": [1], "allowed_keys": [2], "life_timeout": 30,
+                                "active": True, "error": False}
+
+
+@pytest.mark.asyncio
+async def test_add_or_update_publishes_change(mocker):
+    mock_publish = mocker.patch("state.events.publish")
+    state.door_phones = state.Registry()
+    await state.add_or_update("00:11:22:33:44:55", {"location": "X1", "apartments": [1], "allowed_keys": [2]})
+
+    mock_publish.assert_called_once()
+    channel, kind, data = mock_publish.call_args.args
+    assert (channel, kind) == ("doorphones", "update")
+    assert data["mac"] == "00:11:22:33:44:55"
+    assert data["config"]["active"] is True
+
+
+def test_full_remove_publishes_change(mocker):
+    mock_publish = mocker.patch("state.events.publish")
+    state.full_remove("00:11:22:33:44:55")
+
+    mock_publish.assert_called_once_with("doorphones", "remove", {"mac": "00:11:22:33:44:55"})